@@ -0,0 +1,120 @@
+"""
+Аутентификация по токену с кэшем.
+
+Пользователь токена ищется сначала в памяти процесса, затем в общем
+кэше (Redis) и только потом в базе. В кэше хранятся только ИД пользователя
+и флаги для проверки прав (AUTH_FIELDS): хэш пароля и личные данные туда не
+попадают, а остальные поля загружаются из базы при первом обращении к ним.
+При выходе, смене пароля и отключении пользователя запись удаляется из
+общего кэша; в памяти других процессов она живёт не дольше
+AUTH_TOKEN_LOCAL_TIMEOUT секунд.
+"""
+import time
+from collections import OrderedDict
+from hashlib import sha256
+from threading import Lock
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+from .models import User
+
+CACHE_TIMEOUT = getattr(settings, 'AUTH_TOKEN_CACHE_TIMEOUT', 60)
+LOCAL_TIMEOUT = getattr(settings, 'AUTH_TOKEN_LOCAL_TIMEOUT', 5)
+LOCAL_SIZE = getattr(settings, 'AUTH_TOKEN_LOCAL_SIZE', 10000)
+
+# поля пользователя, которых достаточно для аутентификации и проверки прав в представлениях
+AUTH_FIELDS = ('id', 'is_active', 'is_staff', 'type')
+
+
+def token_cache_key(key):
+    # сам токен в ключах кэша не храним
+    return 'auth:token:' + sha256(key.encode()).hexdigest()
+
+
+class TokenCache:
+    """
+    Двухуровневый кэш: LRU в памяти процесса с коротким сроком жизни поверх общего кэша
+    """
+
+    def __init__(self, timeout=CACHE_TIMEOUT, local_timeout=LOCAL_TIMEOUT, maxsize=LOCAL_SIZE):
+        self.timeout = timeout
+        self.local_timeout = local_timeout
+        self.maxsize = maxsize
+        self._local = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        cache_key = token_cache_key(key)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._local.get(cache_key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._local.move_to_end(cache_key)
+                    return entry[1]
+                del self._local[cache_key]
+
+        value = cache.get(cache_key)
+        if value is not None:
+            self._remember(cache_key, value, now)
+        return value
+
+    def set(self, key, value):
+        cache_key = token_cache_key(key)
+        cache.set(cache_key, value, self.timeout)
+        self._remember(cache_key, value, time.monotonic())
+
+    def delete(self, *keys):
+        cache_keys = [token_cache_key(key) for key in keys]
+        cache.delete_many(cache_keys)
+        with self._lock:
+            for cache_key in cache_keys:
+                self._local.pop(cache_key, None)
+
+    def _remember(self, cache_key, value, now):
+        with self._lock:
+            self._local[cache_key] = (now + self.local_timeout, value)
+            self._local.move_to_end(cache_key)
+            while len(self._local) > self.maxsize:
+                self._local.popitem(last=False)
+
+
+token_cache = TokenCache()
+
+
+def invalidate_user_tokens(user_id):
+    """
+    Удаляет из кэша токены пользователя
+    """
+    keys = list(Token.objects.filter(user_id=user_id).values_list('key', flat=True))
+    if keys:
+        token_cache.delete(*keys)
+
+
+def auth_user(values):
+    """
+    Пользователь с загруженными полями AUTH_FIELDS, остальные поля читаются из базы при обращении
+    """
+    names = [field.attname for field in User._meta.concrete_fields if field.attname in AUTH_FIELDS]
+    return User.from_db(DEFAULT_DB_ALIAS, names, [values[name] for name in names])
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    TokenAuthentication, которому не нужен запрос к базе при повторных обращениях
+    """
+
+    def authenticate_credentials(self, key):
+        values = token_cache.get(key)
+        if values is None:
+            # неверный токен или неактивный пользователь - AuthenticationFailed, в кэш не попадает
+            user, token = super().authenticate_credentials(key)
+            token_cache.set(key, {name: getattr(user, name) for name in AUTH_FIELDS})
+            return user, token
+
+        user = auth_user(values)
+        return user, Token(key=key, user=user)
@@ -1,3 +1,83 @@
+from django.core.cache import cache
 from django.test import TestCase
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
 
-# Create your tests here.
+from auth_api.authentication import CachedTokenAuthentication, token_cache, token_cache_key
+from auth_api.models import User
+
+
+class CachedTokenAuthenticationTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('shop@example.com', password='Secret-123', username='shop',
+                                             type='shop', is_active=True)
+        self.token = Token.objects.create(user=self.user)
+        self.addCleanup(token_cache.delete, self.token.key)
+
+    def test_cache_holds_only_auth_fields(self):
+        CachedTokenAuthentication().authenticate_credentials(self.token.key)
+
+        self.assertEqual(cache.get(token_cache_key(self.token.key)),
+                         {'id': self.user.id, 'is_active': True, 'is_staff': False, 'type': 'shop'})
+
+    def test_cached_user(self):
+        authentication = CachedTokenAuthentication()
+        authentication.authenticate_credentials(self.token.key)
+
+        with self.assertNumQueries(0):
+            user, token = authentication.authenticate_credentials(self.token.key)
+        self.assertEqual((user.id, user.type, token.key, token.user_id),
+                         (self.user.id, 'shop', self.token.key, self.user.id))
+        # остальные поля загружаются из базы при обращении
+        with self.assertNumQueries(1):
+            self.assertEqual(user.email, 'shop@example.com')
+
+    def test_account_details(self):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        client.get('/api/v1/user/details')
+
+        response = client.get('/api/v1/user/details')
+        self.assertEqual(response.json()['email'], 'shop@example.com')
+
+    def test_deactivated_user_is_rejected(self):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        self.assertEqual(client.get('/api/v1/user/details').status_code, 200)
+
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(client.get('/api/v1/user/details').status_code, 403)
+
+    def test_cache_hit_without_queries(self):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        client.get('/api/v1/user/details')
+        # повторный запрос находит токен в памяти процесса, а без неё - в общем кэше
+        for clear_local in (False, True):
+            if clear_local:
+                token_cache._local.clear()
+            with self.assertNumQueries(0):
+                user, _ = CachedTokenAuthentication().authenticate_credentials(self.token.key)
+            self.assertEqual(user.id, self.user.id)
+
+    def test_logout_invalidates_token(self):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        self.assertEqual(client.get('/api/v1/user/details').status_code, 200)
+
+        self.assertEqual(client.post('/api/v1/user/logout').status_code, 200)
+        self.assertIsNone(cache.get(token_cache_key(self.token.key)))
+        self.assertEqual(client.get('/api/v1/user/details').status_code, 403)
+
+    def test_deleted_token_is_rejected(self):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        self.assertEqual(client.get('/api/v1/user/details').status_code, 200)
+
+        # токен удалили в админке
+        key = self.token.key
+        self.token.delete()
+        self.assertIsNone(token_cache.get(key))
+        self.assertEqual(client.get('/api/v1/user/details').status_code, 403)
@@ -1,6 +1,7 @@
 import os
 import sentry_sdk
 
+from celery.schedules import crontab
 from sentry_sdk.integrations.django import DjangoIntegration
 
 # sentry_sdk.init(
@@ -33,12 +34,14 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'shop.middleware.QueryCountMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'shop.middleware.ReplicaPinMiddleware',
 ]
 
 ROOT_URLCONF = 'orders.urls'
@@ -68,6 +71,17 @@ DATABASES = {
     }
 }
 
+# Реплики только для чтения - имена из DATABASES, например:
+# DATABASES['replica'] = {'ENGINE': ..., 'NAME': ..., 'TEST': {'MIRROR': 'default'}}
+# Локально можно указать копию db.sqlite3.
+DATABASE_REPLICAS = []
+DATABASE_ROUTERS = ['shop.routers.ReplicaRouter']
+# отставание реплики в секундах, после которого читаем из основной базы, и период проверки
+REPLICA_MAX_LAG = 5
+REPLICA_HEALTH_INTERVAL = 10
+# сколько секунд после записи пользователь читает из основной базы
+REPLICA_PIN_TIMEOUT = 10
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
@@ -94,6 +108,43 @@ STATIC_URL = '/static/'
 
 STORAGE = os.path.join(BASE_DIR, 'storage')
 
+# сколько секунд держать резерв товара по неподтверждённому заказу
+STOCK_RESERVATION_TTL = 24 * 60 * 60
+# наибольшее количество одного товара в позиции корзины
+BASKET_MAX_QUANTITY = 1000
+# сколько секунд лента изменений каталога хранит записи об удалении позиций
+CATALOG_CHANGES_RETENTION = 30 * 24 * 60 * 60
+
+# сколько секунд токен хранится в общем кэше и в памяти процесса
+AUTH_TOKEN_CACHE_TIMEOUT = 60
+AUTH_TOKEN_LOCAL_TIMEOUT = 5
+
+# размер пачки товаров при импорте прайс-листа
+IMPORT_BATCH_SIZE = 1000
+# размер части файла при чтении прайс-листа
+PRICE_READ_CHUNK_SIZE = 64 * 1024
+# размер части прайса для параллельной загрузки несколькими воркерами
+IMPORT_CHUNK_SIZE = 10000
+# через сколько секунд незавершённая загрузка прайса считается зависшей и не мешает начать новую
+IMPORT_STALE_AFTER = 2 * 60 * 60
+# скачивание прайсов по ссылке: размер части при записи в хранилище, тайм-ауты соединения и чтения,
+# размер пула соединений сессии и число повторов при ошибках 502-504
+PRICE_FETCH_CHUNK_SIZE = 64 * 1024
+PRICE_FETCH_TIMEOUT = (10, 60)
+PRICE_FETCH_POOL_SIZE = 10
+PRICE_FETCH_RETRIES = 3
+# наибольший размер скачиваемого прайса в байтах после распаковки
+PRICE_FETCH_MAX_SIZE = 100 * 1024 * 1024
+# скачивание с адресов внутренней сети (loopback, частные диапазоны), только для локальной разработки
+PRICE_FETCH_ALLOW_PRIVATE = False
+# обновление прайсов по расписанию: наименьший интервал в минутах, сколько загрузок выполняется одновременно
+# и случайное отклонение момента обновления в долях интервала
+PRICE_REFRESH_MIN_INTERVAL = 15
+PRICE_REFRESH_MAX_CONCURRENT = 4
+PRICE_REFRESH_JITTER = 0.1
+# сколько названий параметров и категорий держать в кэше процесса
+NAME_RESOLVER_CACHE_SIZE = 10000
+
 AUTH_USER_MODEL = 'auth_api.User'
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 
@@ -104,6 +155,14 @@ EMAIL_PORT = '465'
 EMAIL_USE_SSL = True
 SERVER_EMAIL = EMAIL_HOST_USER
 
+# очередь исходящих писем: размер пачки на одно SMTP-соединение, ограничение частоты, повторы и через
+# сколько секунд письма, взятые на отправку упавшим воркером, возвращаются в очередь
+EMAIL_OUTBOX_BATCH_SIZE = 50
+EMAIL_OUTBOX_RATE_LIMIT = '30/m'
+EMAIL_OUTBOX_MAX_ATTEMPTS = 5
+EMAIL_OUTBOX_RETRY_DELAY = 30
+EMAIL_OUTBOX_CLAIM_TIMEOUT = 10 * 60
+
 REST_FRAMEWORK = {
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 40,
@@ -117,11 +176,11 @@ REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
         'rest_framework.authentication.SessionAuthentication',
         'rest_framework.authentication.BasicAuthentication',
-        'rest_framework.authentication.TokenAuthentication',
+        'auth_api.authentication.CachedTokenAuthentication',
     ),
     'DEFAULT_THROTTLE_CLASSES': [
-        'rest_framework.throttling.AnonRateThrottle',
-        'rest_framework.throttling.UserRateThrottle'
+        'shop.throttling.RedisAnonRateThrottle',
+        'shop.throttling.RedisUserRateThrottle'
     ],
     'DEFAULT_THROTTLE_RATES': {
         'anon': '100/day',
@@ -130,9 +189,59 @@ REST_FRAMEWORK = {
     }
 }
 
+# учёт запросов к базе: сколько повторов запроса считать признаком N+1, как часто процесс
+# сбрасывает итоги в общий кэш и сколько секунд итоги там хранятся
+QUERY_DUPLICATE_THRESHOLD = 3
+QUERY_METRICS_FLUSH_INTERVAL = 10
+QUERY_METRICS_TIMEOUT = 7 * 24 * 60 * 60
+
 # REDIS related settings
 REDIS_HOST = 'localhost'
 REDIS_PORT = '6379'
 CELERY_BROKER_URL = 'redis://' + REDIS_HOST + ':' + REDIS_PORT + '/0'
 BROKER_TRANSPORT_OPTIONS = {'visibility_timeout': 3600}
 CELERY_RESULT_BACKEND = 'redis://' + REDIS_HOST + ':' + REDIS_PORT + '/0'
+CELERY_BEAT_SCHEDULE = {
+    # подбираем письма, оставшиеся в очереди после сбоев
+    'send-outbox': {
+        'task': 'shop.tasks.send_outbox',
+        'schedule': 60.0,
+    },
+    # отменяем заказы с истёкшим резервом товара
+    'expire-reservations': {
+        'task': 'shop.tasks.expire_reservations',
+        'schedule': 5 * 60.0,
+    },
+    # ставим в очередь обновление прайсов магазинов по расписанию
+    'schedule-price-refreshes': {
+        'task': 'shop.tasks.schedule_price_refreshes',
+        'schedule': 60.0,
+    },
+    # удаляем файлы прайсов, оставшиеся после сбоев загрузки
+    'purge-price-files': {
+        'task': 'shop.tasks.purge_price_files',
+        'schedule': 60 * 60.0,
+    },
+    # сжимаем ленту изменений каталога
+    'compact-catalog-changes': {
+        'task': 'shop.tasks.compact_catalog_changes',
+        'schedule': 24 * 60 * 60.0,
+    },
+    # рассылаем магазинам итоги заказов за прошедший день
+    'send-sales-reports': {
+        'task': 'shop.tasks.send_sales_reports',
+        'schedule': crontab(hour=6, minute=0),
+    },
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': 'redis://' + REDIS_HOST + ':' + REDIS_PORT + '/1',
+        'OPTIONS': {
+            'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+        },
+    }
+}
+# сколько секунд хранить страницы каталога в кэше
+CATALOG_CACHE_TIMEOUT = 300
@@ -1,11 +1,36 @@
 from django.contrib import admin
 
-from .models import Shop, Category, Product, ProductInfo, Parameter, ProductParameter, Order, OrderItem
+from .changes import record_changes
+from .models import Shop, Category, Product, ProductInfo, Parameter, ProductParameter, Order, OrderItem, \
+    ImportJob, OrderShopTotal, OutgoingEmail, StockReservation, CatalogChange, \
+    PriceListSource
+from .search import reindex
+
+# связи, которые читает __str__ модели: в выпадающих списках загружаем их одним запросом
+STR_RELATED = {
+    Shop: ('user',),
+    Product: ('category',),
+    ProductInfo: ('shop', 'product'),
+    Order: ('user',),
+    PriceListSource: ('user',),
+}
+
+
+class RelatedStrAdmin(admin.ModelAdmin):
+    """
+    Выпадающие списки связанных моделей без запроса на каждый вариант
+    """
+
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        related = STR_RELATED.get(db_field.related_model)
+        if related and 'queryset' not in kwargs:
+            kwargs['queryset'] = db_field.related_model._default_manager.select_related(*related)
+        return super().formfield_for_foreignkey(db_field, request, **kwargs)
 
 
 @admin.register(Shop)
-class ShopAdmin(admin.ModelAdmin):
-    pass
+class ShopAdmin(RelatedStrAdmin):
+    list_select_related = ('user',)
 
 
 @admin.register(Category)
@@ -14,13 +39,33 @@ class CategoryAdmin(admin.ModelAdmin):
 
 
 @admin.register(Product)
-class ProductAdmin(admin.ModelAdmin):
-    pass
+class ProductAdmin(RelatedStrAdmin):
+    list_select_related = ('category',)
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        # название продукта входит в термины поиска всех его позиций
+        reindex(obj.product_infos.values_list('id', flat=True))
 
 
 @admin.register(ProductInfo)
-class ProductInfoAdmin(admin.ModelAdmin):
-    pass
+class ProductInfoAdmin(RelatedStrAdmin):
+    list_select_related = ('shop', 'product')
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        reindex([obj.id])
+        record_changes(upserted=[obj.id])
+
+    def delete_model(self, request, obj):
+        pk = obj.id
+        super().delete_model(request, obj)
+        record_changes(deleted=[pk])
+
+    def delete_queryset(self, request, queryset):
+        ids = list(queryset.values_list('id', flat=True))
+        super().delete_queryset(request, queryset)
+        record_changes(deleted=ids)
 
 
 @admin.register(Parameter)
@@ -29,15 +74,70 @@ class ParameterAdmin(admin.ModelAdmin):
 
 
 @admin.register(ProductParameter)
-class ProductParameterAdmin(admin.ModelAdmin):
-    pass
+class ProductParameterAdmin(RelatedStrAdmin):
+    list_select_related = ('product_info', 'parameter')
+
+    def save_model(self, request, obj, form, change):
+        # параметр могли перенести на другую позицию
+        ids = {obj.product_info_id, form.initial.get('product_info')} - {None}
+        super().save_model(request, obj, form, change)
+        reindex(ids)
+        record_changes(upserted=ids)
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        reindex([obj.product_info_id])
+        record_changes(upserted=[obj.product_info_id])
+
+    def delete_queryset(self, request, queryset):
+        ids = set(queryset.values_list('product_info_id', flat=True))
+        super().delete_queryset(request, queryset)
+        reindex(ids)
+        record_changes(upserted=ids)
 
 
 @admin.register(Order)
-class OrderAdmin(admin.ModelAdmin):
-    pass
+class OrderAdmin(RelatedStrAdmin):
+    list_select_related = ('user',)
 
 
 @admin.register(OrderItem)
-class OrderItemAdmin(admin.ModelAdmin):
-    pass
+class OrderItemAdmin(RelatedStrAdmin):
+    list_select_related = ('order__user', 'product_info')
+
+
+@admin.register(ImportJob)
+class ImportJobAdmin(RelatedStrAdmin):
+    list_select_related = ('user',)
+    list_display = ('user', 'status', 'rows_parsed', 'rows_written', 'created_at', 'finished_at',)
+
+
+@admin.register(OrderShopTotal)
+class OrderShopTotalAdmin(RelatedStrAdmin):
+    list_select_related = ('order__user', 'shop__user')
+    list_display = ('order', 'shop', 'total_quantity', 'total_sum',)
+
+
+@admin.register(OutgoingEmail)
+class OutgoingEmailAdmin(admin.ModelAdmin):
+    list_display = ('to', 'subject', 'status', 'attempts', 'created_at', 'sent_at',)
+    list_filter = ('status',)
+
+
+@admin.register(StockReservation)
+class StockReservationAdmin(RelatedStrAdmin):
+    list_select_related = ('order__user', 'product_info__shop', 'product_info__product')
+    list_display = ('order', 'product_info', 'quantity', 'status', 'expires_at',)
+    list_filter = ('status',)
+
+
+@admin.register(CatalogChange)
+class CatalogChangeAdmin(admin.ModelAdmin):
+    list_display = ('id', 'product_info_id', 'action', 'created_at',)
+    list_filter = ('action',)
+
+
+@admin.register(PriceListSource)
+class PriceListSourceAdmin(RelatedStrAdmin):
+    list_select_related = ('user',)
+    list_display = ('user', 'url', 'etag', 'last_modified', 'fetched_at',)
@@ -0,0 +1,126 @@
+"""
+Кэш сериализованных страниц каталога.
+
+Ключ страницы содержит номер поколения: поколение магазина, если выборка
+ограничена магазином, и общее поколение каталога в остальных случаях.
+Сброс кэша магазина увеличивает оба номера, старые страницы просто
+перестают запрашиваться и вытесняются по таймауту.
+
+Для условных запросов у ресурсов (categories, shops, products) есть отметка
+времени последнего изменения. По ней строятся ETag и Last-Modified, и
+неизменившаяся страница отдаётся ответом 304 без выборки из базы. Основной
+валидатор - ETag: Last-Modified точен до секунды и отдаётся, только когда
+секунда отметки уже прошла.
+"""
+import time
+from hashlib import md5
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponseNotModified
+from django.utils.cache import get_conditional_response, quote_etag
+from django.utils.http import http_date
+
+CATALOG_CACHE_TIMEOUT = getattr(settings, 'CATALOG_CACHE_TIMEOUT', 300)
+
+
+def _scope(shop_id):
+    return f'catalog:generation:{shop_id}' if shop_id else 'catalog:generation'
+
+
+def _generation(scope):
+    generation = cache.get(scope)
+    if generation is None:
+        # начинаем не с единицы, чтобы после вытеснения счётчика не вернуться к старым страницам
+        cache.add(scope, int(time.time() * 1000), timeout=None)
+        generation = cache.get(scope)
+    return generation
+
+
+def catalog_page_key(query_params):
+    """
+    Ключ страницы каталога по всем параметрам запроса
+    """
+    shop_id = query_params.get('shop_id')
+    query = md5(urlencode(sorted(query_params.lists()), doseq=True).encode()).hexdigest()
+    return f'catalog:page:{_generation(_scope(shop_id))}:{query}'
+
+
+def invalidate_catalog(shop_id):
+    """
+    Сбрасывает закэшированные страницы каталога магазина
+    """
+    for scope in (_scope(shop_id), _scope(None)):
+        try:
+            cache.incr(scope)
+        except ValueError:
+            pass
+
+
+def _stamp_key(resource):
+    return f'stamp:{resource}'
+
+
+def stamp(resource):
+    """
+    Время последнего изменения ресурса
+    """
+    value = cache.get(_stamp_key(resource))
+    if value is None:
+        # отметка вытеснена из кэша: считаем, что ресурс изменился сейчас
+        cache.add(_stamp_key(resource), time.time(), timeout=None)
+        value = cache.get(_stamp_key(resource))
+    return value
+
+
+def touch(*resources):
+    """
+    Отмечает изменение ресурсов
+    """
+    now = time.time()
+    cache.set_many({_stamp_key(resource): now for resource in resources}, timeout=None)
+
+
+class NotModified(Exception):
+    pass
+
+
+class ConditionalGetMixin:
+    """
+    ETag и Last-Modified для GET по отметке stamp_resource.
+
+    ETag зависит от отметки, пути с параметрами и формата ответа. Проверка
+    идёт после аутентификации и ограничения частоты, но до выборки.
+
+    Если клиент прислал If-None-Match, If-Modified-Since не проверяется.
+    Два изменения в одну секунду по Last-Modified не различить, поэтому он
+    отдаётся и проверяется, только когда секунда отметки прошла: любое
+    следующее изменение получит уже другое значение.
+    """
+    stamp_resource = None
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        self.validators = None
+        if request.method in ('GET', 'HEAD'):
+            version = stamp(self.stamp_resource)
+            etag = quote_etag(md5(f'{version}:{request.get_full_path()}:{request.accepted_media_type}'.encode())
+                              .hexdigest())
+            last_modified = int(version) if int(version) < int(time.time()) else None
+            self.validators = (etag, last_modified)
+            if get_conditional_response(request, etag=etag, last_modified=last_modified) is not None:
+                raise NotModified()
+
+    def handle_exception(self, exc):
+        if isinstance(exc, NotModified):
+            return HttpResponseNotModified()
+        return super().handle_exception(exc)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if getattr(self, 'validators', None) and response.status_code in (200, 304):
+            response['ETag'] = self.validators[0]
+            if self.validators[1] is not None:
+                response['Last-Modified'] = http_date(self.validators[1])
+        return response
@@ -0,0 +1,67 @@
+"""
+Лента изменений каталога.
+
+Каждая вставка, изменение или удаление позиции (импортом, резервом товара
+или в админке) добавляет запись с монотонно растущим номером. Покупатель
+запрашивает изменения после последнего известного ему номера и получает
+только их. compact() удаляет записи, перекрытые более поздними по той же
+позиции, и старые записи об удалении.
+
+Номер последнего удалённого сжатием изменения (горизонт) хранится в базе:
+кто не видел его, должен загрузить каталог заново. В кэше лежит только его копия.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from .cache import touch
+from .models import CatalogChange, CatalogHorizon
+
+RETENTION = getattr(settings, 'CATALOG_CHANGES_RETENTION', 30 * 24 * 60 * 60)
+CHANGES_MAX_LIMIT = getattr(settings, 'CATALOG_CHANGES_MAX_LIMIT', 1000)
+
+HORIZON_KEY = 'catalog:changes:horizon'
+
+
+def record_changes(upserted=(), deleted=()):
+    changes = [CatalogChange(product_info_id=pk, action='upsert') for pk in upserted] + \
+              [CatalogChange(product_info_id=pk, action='delete') for pk in deleted]
+    if changes:
+        CatalogChange.objects.bulk_create(changes)
+        # ETag каталога меняем, только когда изменения видны другим запросам
+        transaction.on_commit(lambda: touch('products'))
+
+
+def horizon():
+    value = cache.get(HORIZON_KEY)
+    if value is None:
+        value = CatalogHorizon.objects.filter(id=1).values_list('change_id', flat=True).first() or 0
+        # add, а не set: значение, записанное сжатием после нашего чтения, не перезаписываем
+        cache.add(HORIZON_KEY, value, timeout=None)
+    return value
+
+
+def compact():
+    """
+    Сжимает ленту, возвращает количество удалённых записей
+    """
+    latest = CatalogChange.objects.values('product_info_id').annotate(last=Max('id')).values('last')
+    superseded, _ = CatalogChange.objects.exclude(id__in=latest).delete()
+
+    expired = CatalogChange.objects.filter(action='delete',
+                                           created_at__lt=timezone.now() - timedelta(seconds=RETENTION))
+    last = expired.aggregate(last=Max('id'))['last']
+    if last is None:
+        return superseded
+
+    with transaction.atomic():
+        current, _ = CatalogHorizon.objects.select_for_update().get_or_create(id=1)
+        current.change_id = max(current.change_id, last)
+        current.save()
+        deleted, _ = expired.filter(id__lte=last).delete()
+        transaction.on_commit(lambda: cache.set(HORIZON_KEY, current.change_id, timeout=None))
+    return superseded + deleted
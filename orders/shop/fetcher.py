@@ -0,0 +1,181 @@
+"""
+Скачивание прайс-листов поставщиков по ссылке.
+
+Запрос условный: ETag и Last-Modified прошлой загрузки уходят в заголовках
+If-None-Match и If-Modified-Since, и на ответ 304 файл не скачивается.
+Тело ответа пишется в хранилище (settings.STORAGE) частями по
+PRICE_FETCH_CHUNK_SIZE байт, по пути считается SHA-256. Если сервер не
+поддерживает условные запросы, а содержимое совпало с прошлой загрузкой,
+файл удаляется и импорт не запускается.
+
+Скачиваются только файлы до PRICE_FETCH_MAX_SIZE байт и только с публичных
+адресов: ссылку присылает поставщик, и она не должна вести во внутреннюю
+сеть сервиса. Адрес проверяется перед каждым запросом, в том числе после
+перенаправления.
+
+HTTP-сессии с пулом соединений создаются по одной на поток и
+переиспользуются между загрузками.
+"""
+import hashlib
+import ipaddress
+import os
+import socket
+import threading
+from urllib.parse import urljoin, urlparse
+
+from django.conf import settings
+from django.core.files import File
+from django.utils import timezone
+from requests import Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .models import PriceListSource, storage
+
+CHUNK_SIZE = getattr(settings, 'PRICE_FETCH_CHUNK_SIZE', 64 * 1024)
+# (ожидание соединения, ожидание очередной части ответа) в секундах
+TIMEOUT = getattr(settings, 'PRICE_FETCH_TIMEOUT', (10, 60))
+POOL_SIZE = getattr(settings, 'PRICE_FETCH_POOL_SIZE', 10)
+RETRIES = getattr(settings, 'PRICE_FETCH_RETRIES', 3)
+MAX_SIZE = getattr(settings, 'PRICE_FETCH_MAX_SIZE', 100 * 1024 * 1024)
+ALLOW_PRIVATE = getattr(settings, 'PRICE_FETCH_ALLOW_PRIVATE', False)
+MAX_REDIRECTS = 5
+
+_local = threading.local()
+
+
+class PriceFetchError(ValueError):
+    """
+    Прайс по ссылке нельзя скачать: адрес не публичный или файл слишком большой
+    """
+
+
+def get_session():
+    """
+    HTTP-сессия текущего потока
+    """
+    session = getattr(_local, 'session', None)
+    if session is None:
+        retry = Retry(total=RETRIES, backoff_factor=1, status_forcelist=(502, 503, 504))
+        adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=retry)
+        session = _local.session = Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+    return session
+
+
+class HashingReader:
+    """
+    Файлоподобная обёртка над частями тела ответа, считает SHA-256 прочитанного
+    """
+
+    def __init__(self, chunks, max_size):
+        self.chunks = chunks
+        self.hash = hashlib.sha256()
+        self.size = 0
+        self.max_size = max_size
+
+    @property
+    def too_large(self):
+        return self.size > self.max_size
+
+    def read(self, size=-1):
+        # после превышения размера отдаём конец файла: хранилище закроет файл, и его можно удалить
+        if self.too_large:
+            return b''
+        # части приходят размером PRICE_FETCH_CHUNK_SIZE, size хранилища не важен
+        data = next(self.chunks, b'')
+        self.hash.update(data)
+        self.size += len(data)
+        return data
+
+
+def check_url(url):
+    """
+    Проверяет, что ссылка http(s) ведёт на публичный адрес, а не на loopback,
+    частные и служебные диапазоны
+    """
+    parsed = urlparse(url)
+    if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+        raise PriceFetchError(f'Прайс скачивается только по ссылкам http и https: {url}')
+    if ALLOW_PRIVATE:
+        return
+
+    try:
+        addresses = socket.getaddrinfo(parsed.hostname, None, proto=socket.IPPROTO_TCP)
+    except (socket.gaierror, UnicodeError):
+        raise PriceFetchError(f'Не удалось найти адрес {parsed.hostname}')
+    # хост проверяем по всем его адресам: соединение может уйти на любой
+    for *_, sockaddr in addresses:
+        if not ipaddress.ip_address(sockaddr[0].split('%')[0]).is_global:
+            raise PriceFetchError(f'Адрес {parsed.hostname} недоступен для загрузки прайса')
+
+
+def open_url(url, headers):
+    """
+    GET-запрос с проверкой адреса перед каждым перенаправлением
+    """
+    for _ in range(MAX_REDIRECTS + 1):
+        check_url(url)
+        response = get_session().get(url, headers=headers, stream=True, timeout=TIMEOUT, allow_redirects=False)
+        if not response.is_redirect:
+            return response
+        response.close()
+        url = urljoin(url, response.headers['Location'])
+    raise PriceFetchError(f'Больше {MAX_REDIRECTS} перенаправлений: {url}')
+
+
+def get_source(user_id, url):
+    source, _ = PriceListSource.objects.get_or_create(user_id=user_id, url=url)
+    return source
+
+
+def fetch_price_list(source):
+    """
+    Скачивает прайс источника в хранилище и возвращает имя файла
+    или None, если прайс не изменился с прошлой загрузки
+    """
+    headers = {}
+    if source.etag:
+        headers['If-None-Match'] = source.etag
+    if source.last_modified:
+        headers['If-Modified-Since'] = source.last_modified
+
+    with open_url(source.url, headers) as response:
+        source.fetched_at = timezone.now()
+        if response.status_code == 304:
+            source.save(update_fields=['fetched_at'])
+            return None
+        response.raise_for_status()
+
+        length = response.headers.get('Content-Length', '')
+        if length.isdigit() and int(length) > MAX_SIZE:
+            raise PriceFetchError(f'Прайс больше {MAX_SIZE} байт')
+
+        name = os.path.basename(urlparse(source.url).path) or 'price.yaml'
+        # iter_content распаковывает gzip и deflate, если сервер сжал ответ,
+        # поэтому размер проверяется ещё и по распакованным данным
+        reader = HashingReader(response.iter_content(CHUNK_SIZE), MAX_SIZE)
+        file_name = storage.save(name, File(reader, name=name))
+
+    if reader.too_large:
+        storage.delete(file_name)
+        raise PriceFetchError(f'Прайс больше {MAX_SIZE} байт')
+
+    content_hash = reader.hash.hexdigest()
+    if content_hash == source.content_hash:
+        storage.delete(file_name)
+        file_name = None
+
+    source.etag = response.headers.get('ETag', '')
+    source.last_modified = response.headers.get('Last-Modified', '')
+    source.content_hash = content_hash
+    source.save()
+    return file_name
+
+
+def forget_price_list(source_id):
+    """
+    Прайс не загрузился: следующая загрузка скачает и загрузит его целиком
+    """
+    PriceListSource.objects.filter(id=source_id).update(etag='', last_modified='', content_hash='')
@@ -0,0 +1,351 @@
+"""
+Потоковый импорт прайс-листов поставщиков.
+
+Прайс-лист любого формата из shop.readers разбирается по одному товару:
+в памяти одновременно находится только текущая пачка товаров и внешние ИД
+уже прочитанных. Каждая пачка сравнивается с уже загруженными позициями
+магазина по внешнему ИД, и в базу уходят только вставки, обновления
+и удаления того, что действительно изменилось.
+
+Разделы прайса могут идти в любом порядке. Магазин находится по
+пользователю, а товары категорий, которые ещё не встретились, откладываются
+до конца файла.
+
+Покупатели видят каталог магазина целиком в одной версии: новые позиции
+пишутся с номером следующей версии и скрыты, а изменения видимых позиций
+каждой пачки сохраняются в ImportStage и применяются в publish() одной
+транзакцией вместе с удалениями и переключением Shop.catalog_version.
+"""
+from django.conf import settings
+from django.db import transaction
+from ujson import dumps as dump_json, loads as load_json
+
+from .cache import invalidate_catalog, touch
+from .changes import record_changes
+from .models import ImportStage, Product, ProductInfo, ProductParameter, SearchTerm, Shop
+from .readers import PriceListError, iter_price_list
+from .reservations import reserved_quantities
+from .resolvers import category_resolver, parameter_resolver
+from .search import item_terms
+
+BATCH_SIZE = getattr(settings, 'IMPORT_BATCH_SIZE', 1000)
+
+# поля ProductInfo, которые берутся из прайса и сравниваются при импорте
+INFO_FIELDS = ('model', 'quantity', 'price', 'price_rrc', 'product_id')
+
+# отложенные до publish() изменения видимых позиций, только простые типы для записи в ImportStage
+PENDING_KEYS = ('infos', 'parameters', 'values', 'removed', 'terms', 'dropped_terms', 'changed')
+
+
+class PriceListImporter:
+    """
+    Загружает прайс-лист поставщика пачками по batch_size товаров.
+
+    progress, если передан, вызывается со статистикой после каждой пачки.
+    """
+
+    def __init__(self, user_id, batch_size=BATCH_SIZE, progress=None, shop=None, category_ids=None, version=None):
+        self.user_id = user_id
+        self.batch_size = batch_size
+        self.progress = progress
+        self.shop = shop
+        self.version = version
+        if shop is not None and version is None:
+            self.version = shop.catalog_version + 1
+        self.shop_named = False
+        self.shop_created = False
+        self.categories = []
+        self.category_ids = dict(category_ids or {})
+        # товары, категории которых в прайсе ещё не встретились
+        self.deferred = []
+        self.seen = set()
+        self.stats = {'parsed': 0, 'created': 0, 'updated': 0, 'deleted': 0}
+        self.pending = {key: [] for key in PENDING_KEYS}
+
+    def run(self, stream):
+        self.apply_items(self.iter_goods(stream))
+        self.publish()
+        self.report()
+        return self.stats
+
+    def iter_goods(self, stream):
+        """
+        Загружает магазин и категории прайса, а товары отдаёт по одному
+        """
+        for section, value in iter_price_list(stream):
+            if section == 'shop':
+                self.shop_named = True
+                self.load_shop(value)
+                continue
+
+            self.load_shop()
+            if section == 'category':
+                self.categories.append(value)
+            elif section == 'goods':
+                self.load_categories()
+                if value['category'] in self.category_ids:
+                    yield value
+                else:
+                    self.deferred.append(value)
+
+        self.load_shop()
+        if not self.shop_named:
+            if self.shop_created:
+                self.shop.delete()
+            raise PriceListError('В прайс-листе не указан магазин')
+        self.load_categories()
+        # неизвестные и после всех категорий товары отклонит resolve_products()
+        deferred, self.deferred = self.deferred, []
+        yield from deferred
+
+    def load_shop(self, name=None):
+        """
+        Находит магазин поставщика. Название из прайса нужно только новому магазину,
+        поэтому раздел shop может идти после товаров
+        """
+        if self.shop is None:
+            self.shop, self.shop_created = Shop.objects.get_or_create(user_id=self.user_id,
+                                                                      defaults={'name': name or ''})
+            self.version = self.shop.catalog_version + 1
+            # изменения, оставшиеся от прерванного импорта той же версии, не должны попасть в каталог
+            ImportStage.objects.filter(shop=self.shop).delete()
+        elif name and not self.shop.name:
+            self.shop.name = name
+            Shop.objects.filter(id=self.shop.id).update(name=name)
+
+    def apply_items(self, items):
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                self.apply_batch(batch)
+                batch = []
+
+        if batch:
+            self.apply_batch(batch)
+
+    def report(self):
+        if self.progress:
+            self.progress(self.stats)
+
+    def load_categories(self):
+        """
+        Сопоставляет категории прайса с общим справочником по названию
+        """
+        if not self.categories:
+            return
+
+        ids = category_resolver.resolve(category['name'] for category in self.categories)
+        self.category_ids.update({category['id']: ids[category['name']] for category in self.categories})
+        self.shop.categories.add(*ids.values())
+        self.categories = []
+
+    def apply_batch(self, items):
+        # при повторе внешнего ИД в прайсе действует последняя запись
+        items = {item['id']: item for item in items}
+        self.stats['parsed'] += len(items)
+        self.seen.update(items)
+
+        products = self.resolve_products(items.values())
+        parameters = parameter_resolver.resolve(
+            name for item in items.values() for name in item.get('parameters', {}))
+
+        existing = {
+            row[0]: (row[1], row[2:]) for row in ProductInfo.objects.filter(
+                shop=self.shop, external_id__in=items).values_list('external_id', 'id', *INFO_FIELDS)
+        }
+
+        # остаток у поставщика уменьшаем на товар в активных резервах покупателей. Здесь - только чтобы
+        # понять, изменилась ли позиция: до publish() резервы могут измениться, остаток пересчитывается там
+        reserved = reserved_quantities([row[0] for row in existing.values()])
+
+        created = []
+        for external_id, item in items.items():
+            supplied = (item['model'], item['quantity'], item['price'], item['price_rrc'],
+                        products[(item['name'], self.category_ids[item['category']])])
+            if external_id not in existing:
+                created.append(ProductInfo(shop=self.shop, external_id=external_id, version=self.version,
+                                           **dict(zip(INFO_FIELDS, supplied))))
+                continue
+            info_id = existing[external_id][0]
+            values = (supplied[0], max(supplied[1] - reserved.get(info_id, 0), 0), *supplied[2:])
+            if existing[external_id][1] != values:
+                # в ImportStage - остаток поставщика, без резервов
+                self.pending['infos'].append([info_id, *supplied])
+                self.pending['changed'].append(existing[external_id][0])
+                self.stats['updated'] += 1
+
+        with transaction.atomic():
+            # новые позиции не видны покупателям, пока магазин не переключится на self.version
+            ProductInfo.objects.bulk_create(created, batch_size=self.batch_size)
+
+            info_ids = {external_id: row[0] for external_id, row in existing.items()}
+            if created:
+                new_ids = dict(ProductInfo.objects.filter(
+                    shop=self.shop, external_id__in=[info.external_id for info in created]).values_list(
+                    'external_id', 'id'))
+                info_ids.update(new_ids)
+                self.pending['changed'].extend(new_ids.values())
+            existing_ids = [row[0] for row in existing.values()]
+            self.sync_parameters(items, info_ids, parameters, existing_ids)
+            self.sync_terms(items, info_ids, parameters, existing_ids)
+            self.stage()
+
+        self.stats['created'] += len(created)
+        self.report()
+
+    def sync_parameters(self, items, info_ids, parameters, existing_ids):
+        current = {
+            (info_id, parameter_id): (pk, value) for pk, info_id, parameter_id, value in
+            ProductParameter.objects.filter(product_info_id__in=existing_ids).values_list(
+                'id', 'product_info_id', 'parameter_id', 'value')
+        }
+        existing_ids = set(existing_ids)
+
+        created = []
+        for external_id, item in items.items():
+            for name, value in item.get('parameters', {}).items():
+                key = (info_ids[external_id], parameters[name])
+                value = str(value)
+                if key not in current:
+                    if key[0] in existing_ids:
+                        self.pending['parameters'].append([key[0], key[1], value])
+                        self.pending['changed'].append(key[0])
+                    else:
+                        created.append(ProductParameter(product_info_id=key[0], parameter_id=key[1], value=value))
+                    continue
+                pk, old_value = current.pop(key)
+                if old_value != value:
+                    self.pending['values'].append([pk, value])
+                    self.pending['changed'].append(key[0])
+
+        ProductParameter.objects.bulk_create(created, batch_size=self.batch_size)
+        # всё, что осталось в current, из прайса пропало
+        self.pending['removed'].extend(pk for pk, _ in current.values())
+        self.pending['changed'].extend(info_id for info_id, _ in current)
+
+    def sync_terms(self, items, info_ids, parameters, existing_ids):
+        """
+        Обновляет индекс поиска по названию, модели и параметрам позиций пачки
+        """
+        current = {}
+        for pk, info_id, term in SearchTerm.objects.filter(product_info_id__in=existing_ids).values_list(
+                'id', 'product_info_id', 'term'):
+            current.setdefault(info_id, {})[term] = pk
+        existing_ids = set(existing_ids)
+
+        created = []
+        for external_id, item in items.items():
+            info_id = info_ids[external_id]
+            terms = item_terms(item['name'], item['model'], {
+                parameters[name]: value for name, value in item.get('parameters', {}).items()})
+            old_terms = current.get(info_id, {})
+
+            if info_id in existing_ids:
+                self.pending['terms'].extend([info_id, term] for term in terms - old_terms.keys())
+                self.pending['dropped_terms'].extend(pk for term, pk in old_terms.items() if term not in terms)
+            else:
+                created.extend(SearchTerm(product_info_id=info_id, term=term) for term in terms)
+
+        SearchTerm.objects.bulk_create(created, batch_size=self.batch_size)
+
+    def stage(self):
+        """
+        Сохраняет отложенные изменения пачки в ImportStage
+        """
+        if any(self.pending.values()):
+            ImportStage.objects.create(shop=self.shop, version=self.version, changes=dump_json(self.pending))
+        self.pending = {key: [] for key in PENDING_KEYS}
+
+    def publish(self):
+        """
+        Применяет отложенные изменения, удаляет пропавшие позиции и открывает
+        покупателям новую версию каталога одной транзакцией
+        """
+        stages = ImportStage.objects.filter(shop=self.shop, version=self.version)
+        with transaction.atomic():
+            # изменения читаем по одной пачке, чтобы в памяти не оказались все сразу
+            for stage_id in list(stages.values_list('id', flat=True)):
+                self.apply_pending(load_json(ImportStage.objects.get(id=stage_id).changes))
+            stages.delete()
+
+            stale = self.remove_stale()
+            record_changes(deleted=stale)
+            Shop.objects.filter(id=self.shop.id).update(catalog_version=self.version)
+
+        invalidate_catalog(self.shop.id)
+        # категории и параметры создаются при загрузке bulk_create, без сигналов
+        touch('categories', 'parameters', 'shops')
+
+        self.shop.catalog_version = self.version
+
+    def apply_pending(self, pending):
+        # строки блокируются до чтения резервов: оформление, уже списавшее остаток, успеет записать
+        # резерв, а следующее дождётся конца публикации и спишет остаток с нового значения
+        info_ids = sorted(row[0] for row in pending['infos'])
+        list(ProductInfo.objects.select_for_update().filter(id__in=info_ids).order_by('id').values_list('id'))
+        reserved = reserved_quantities(info_ids)
+
+        infos = []
+        for info_id, *values in pending['infos']:
+            info = ProductInfo(id=info_id, **dict(zip(INFO_FIELDS, values)))
+            info.quantity = max(info.quantity - reserved.get(info_id, 0), 0)
+            infos.append(info)
+        ProductInfo.objects.bulk_update(infos, INFO_FIELDS, batch_size=self.batch_size)
+        ProductParameter.objects.bulk_create(
+            [ProductParameter(product_info_id=info_id, parameter_id=parameter_id, value=value)
+             for info_id, parameter_id, value in pending['parameters']], batch_size=self.batch_size)
+        ProductParameter.objects.bulk_update(
+            [ProductParameter(id=pk, value=value) for pk, value in pending['values']], ('value',),
+            batch_size=self.batch_size)
+        for start in range(0, len(pending['removed']), self.batch_size):
+            ProductParameter.objects.filter(id__in=pending['removed'][start:start + self.batch_size]).delete()
+        SearchTerm.objects.bulk_create(
+            [SearchTerm(product_info_id=info_id, term=term) for info_id, term in pending['terms']],
+            batch_size=self.batch_size)
+        for start in range(0, len(pending['dropped_terms']), self.batch_size):
+            SearchTerm.objects.filter(id__in=pending['dropped_terms'][start:start + self.batch_size]).delete()
+        # ленту изменений пишем в той же транзакции, что и сами изменения
+        record_changes(upserted=set(pending['changed']))
+
+    def resolve_products(self, items):
+        """
+        Возвращает словарь (название, категория) -> ИД продукта, создавая недостающие продукты
+        """
+        keys = set()
+        for item in items:
+            if item['category'] not in self.category_ids:
+                raise PriceListError(f'Неизвестная категория {item["category"]} у товара {item["id"]}')
+            keys.add((item['name'], self.category_ids[item['category']]))
+        names = {name for name, _ in keys}
+
+        products = {
+            (name, category_id): pk for pk, name, category_id in
+            Product.objects.filter(name__in=names).values_list('id', 'name', 'category_id')
+        }
+        missing = keys - products.keys()
+        if missing:
+            # тот же продукт мог создать параллельный импорт, ИД перечитываются в любом случае
+            Product.objects.bulk_create([Product(name=name, category_id=category_id)
+                                         for name, category_id in missing], batch_size=self.batch_size,
+                                        ignore_conflicts=True)
+            products.update({
+                (name, category_id): pk for pk, name, category_id in
+                Product.objects.filter(name__in={name for name, _ in missing}).values_list(
+                    'id', 'name', 'category_id')
+            })
+        return products
+
+    def remove_stale(self):
+        """
+        Удаляет позиции магазина, которых больше нет в прайсе
+        """
+        stale = [
+            pk for pk, external_id in ProductInfo.objects.filter(shop=self.shop).values_list(
+                'id', 'external_id').iterator()
+            if external_id not in self.seen
+        ]
+        for start in range(0, len(stale), self.batch_size):
+            _, deleted = ProductInfo.objects.filter(id__in=stale[start:start + self.batch_size]).delete()
+            self.stats['deleted'] += deleted.get(ProductInfo._meta.label, 0)
+        return stale
@@ -0,0 +1,110 @@
+import os
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, connection, connections
+
+from auth_api.models import Contact, User
+from shop.models import Category, Order, OrderItem, Product, ProductInfo, Shop, StockReservation
+from shop.reservations import OutOfStock, reserve_order
+from shop.testing import bench_database
+
+
+class Command(BaseCommand):
+    help = 'Нагрузочная проверка резервирования: параллельные покупатели оформляют заказы на ходовые товары ' \
+           'в тестовой базе. Показательные цифры - на PostgreSQL, SQLite выполняет записи по очереди'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--buyers', type=int, default=100)
+        parser.add_argument('--skus', type=int, default=5)
+        parser.add_argument('--stock', type=int, default=100, help='Остаток каждого товара')
+        parser.add_argument('--max-quantity', type=int, default=3, help='Наибольшее количество в строке корзины')
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--keepdb', action='store_true')
+
+    def handle(self, *args, **options):
+        if connection.vendor == 'sqlite' and not connection.settings_dict['TEST']['NAME']:
+            # база в памяти не ждёт блокировку, а сразу отказывает параллельным записям
+            connection.settings_dict['TEST']['NAME'] = os.path.join(tempfile.gettempdir(), 'bench_checkout.sqlite3')
+
+        with bench_database(keepdb=options['keepdb']):
+            self.run(options)
+
+    def run(self, options):
+        random.seed(options['seed'])
+        infos, orders = self.prepare(options)
+        initial = dict(ProductInfo.objects.filter(id__in=infos).values_list('id', 'quantity'))
+
+        results = {'ok': 0, 'out_of_stock': 0, 'errors': 0}
+        latencies = []
+        lock = threading.Lock()
+        barrier = threading.Barrier(len(orders))
+
+        def checkout(order):
+            order_id, user_id, contact_id = order
+            barrier.wait()
+            started = time.perf_counter()
+            try:
+                outcome = 'ok' if reserve_order(order_id, user_id, contact_id) else 'errors'
+            except OutOfStock:
+                outcome = 'out_of_stock'
+            except DatabaseError:
+                outcome = 'errors'
+            finally:
+                connections.close_all()
+            with lock:
+                results[outcome] += 1
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=len(orders)) as executor:
+            list(executor.map(checkout, orders))
+        elapsed = time.perf_counter() - started
+
+        final = dict(ProductInfo.objects.filter(id__in=infos).values_list('id', 'quantity'))
+        reserved = {}
+        for product_info_id, quantity in StockReservation.objects.filter(status='active').values_list(
+                'product_info_id', 'quantity'):
+            reserved[product_info_id] = reserved.get(product_info_id, 0) + quantity
+        oversold = [pk for pk in infos if final[pk] + reserved.get(pk, 0) != initial[pk]]
+
+        latencies.sort()
+        self.stdout.write(f'Покупателей: {len(orders)}, товаров: {len(infos)}, время: {elapsed:.3f} с')
+        self.stdout.write(f'Оформлено: {results["ok"]}, не хватило товара: {results["out_of_stock"]}, '
+                          f'ошибок: {results["errors"]}')
+        self.stdout.write(f'Пропускная способность: {results["ok"] / elapsed:.1f} заказов/с, '
+                          f'p50: {latencies[len(latencies) // 2] * 1000:.1f} мс, '
+                          f'p95: {latencies[int(len(latencies) * 0.95) - 1] * 1000:.1f} мс')
+        if oversold or any(quantity < 0 for quantity in final.values()):
+            self.stdout.write(self.style.ERROR(f'Перепродажа по позициям: {oversold}'))
+        else:
+            self.stdout.write(self.style.SUCCESS('Перепродажи нет: остаток + резервы = исходный остаток'))
+
+    @staticmethod
+    def prepare(options):
+        supplier = User.objects.create_user('bench-shop@example.com', username='bench-shop', type='shop')
+        shop = Shop.objects.create(name='Bench', user=supplier)
+        category = Category.objects.create(name='Bench')
+        infos = []
+        for number in range(options['skus']):
+            product = Product.objects.create(name=f'Товар {number}', category=category)
+            infos.append(ProductInfo.objects.create(
+                model=f'bench/{number}', external_id=number, product=product, shop=shop,
+                quantity=options['stock'], price=100, price_rrc=120).id)
+
+        orders = []
+        for number in range(options['buyers']):
+            buyer = User.objects.create_user(f'bench-{number}@example.com', username=f'bench-{number}')
+            contact = Contact.objects.create(user=buyer, city='Москва', phone=str(number))
+            order = Order.objects.create(user=buyer, status='basket')
+            OrderItem.objects.bulk_create([
+                OrderItem(order=order, product_info_id=product_info_id, price=100,
+                          quantity=random.randint(1, options['max_quantity']))
+                for product_info_id in random.sample(infos, random.randint(1, len(infos)))
+            ])
+            orders.append((order.id, buyer.id, contact.id))
+        return infos, orders
@@ -0,0 +1,63 @@
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import yaml
+from django.core.management.base import BaseCommand, CommandError
+
+from shop import readers
+from shop.synthetic import iter_goods, write_price_list
+
+
+def parse(path, yaml_loader=None):
+    """
+    Разбирает файл в отдельном процессе и возвращает (товаров, секунд, прирост пиковой памяти в КБ)
+    """
+    if yaml_loader is not None:
+        readers.READERS['yaml'] = partial(readers.iter_yaml, loader_class=yaml_loader)
+
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    goods = 0
+    with open(path, 'rb') as stream:
+        for section, _ in readers.iter_price_list(stream):
+            if section == 'goods':
+                goods += 1
+    elapsed = time.perf_counter() - started
+    return goods, elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+
+
+class Command(BaseCommand):
+    help = 'Сравнивает скорость разбора прайс-листа в форматах shop.readers (товаров в секунду) ' \
+           'и прирост пиковой памяти процесса'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--goods', type=int, default=20000, help='Товаров в прайс-листе')
+        parser.add_argument('--parameters', type=int, default=5, help='Параметров у товара')
+
+    def handle(self, *args, **options):
+        cases = [('yaml, SafeLoader', 'price.yaml', yaml.SafeLoader)]
+        if readers.YAMLLoader is not yaml.SafeLoader:
+            cases.append(('yaml, CSafeLoader', 'price.yaml', None))
+        cases += [('yaml.gz', 'price.yaml.gz', None), ('json', 'price.json', None),
+                  ('jsonl', 'price.jsonl', None), ('jsonl.gz', 'price.jsonl.gz', None), ('csv', 'price.csv', None)]
+
+        with tempfile.TemporaryDirectory() as directory:
+            for _, file_name, _ in cases:
+                path = os.path.join(directory, file_name)
+                if not os.path.exists(path):
+                    write_price_list(path, iter_goods(options['goods'], options['parameters']))
+
+            for name, file_name, yaml_loader in cases:
+                path = os.path.join(directory, file_name)
+                # каждый формат в новом процессе, чтобы пиковая память не накапливалась между замерами
+                with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('fork')) as executor:
+                    goods, elapsed, memory = executor.submit(parse, path, yaml_loader).result()
+                if goods != options['goods']:
+                    raise CommandError(f'{name}: прочитано {goods} товаров из {options["goods"]}')
+                self.stdout.write(f'{name}: {os.path.getsize(path) / 2 ** 20:.1f} МБ, {elapsed:.2f} с, '
+                                  f'{goods / elapsed:.0f} товаров/с, память +{memory / 1024:.1f} МБ')
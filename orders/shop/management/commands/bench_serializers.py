@@ -0,0 +1,45 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from shop.synthetic import create_sample_order
+from shop.testing import bench_database, rendering_cases
+
+
+class Command(BaseCommand):
+    help = 'Замеряет ускорение ответов быстрого пути shop.payloads против сериализаторов DRF ' \
+           'на странице каталога и заказе в тестовой базе. Совпадение ответов проверяют тесты shop'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--items', type=int, default=40, help='Позиций на странице и в заказе')
+        parser.add_argument('--parameters', type=int, default=10, help='Параметров у позиции')
+        parser.add_argument('--repeat', type=int, default=50)
+        parser.add_argument('--min-speedup', type=float, default=5, help='Наименьшее ускорение страницы каталога')
+
+    def handle(self, *args, **options):
+        with bench_database():
+            self.run(options)
+
+    def run(self, options):
+        shop, order = create_sample_order(options['items'], options['parameters'])
+
+        slow_cases = []
+        for name, reference, fast in rendering_cases(shop, order, options['items']):
+            reference_time = self.measure(reference, options['repeat'])
+            fast_time = self.measure(fast, options['repeat'])
+            speedup = reference_time / fast_time
+            self.stdout.write(f'{name}: {len(fast())} байт, сериализаторы {reference_time * 1000:.2f} мс, '
+                              f'быстрый путь {fast_time * 1000:.2f} мс, ускорение {speedup:.1f}x')
+            # порог задан для страницы каталога, у заказов больше доля запросов к базе
+            if name == 'Страница каталога' and speedup < options['min_speedup']:
+                slow_cases.append(name)
+
+        if slow_cases:
+            raise CommandError(f'Ускорение меньше {options["min_speedup"]}x: {", ".join(slow_cases)}')
+
+    @staticmethod
+    def measure(render, repeat):
+        started = time.perf_counter()
+        for _ in range(repeat):
+            render()
+        return (time.perf_counter() - started) / repeat
@@ -0,0 +1,178 @@
+import json
+import os
+import platform
+import resource
+import tempfile
+import time
+from unittest import mock
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rest_framework.views import APIView
+
+from shop.importer import PriceListImporter
+from shop.models import ProductInfo
+from shop.readers import READERS, YAMLLoader
+from shop.synthetic import create_buyers, create_orders, create_suppliers, write_price_lists
+from shop.testing import bench_database
+
+
+def peak_memory():
+    # ru_maxrss в Linux - в килобайтах
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[round(fraction * (len(values) - 1))]
+
+
+def flatten(results, prefix=''):
+    metrics = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            metrics.update(flatten(value, f'{prefix}{key}.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            metrics[prefix + key] = value
+    return metrics
+
+
+class Command(BaseCommand):
+    help = 'Замеряет импорт прайсов (товаров в секунду, запросы, память) и задержки p50/p95 ' \
+           '/products, /basket, /order и /partner/orders на синтетических данных в тестовой базе. ' \
+           'Результаты сохраняются в JSON для сравнения версий'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--shops', type=int, default=3, help='Поставщиков')
+        parser.add_argument('--goods', type=int, default=5000, help='Товаров в прайсе поставщика')
+        parser.add_argument('--parameters', type=int, default=5, help='Параметров у товара')
+        parser.add_argument('--buyers', type=int, default=20, help='Покупателей')
+        parser.add_argument('--orders', type=int, default=5, help='Заказов у покупателя')
+        parser.add_argument('--items', type=int, default=5, help='Позиций в заказе и корзине')
+        parser.add_argument('--format', default='yaml', choices=sorted(READERS), help='Формат прайсов')
+        parser.add_argument('--requests', type=int, default=200, help='Запросов к каждому адресу')
+        parser.add_argument('--label', default='', help='Метка замера, например номер версии')
+        parser.add_argument('--output', help='Файл результатов, по умолчанию bench-<время>.json')
+        parser.add_argument('--compare', help='Файл результатов прошлого замера для сравнения')
+
+    def handle(self, *args, **options):
+        # лимиты запросов в замере не участвуют
+        with bench_database(), mock.patch.object(APIView, 'get_throttles', return_value=[]):
+            results = self.run(options)
+
+        output = options['output'] or f'bench-{timezone.now():%Y%m%d-%H%M%S}.json'
+        with open(output, 'w') as file:
+            json.dump(results, file, ensure_ascii=False, indent=2)
+        self.stdout.write(self.style.SUCCESS(f'Результаты сохранены в {output}'))
+
+        if options['compare']:
+            with open(options['compare']) as file:
+                self.compare(json.load(file), results)
+
+    def run(self, options):
+        results = {
+            'label': options['label'],
+            'created_at': timezone.now().isoformat(),
+            'environment': {
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'database': connection.vendor,
+                'yaml_loader': YAMLLoader.__name__,
+            },
+            'parameters': {name: options[name] for name in (
+                'shops', 'goods', 'parameters', 'buyers', 'orders', 'items', 'format', 'requests')},
+            'import': {},
+            'endpoints': {},
+        }
+
+        suppliers = create_suppliers(options['shops'])
+        with tempfile.TemporaryDirectory() as directory:
+            # первая загрузка, повторная без изменений и с новыми ценами у каждого десятого товара
+            for phase, revision in (('initial', 0), ('unchanged', 0), ('changed', 1)):
+                price_lists = write_price_lists(directory, suppliers, options['goods'], options['parameters'],
+                                                options['format'], revision)
+                results['import'][phase] = self.measure_import(price_lists)
+                self.report(f'Импорт, {phase}', results['import'][phase])
+
+        buyers = create_buyers(options['buyers'])
+        create_orders(buyers, options['orders'], options['items'])
+
+        # первая и вторая страница, если товаров на неё хватает
+        page_size = settings.REST_FRAMEWORK['PAGE_SIZE']
+        counts = ProductInfo.objects.values_list('shop_id', 'product__category_id').annotate(count=Count('id'))
+        endpoints = {
+            '/products': [(None, f'/api/v1/products/?shop_id={shop}&category_id={category}&page={page}')
+                          for shop, category, count in counts.order_by('shop_id', 'product__category_id')
+                          for page in range(1, min(2, -(-count // page_size)) + 1)],
+            '/basket': [(buyer, '/api/v1/basket') for buyer in buyers],
+            '/order': [(buyer, '/api/v1/order') for buyer in buyers],
+            '/partner/orders': [(supplier, '/api/v1/partner/orders') for supplier in suppliers],
+        }
+        client = APIClient()
+        for name, requests in endpoints.items():
+            results['endpoints'][name] = self.measure_requests(client, requests, options['requests'])
+            self.report(name, results['endpoints'][name])
+
+        results['peak_memory_mb'] = round(peak_memory(), 1)
+        return results
+
+    @staticmethod
+    def measure_import(price_lists):
+        memory = peak_memory()
+        rows = 0
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            for supplier, path in price_lists:
+                with open(path, 'rb') as stream:
+                    rows += PriceListImporter(supplier.id).run(stream)['parsed']
+            elapsed = time.perf_counter() - started
+        return {
+            'rows': rows,
+            'seconds': round(elapsed, 3),
+            'rows_per_second': round(rows / elapsed),
+            'queries': len(queries),
+            'file_mb': round(sum(os.path.getsize(path) for _, path in price_lists) / 2 ** 20, 2),
+            'peak_memory_growth_mb': round(peak_memory() - memory, 1),
+        }
+
+    @staticmethod
+    def measure_requests(client, requests, count):
+        timings = []
+        queries = []
+        for number in range(count):
+            user, url = requests[number % len(requests)]
+            client.force_authenticate(user)
+            with CaptureQueriesContext(connection) as captured:
+                started = time.perf_counter()
+                response = client.get(url)
+                timings.append(time.perf_counter() - started)
+            if response.status_code != 200:
+                raise CommandError(f'{url}: ответ {response.status_code} {response.content[:200]!r}')
+            queries.append(len(captured))
+        return {
+            'requests': count,
+            'p50_ms': round(percentile(timings, 0.5) * 1000, 2),
+            'p95_ms': round(percentile(timings, 0.95) * 1000, 2),
+            'queries_p50': percentile(queries, 0.5),
+            'queries_max': max(queries),
+        }
+
+    def report(self, name, metrics):
+        self.stdout.write(f'{name}: ' + ', '.join(f'{key} {value}' for key, value in metrics.items()))
+
+    def compare(self, previous, current):
+        self.stdout.write(f'Сравнение с замером {previous.get("label") or previous.get("created_at")}:')
+        old, new = flatten(previous), flatten(current)
+        for key in sorted(old.keys() & new.keys()):
+            if key.startswith('parameters.'):
+                continue
+            change = f'{(new[key] - old[key]) / old[key] * 100:+.1f}%' if old[key] else ''
+            self.stdout.write(f'  {key}: {old[key]} -> {new[key]} {change}')
+        if previous.get('parameters') != current['parameters']:
+            self.stdout.write(self.style.WARNING('Параметры замеров различаются, сравнение неточно'))
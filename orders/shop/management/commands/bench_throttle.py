@@ -0,0 +1,69 @@
+import time
+
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django_redis import get_redis_connection
+from rest_framework.test import APIRequestFactory
+from rest_framework.throttling import AnonRateThrottle
+
+from shop.throttling import RedisAnonRateThrottle
+
+RATES = {'bench': '1000000/day'}
+
+
+class DjangoThrottle(AnonRateThrottle):
+    scope = 'bench'
+    THROTTLE_RATES = RATES
+
+
+class RedisThrottle(RedisAnonRateThrottle):
+    scope = 'bench'
+    THROTTLE_RATES = RATES
+
+
+class Command(BaseCommand):
+    help = 'Сравнивает стоимость проверки лимита запросов: стандартный throttle DRF на кэше Django ' \
+           'и счётчик GCRA в Redis'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=10000)
+        parser.add_argument('--clients', type=int, default=100, help='Количество разных IP-адресов')
+
+    def handle(self, *args, **options):
+        factory = APIRequestFactory()
+        requests = [factory.get('/', REMOTE_ADDR=f'10.0.{number // 256}.{number % 256}')
+                    for number in range(options['clients'])]
+        for request in requests:
+            request.user = AnonymousUser()
+
+        for name, throttle_class in (('DRF + кэш Django', DjangoThrottle), ('Redis GCRA', RedisThrottle)):
+            keys = [throttle_class().get_cache_key(request, None) for request in requests]
+            self.clear(keys)
+            try:
+                elapsed = self.measure(throttle_class, requests, options['requests'])
+                self.stdout.write(f'{name}: {elapsed / options["requests"] * 1000000:.1f} мкс на запрос, '
+                                  f'ключ: {self.key_size(keys[0])}')
+            finally:
+                self.clear(keys)
+
+    @staticmethod
+    def measure(throttle_class, requests, count):
+        started = time.perf_counter()
+        for number in range(count):
+            throttle_class().allow_request(requests[number % len(requests)], None)
+        return time.perf_counter() - started
+
+    @staticmethod
+    def clear(keys):
+        cache.delete_many(keys)
+        get_redis_connection('default').delete(*keys)
+
+    @staticmethod
+    def key_size(key):
+        # кэш Django добавляет к ключу префикс и версию
+        connection = get_redis_connection('default')
+        for candidate in (key, cache.make_key(key)):
+            if connection.exists(candidate):
+                return f'{connection.memory_usage(candidate)} байт'
+        return 'не найден (кэш не в Redis)'
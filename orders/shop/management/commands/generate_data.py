@@ -0,0 +1,37 @@
+import tempfile
+
+from django.core.management.base import BaseCommand
+
+from shop.importer import PriceListImporter
+from shop.readers import READERS
+from shop.synthetic import create_buyers, create_orders, create_suppliers, write_price_lists
+
+
+class Command(BaseCommand):
+    help = 'Заполняет базу синтетическими данными: поставщики с прайсами, покупатели, корзины и заказы'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--shops', type=int, default=3, help='Поставщиков')
+        parser.add_argument('--goods', type=int, default=1000, help='Товаров в прайсе поставщика')
+        parser.add_argument('--parameters', type=int, default=5, help='Параметров у товара')
+        parser.add_argument('--buyers', type=int, default=10, help='Покупателей')
+        parser.add_argument('--orders', type=int, default=5, help='Заказов у покупателя')
+        parser.add_argument('--items', type=int, default=5, help='Позиций в заказе и корзине')
+        parser.add_argument('--format', default='yaml', choices=sorted(READERS), help='Формат прайсов')
+        parser.add_argument('--directory', help='Сохранить прайсы в этот каталог, по умолчанию они удаляются')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        suppliers = create_suppliers(options['shops'])
+        with tempfile.TemporaryDirectory() as directory:
+            price_lists = write_price_lists(options['directory'] or directory, suppliers, options['goods'],
+                                            options['parameters'], options['format'])
+            for supplier, path in price_lists:
+                with open(path, 'rb') as stream:
+                    stats = PriceListImporter(supplier.id).run(stream)
+                self.stdout.write(f'{supplier.email}: {path}, {stats}')
+
+        buyers = create_buyers(options['buyers'])
+        orders = create_orders(buyers, options['orders'], options['items'], options['seed'])
+        self.stdout.write(self.style.SUCCESS(f'Поставщиков: {len(suppliers)}, покупателей: {len(buyers)}, '
+                                             f'заказов: {orders}'))
@@ -0,0 +1,45 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from shop.models import ProductInfo, ProductParameter, SearchTerm
+from shop.search import item_terms
+
+
+class Command(BaseCommand):
+    help = 'Перестраивает индекс поиска по каталогу целиком'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=getattr(settings, 'IMPORT_BATCH_SIZE', 1000))
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        SearchTerm.objects.all().delete()
+
+        infos = ProductInfo.objects.order_by('id').values_list('id', 'product__name', 'model')
+        batch = []
+        total = 0
+        for row in infos.iterator(chunk_size=batch_size):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                total += self.index(batch, batch_size)
+                batch = []
+        if batch:
+            total += self.index(batch, batch_size)
+
+        self.stdout.write(self.style.SUCCESS(f'Проиндексировано позиций: {total}'))
+
+    @staticmethod
+    def index(batch, batch_size):
+        parameters = {}
+        for info_id, parameter_id, value in ProductParameter.objects.filter(
+                product_info_id__in=[row[0] for row in batch]).values_list('product_info_id', 'parameter_id', 'value'):
+            parameters.setdefault(info_id, {})[parameter_id] = value
+
+        with transaction.atomic():
+            SearchTerm.objects.bulk_create([
+                SearchTerm(product_info_id=info_id, term=term)
+                for info_id, name, model in batch
+                for term in item_terms(name, model, parameters.get(info_id, {}))
+            ], batch_size=batch_size)
+        return len(batch)
@@ -0,0 +1,62 @@
+from django.conf import settings
+from rest_framework.permissions import SAFE_METHODS
+
+from .queries import DUPLICATE_THRESHOLD, logger, query_budget, query_metrics, track_queries
+from .routers import pin_to_primary
+
+
+class ReplicaPinMiddleware:
+    """
+    После запроса на изменение закрепляет пользователя за основной базой,
+    чтобы следующие чтения с реплик не вернули ему устаревшие данные
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        # DRF записывает пользователя, определённого по токену, и в исходный запрос
+        user = getattr(request, 'user', None)
+        if request.method not in SAFE_METHODS and user is not None and user.is_authenticated:
+            pin_to_primary(user.id)
+        return response
+
+
+class QueryCountMiddleware:
+    """
+    Считает запросы к базе на каждый запрос к API. В режиме DEBUG отдаёт итоги
+    в заголовках X-DB-*, иначе копит их по представлениям для metrics/queries.
+
+    Запросы потоковых ответов (выгрузки) выполняются уже после middleware и не учитываются
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with track_queries() as stats:
+            response = self.get_response(request)
+
+        match = request.resolver_match
+        if match is None:
+            return response
+        budget = query_budget(match.func, request.method)
+        over_budget = budget is not None and stats.count > budget
+
+        if not settings.DEBUG:
+            query_metrics.record(f'{request.method} {match.view_name}', stats, over_budget)
+            return response
+
+        response['X-DB-Queries'] = stats.count
+        response['X-DB-Time-Ms'] = f'{stats.duration * 1000:.1f}'
+        response['X-DB-Duplicates'] = stats.duplicates
+        repeated = stats.repeated()
+        if repeated:
+            response['X-DB-Duplicate-Fingerprints'] = ', '.join(f'{key}*{count}' for key, count in repeated[:5])
+        if budget is not None:
+            response['X-DB-Query-Budget'] = budget
+        if over_budget or stats.repeated(DUPLICATE_THRESHOLD):
+            logger.warning('%s %s (бюджет %s): %s', request.method, request.path, budget,
+                           stats.describe(DUPLICATE_THRESHOLD))
+        return response
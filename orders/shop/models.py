@@ -1,6 +1,7 @@
 from django.db import models
 from django.conf import settings
 from django.core.files.storage import FileSystemStorage
+from django.utils import timezone
 
 from auth_api.models import User, Contact
 
@@ -16,6 +17,32 @@ STATUS_CHOICES = (
     ('canceled', 'Отменен'),
 )
 
+EMAIL_STATUS_CHOICES = (
+    ('pending', 'Ожидает отправки'),
+    ('sending', 'Отправляется'),
+    ('sent', 'Отправлено'),
+    ('failed', 'Ошибка'),
+)
+
+RESERVATION_STATUS_CHOICES = (
+    ('active', 'Активен'),
+    ('committed', 'Списан'),
+    ('released', 'Снят'),
+)
+
+CHANGE_ACTION_CHOICES = (
+    ('upsert', 'Добавлена или изменена'),
+    ('delete', 'Удалена'),
+)
+
+IMPORT_STATUS_CHOICES = (
+    ('queued', 'В очереди'),
+    ('running', 'Выполняется'),
+    ('done', 'Завершен'),
+    ('unchanged', 'Прайс не изменился'),
+    ('failed', 'Ошибка'),
+)
+
 
 class Shop(models.Model):
     name = models.CharField(max_length=50, verbose_name='Название магазина')
@@ -24,6 +51,12 @@ class Shop(models.Model):
     user = models.OneToOneField(User, verbose_name='Пользователь', blank=True, null=True,
                                 on_delete=models.CASCADE)
     state = models.BooleanField(verbose_name='Cтатус получения заказов', default=True)
+    catalog_version = models.PositiveIntegerField(verbose_name='Версия каталога', default=0)
+    price_url = models.URLField(verbose_name='Адрес прайса для обновления по расписанию', null=True, blank=True)
+    refresh_interval = models.PositiveIntegerField(verbose_name='Интервал обновления прайса, мин', null=True,
+                                                   blank=True)
+    next_refresh_at = models.DateTimeField(verbose_name='Следующее обновление прайса', null=True, blank=True,
+                                           db_index=True)
 
     class Meta:
         verbose_name = 'Магазин'
@@ -35,7 +68,7 @@ class Shop(models.Model):
 
 
 class Category(models.Model):
-    name = models.CharField(max_length=50, verbose_name='Название категории')
+    name = models.CharField(max_length=50, verbose_name='Название категории', unique=True)
     shops = models.ManyToManyField(Shop, verbose_name='Магазины', related_name='categories', blank=True)
 
     class Meta:
@@ -56,34 +89,83 @@ class Product(models.Model):
         verbose_name = 'Продукт'
         verbose_name_plural = "Продукты"
         ordering = ('-name',)
+        constraints = [
+            models.UniqueConstraint(fields=['name', 'category'], name='unique_product'),
+        ]
 
     def __str__(self):
         return f'{self.category} - {self.name}'
 
 
+class ProductInfoQuerySet(models.QuerySet):
+    def published(self):
+        """
+        Позиции из текущей версии каталога своего магазина
+        """
+        return self.filter(version__lte=models.F('shop__catalog_version'))
+
+
 class ProductInfo(models.Model):
     model = models.CharField(max_length=100, verbose_name='Модель')
+    external_id = models.PositiveIntegerField(verbose_name='Внешний ИД')
     quantity = models.PositiveIntegerField(verbose_name='Количество')
-    price = models.PositiveIntegerField(verbose_name='Цена')
+    price = models.PositiveIntegerField(verbose_name='Цена', db_index=True)
     price_rrc = models.PositiveIntegerField(verbose_name='Рекомендуемая розничная цена')
     product = models.ForeignKey(Product, verbose_name='Продукт', related_name='product_infos', blank=True,
                                 on_delete=models.CASCADE)
     shop = models.ForeignKey(Shop, verbose_name='Магазин', related_name='product_infos', blank=True,
                              on_delete=models.CASCADE)
+    version = models.PositiveIntegerField(verbose_name='Версия каталога', default=0)
+
+    objects = ProductInfoQuerySet.as_manager()
 
     class Meta:
         verbose_name = 'Информация о продукте'
         verbose_name_plural = 'Информационный список о продуктах'
         constraints = [
-            models.UniqueConstraint(fields=['product', 'shop'], name='unique_product_info'),
+            models.UniqueConstraint(fields=['shop', 'external_id'], name='unique_product_info'),
         ]
 
     def __str__(self):
         return f'{self.shop.name} - {self.product.name}'
 
 
+class CatalogChange(models.Model):
+    """
+    Лента изменений каталога для синхронизации с учётными системами покупателей.
+
+    ИД записи служит номером изменения. Данные позиции не копируются,
+    лента отдаёт её текущее состояние.
+    """
+    product_info_id = models.PositiveIntegerField(verbose_name='ИД позиции', db_index=True)
+    action = models.CharField(max_length=10, verbose_name='Действие', choices=CHANGE_ACTION_CHOICES)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'Изменение каталога'
+        verbose_name_plural = 'Лента изменений каталога'
+        ordering = ('id',)
+
+    def __str__(self):
+        return f'№ {self.id} - {self.product_info_id}. {self.action}'
+
+
+class CatalogHorizon(models.Model):
+    """
+    Номер последнего изменения, удалённого из ленты при сжатии. Таблица из одной строки
+    """
+    change_id = models.PositiveIntegerField(verbose_name='Номер изменения', default=0)
+
+    class Meta:
+        verbose_name = 'Горизонт ленты изменений'
+        verbose_name_plural = 'Горизонт ленты изменений'
+
+    def __str__(self):
+        return f'№ {self.change_id}'
+
+
 class Parameter(models.Model):
-    name = models.CharField(max_length=50, verbose_name='Название параметра')
+    name = models.CharField(max_length=50, verbose_name='Название параметра', unique=True)
 
     class Meta:
         verbose_name = 'Название параметра'
@@ -112,6 +194,28 @@ class ProductParameter(models.Model):
         return f'{self.product_info.model} - {self.parameter.name}'
 
 
+class SearchTerm(models.Model):
+    """
+    Инвертированный индекс поиска по каталогу.
+
+    Слова из названия продукта и модели хранятся как 'w:<слово>',
+    пары параметр-значение как 'p:<ИД параметра>:<значение>'.
+    """
+    term = models.CharField(max_length=150, verbose_name='Термин')
+    product_info = models.ForeignKey(ProductInfo, verbose_name='Информация о продукте', related_name='search_terms',
+                                     on_delete=models.CASCADE)
+
+    class Meta:
+        verbose_name = 'Термин поиска'
+        verbose_name_plural = 'Индекс поиска'
+        constraints = [
+            models.UniqueConstraint(fields=['term', 'product_info'], name='unique_search_term'),
+        ]
+
+    def __str__(self):
+        return f'{self.term} - {self.product_info_id}'
+
+
 class Order(models.Model):
     user = models.ForeignKey(User, verbose_name='Пользователь', related_name='orders', blank=True,
                              on_delete=models.CASCADE)
@@ -119,6 +223,8 @@ class Order(models.Model):
                                 on_delete=models.CASCADE)
     dt = models.DateTimeField(auto_now_add=True)
     status = models.CharField(max_length=15, verbose_name='Статус', choices=STATUS_CHOICES)
+    total_quantity = models.PositiveIntegerField(default=0, verbose_name='Общее количество')
+    total_sum = models.PositiveIntegerField(default=0, verbose_name='Общая стоимость')
 
     class Meta:
         verbose_name = 'Заказ'
@@ -147,9 +253,157 @@ class OrderItem(models.Model):
         ]
 
     def __str__(self):
-        return f'№ {self.order} - {self.product_info.model}. Кол-во: {self.quantity}. Сумма {self.total_amount} '
+        return f'№ {self.order} - {self.product_info.model}. Кол-во: {self.quantity}. Сумма {self.total_amount}'
 
     def save(self, *args, **kwargs):
+        if not self.price:
+            self.price = self.product_info.price
         self.total_amount = self.price * self.quantity
         super(OrderItem, self).save(*args, **kwargs)
 
+
+class StockReservation(models.Model):
+    """
+    Резерв товара под оформленный заказ. Снимается при отмене заказа или по истечении срока
+    """
+    order = models.ForeignKey(Order, verbose_name='Заказ', related_name='reservations', on_delete=models.CASCADE)
+    product_info = models.ForeignKey(ProductInfo, verbose_name='Информация о продукте', related_name='reservations',
+                                     on_delete=models.CASCADE)
+    quantity = models.PositiveIntegerField(verbose_name='Количество')
+    status = models.CharField(max_length=15, verbose_name='Статус', choices=RESERVATION_STATUS_CHOICES,
+                              default='active')
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(verbose_name='Действует до')
+
+    class Meta:
+        verbose_name = 'Резерв товара'
+        verbose_name_plural = 'Резервы товаров'
+        indexes = [
+            models.Index(fields=['status', 'expires_at'], name='reservation_expiry'),
+        ]
+
+    def __str__(self):
+        return f'№ {self.order_id} - {self.product_info_id}. Кол-во: {self.quantity}. Статус: {self.status}'
+
+
+class OrderShopTotal(models.Model):
+    """
+    Итоги заказа по позициям одного магазина, пересчитываются вместе с итогами заказа
+    """
+    order = models.ForeignKey(Order, verbose_name='Заказ', related_name='shop_totals', on_delete=models.CASCADE)
+    shop = models.ForeignKey(Shop, verbose_name='Магазин', related_name='order_totals', on_delete=models.CASCADE)
+    total_quantity = models.PositiveIntegerField(default=0, verbose_name='Количество')
+    total_sum = models.PositiveIntegerField(default=0, verbose_name='Стоимость')
+
+    class Meta:
+        verbose_name = 'Итог заказа по магазину'
+        verbose_name_plural = 'Итоги заказов по магазинам'
+        constraints = [
+            models.UniqueConstraint(fields=['order', 'shop'], name='unique_order_shop_total'),
+        ]
+
+    def __str__(self):
+        return f'№ {self.order_id} - {self.shop_id}. Сумма {self.total_sum}'
+
+
+class PriceListSource(models.Model):
+    """
+    Прайс-лист поставщика по ссылке: заголовки и хэш последней загруженной версии,
+    чтобы не скачивать и не загружать неизменившийся файл повторно
+    """
+    user = models.ForeignKey(User, verbose_name='Пользователь', related_name='price_sources',
+                             on_delete=models.CASCADE)
+    url = models.URLField(verbose_name='Адрес прайса')
+    etag = models.CharField(max_length=200, verbose_name='ETag', blank=True)
+    last_modified = models.CharField(max_length=50, verbose_name='Last-Modified', blank=True)
+    content_hash = models.CharField(max_length=64, verbose_name='SHA-256 содержимого', blank=True)
+    fetched_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = 'Источник прайса'
+        verbose_name_plural = 'Источники прайсов'
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'url'], name='unique_user_price_source'),
+        ]
+
+    def __str__(self):
+        return f'{self.user} - {self.url}'
+
+
+class ImportJob(models.Model):
+    user = models.ForeignKey(User, verbose_name='Пользователь', related_name='import_jobs', blank=True,
+                             on_delete=models.CASCADE)
+    file_name = models.FileField(verbose_name='Файл прайса', null=True, blank=True, storage=storage)
+    url = models.URLField(verbose_name='Адрес прайса', null=True, blank=True)
+    source = models.ForeignKey(PriceListSource, verbose_name='Источник прайса', related_name='jobs', null=True,
+                               blank=True, on_delete=models.SET_NULL)
+    chunked = models.BooleanField(verbose_name='Параллельная загрузка частями', default=False)
+    status = models.CharField(max_length=15, verbose_name='Статус', choices=IMPORT_STATUS_CHOICES,
+                              default='queued')
+    rows_parsed = models.PositiveIntegerField(default=0, verbose_name='Разобрано товаров')
+    rows_written = models.PositiveIntegerField(default=0, verbose_name='Записано товаров')
+    errors = models.TextField(verbose_name='Ошибки', blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = 'Загрузка прайса'
+        verbose_name_plural = 'Список загрузок прайсов'
+        ordering = ('-created_at',)
+
+    def __str__(self):
+        return f'{self.user} - {self.created_at}. Статус: {self.status}'
+
+    @property
+    def elapsed(self):
+        """
+        Время выполнения загрузки в секундах
+        """
+        if not self.started_at:
+            return None
+        return ((self.finished_at or timezone.now()) - self.started_at).total_seconds()
+
+
+class ImportStage(models.Model):
+    """
+    Изменения видимых позиций одной пачки импорта, отложенные до публикации
+    новой версии каталога. Хранятся в базе, чтобы импорт большого прайса
+    не держал их все в памяти
+    """
+    shop = models.ForeignKey(Shop, verbose_name='Магазин', related_name='import_stages', on_delete=models.CASCADE)
+    version = models.PositiveIntegerField(verbose_name='Версия каталога')
+    changes = models.TextField(verbose_name='Изменения в JSON')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'Отложенные изменения импорта'
+        verbose_name_plural = 'Отложенные изменения импортов'
+        ordering = ('id',)
+
+    def __str__(self):
+        return f'{self.shop_id} - {self.version}'
+
+
+class OutgoingEmail(models.Model):
+    """
+    Исходящее письмо. Записывается в транзакции запроса и отправляется задачей send_outbox
+    """
+    subject = models.CharField(max_length=200, verbose_name='Тема')
+    body = models.TextField(verbose_name='Текст')
+    to = models.EmailField(verbose_name='Получатель')
+    status = models.CharField(max_length=15, verbose_name='Статус', choices=EMAIL_STATUS_CHOICES, default='pending',
+                              db_index=True)
+    attempts = models.PositiveIntegerField(default=0, verbose_name='Попыток отправки')
+    last_error = models.TextField(verbose_name='Последняя ошибка', blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    claimed_at = models.DateTimeField(verbose_name='Взято на отправку', null=True, blank=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = 'Исходящее письмо'
+        verbose_name_plural = 'Очередь исходящих писем'
+        ordering = ('created_at',)
+
+    def __str__(self):
+        return f'{self.to} - {self.subject}. Статус: {self.status}'
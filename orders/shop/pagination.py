@@ -0,0 +1,64 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+from operator import attrgetter
+
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Постраничный вывод по ключу (product, id) без COUNT(*) и OFFSET.
+
+    Курсор хранит ключ последней позиции страницы, следующая страница
+    начинается строго после него.
+    """
+    page_size = api_settings.PAGE_SIZE
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = 'Неверный курсор'
+
+    def paginate_queryset(self, queryset, request, view=None, key=attrgetter('product_id', 'id')):
+        """
+        key возвращает (product_id, id) элемента выборки, для values_list() - itemgetter
+        """
+        self.request = request
+        position = self.decode_cursor(request)
+        if position:
+            product_id, pk = position
+            queryset = queryset.filter(Q(product_id__gt=product_id) | Q(product_id=product_id, id__gt=pk))
+
+        rows = list(queryset.order_by('product_id', 'id')[:self.page_size + 1])
+        self.next_cursor = None
+        if len(rows) > self.page_size:
+            self.next_cursor = self.encode_cursor(*key(rows[self.page_size - 1]))
+        return rows[:self.page_size]
+
+    def get_next_link(self):
+        if self.next_cursor is None:
+            return None
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, self.next_cursor)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data),
+        ]))
+
+    def decode_cursor(self, request):
+        cursor = request.query_params.get(self.cursor_query_param)
+        if not cursor:
+            return None
+
+        try:
+            product_id, pk = urlsafe_b64decode(cursor.encode('ascii')).decode('ascii').split(':')
+            return int(product_id), int(pk)
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+
+    @staticmethod
+    def encode_cursor(product_id, pk):
+        return urlsafe_b64encode(f'{product_id}:{pk}'.encode('ascii')).decode('ascii')
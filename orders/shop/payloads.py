@@ -0,0 +1,299 @@
+"""
+Быстрое формирование ответов каталога и заказов.
+
+Вместо вложенных сериализаторов DRF строки читаются через values_list(),
+параметры позиций загружаются одним запросом и группируются по позиции,
+ответ кодируется ujson. Результат совпадает побайтно с ответом
+ProductInfoSerializer, OrderSerializer и PartnerOrderSerializer
+(проверка и замер - manage.py bench_serializers). При изменении полей
+сериализаторов нужно менять и этот модуль.
+
+Состав ответа задаётся параметрами запроса:
+
+- fields - поля через запятую, вложенные через точку:
+  ?fields=id,model,price,quantity или ?fields=id,ordered_items.product_info.price;
+- expand - связи, которые отдаются объектами: product, product_parameters,
+  product_info, contact. Без параметра раскрыты все, с параметром остальные
+  отдаются своим ИД, а product_parameters не отдаются.
+
+Ненужные поля не читаются из базы: пропадают соединения таблиц и запрос
+параметров позиций.
+"""
+from operator import itemgetter
+
+from rest_framework.exceptions import ParseError
+from rest_framework.fields import DateTimeField
+from rest_framework.renderers import JSONRenderer
+from ujson import dumps as dump_json
+
+from .models import OrderItem, ProductParameter
+
+EXPANDABLE = ('product', 'product_parameters', 'product_info', 'contact')
+
+CONTACT_FIELDS = ('id', 'city', 'street', 'house', 'apartment', 'e_mail', 'phone', 'work_phone')
+
+_datetime_field = DateTimeField()
+
+
+def _split(value):
+    return {name.strip() for name in value.split(',') if name.strip()}
+
+
+class Fields:
+    """
+    Выбранные поля ответа на одном уровне вложенности
+    """
+
+    def __init__(self, names=None, expand=None, path='', errors=None):
+        self.names = names
+        self.expand = expand
+        self.path = path
+        self.errors = [] if errors is None else errors
+
+    @classmethod
+    def from_query(cls, query_params):
+        fields = query_params.get('fields')
+        expand = query_params.get('expand')
+        return cls(_split(fields) if fields else None, _split(expand) if expand is not None else None)
+
+    def wants(self, name):
+        return self.names is None or name in self.names or any(
+            field.startswith(name + '.') for field in self.names)
+
+    def expanded(self, name):
+        return self.expand is None or name in self.expand
+
+    def nested(self, name):
+        # поле выбрано целиком - вложенные поля все
+        if self.names is None or name in self.names:
+            names = None
+        else:
+            names = {field[len(name) + 1:] for field in self.names if field.startswith(name + '.')}
+        return Fields(names, self.expand, f'{self.path}{name}.', self.errors)
+
+    def check(self, known):
+        if self.names is not None:
+            self.errors.extend(sorted(self.path + field for field in self.names if field.split('.')[0] not in known))
+
+
+class Payload:
+    """
+    Строит словари ответа по строкам values_list().
+
+    columns - читаемые столбцы, getters - пары (поле ответа, функция от строки).
+    """
+    base_columns = ()
+
+    def __init__(self, fields=None, prefix=''):
+        self.fields = fields or Fields()
+        self.prefix = prefix
+        self.columns = [prefix + column for column in self.base_columns]
+        self.getters = []
+
+    def column(self, name):
+        if self.prefix + name not in self.columns:
+            self.columns.append(self.prefix + name)
+        return itemgetter(self.columns.index(self.prefix + name))
+
+    def add(self, name, getter):
+        self.getters.append((name, getter))
+
+    def add_column(self, name, column):
+        get = self.column(column)
+        self.add(name, lambda row, context: get(row))
+
+    def build(self, row, context):
+        return {name: getter(row, context) for name, getter in self.getters}
+
+
+class ProductInfoPayload(Payload):
+    """
+    Позиция каталога, как ProductInfoSerializer
+    """
+    # ключ страницы каталога (product_id, id) читается всегда
+    base_columns = ('id', 'product_id')
+    names = ('id', 'model', 'product', 'shop', 'quantity', 'price', 'price_rrc', 'product_parameters')
+
+    def __init__(self, fields=None, prefix=''):
+        super().__init__(fields, prefix)
+        fields = self.fields
+        fields.check(self.names)
+        self.with_parameters = False
+
+        for name, column in (('id', 'id'), ('model', 'model')):
+            if fields.wants(name):
+                self.add_column(name, column)
+
+        if fields.wants('product'):
+            if fields.expanded('product'):
+                product = fields.nested('product')
+                product.check(('name', 'category'))
+                getters = [(name, self.column(column)) for name, column in (
+                    ('name', 'product__name'), ('category', 'product__category__name')) if product.wants(name)]
+                self.add('product', lambda row, parameters: {name: get(row) for name, get in getters})
+            else:
+                self.add_column('product', 'product_id')
+
+        for name, column in (('shop', 'shop_id'), ('quantity', 'quantity'), ('price', 'price'),
+                             ('price_rrc', 'price_rrc')):
+            if fields.wants(name):
+                self.add_column(name, column)
+
+        if fields.wants('product_parameters') and fields.expanded('product_parameters'):
+            self.with_parameters = True
+            get_id = self.column('id')
+            self.add('product_parameters', lambda row, parameters: parameters.get(get_id(row), []))
+
+
+def product_info_values(queryset, payload=None):
+    """
+    Строки позиций для product_info_payloads()
+    """
+    payload = payload or ProductInfoPayload()
+    # параметры загружает product_info_payloads(), prefetch_related со строками не работает
+    return queryset.prefetch_related(None).values_list(*payload.columns)
+
+
+def parameter_map(product_info_ids):
+    parameters = {}
+    for product_info_id, name, value in ProductParameter.objects.filter(
+            product_info_id__in=product_info_ids).order_by('id').values_list(
+            'product_info_id', 'parameter__name', 'value'):
+        parameters.setdefault(product_info_id, []).append({'parameter': name, 'value': value})
+    return parameters
+
+
+def product_info_payloads(rows, payload=None):
+    """
+    То же, что ProductInfoSerializer(..., many=True).data, по строкам product_info_values()
+    """
+    payload = payload or ProductInfoPayload()
+    parameters = parameter_map([row[0] for row in rows]) if payload.with_parameters else {}
+    return [payload.build(row, parameters) for row in rows]
+
+
+class OrderItemPayload(Payload):
+    """
+    Позиция заказа, как OrderItemCreateSerializer
+    """
+    base_columns = ('order_id',)
+    names = ('id', 'product_info', 'quantity')
+
+    def __init__(self, fields=None, prefix=''):
+        super().__init__(fields, prefix)
+        fields = self.fields
+        fields.check(self.names)
+        self.product_info = None
+
+        if fields.wants('id'):
+            self.add_column('id', 'id')
+
+        if fields.wants('product_info'):
+            if fields.expanded('product_info'):
+                product_info = self.product_info = ProductInfoPayload(fields.nested('product_info'), 'product_info__')
+                start = len(self.columns)
+                self.columns.extend(product_info.columns)
+                # позиция каталога строится по своей части строки, первым в ней идёт ИД
+                get_info = itemgetter(slice(start, start + len(product_info.columns)))
+                self.info_id = itemgetter(start)
+                self.add('product_info', lambda row, parameters: product_info.build(get_info(row), parameters))
+            else:
+                self.add_column('product_info', 'product_info_id')
+
+        if fields.wants('quantity'):
+            self.add_column('quantity', 'quantity')
+
+    @property
+    def with_parameters(self):
+        return self.product_info is not None and self.product_info.with_parameters
+
+
+class OrderPayload(Payload):
+    """
+    Заказ, как OrderSerializer
+    """
+    base_columns = ('id',)
+    names = ('id', 'ordered_items', 'status', 'dt', 'total_quantity', 'total_sum', 'contact')
+
+    def __init__(self, fields=None, totals=('total_quantity', 'total_sum')):
+        super().__init__(fields)
+        fields = self.fields
+        fields.check(self.names)
+        self.items = None
+
+        if fields.wants('id'):
+            self.add_column('id', 'id')
+        if fields.wants('ordered_items'):
+            self.items = OrderItemPayload(fields.nested('ordered_items'))
+            self.add('ordered_items', lambda row, items: items.get(row[0], []))
+        if fields.wants('status'):
+            self.add_column('status', 'status')
+        if fields.wants('dt'):
+            get_dt = self.column('dt')
+            self.add('dt', lambda row, items: _datetime_field.to_representation(get_dt(row)))
+        for name, column in zip(('total_quantity', 'total_sum'), totals):
+            if fields.wants(name):
+                self.add_column(name, column)
+
+        if fields.wants('contact'):
+            if fields.expanded('contact'):
+                contact = fields.nested('contact')
+                contact.check(CONTACT_FIELDS)
+                get_contact_id = self.column('contact__id')
+                getters = [(name, self.column('contact__' + name)) for name in CONTACT_FIELDS if contact.wants(name)]
+                self.add('contact', lambda row, items: {name: get(row) for name, get in getters}
+                         if get_contact_id(row) is not None else None)
+            else:
+                self.add_column('contact', 'contact_id')
+
+
+def order_payloads(queryset, items=None, payload=None):
+    """
+    То же, что OrderSerializer(..., many=True).data.
+
+    items - выборка позиций, если показывать нужно не все (заказы поставщика).
+    """
+    payload = payload or OrderPayload()
+    orders = list(queryset.values_list(*payload.columns))
+
+    ordered_items = {}
+    if payload.items is not None:
+        if items is None:
+            items = OrderItem.objects.all()
+        rows = list(items.filter(order_id__in=[order[0] for order in orders]).order_by('id').values_list(
+            *payload.items.columns))
+        parameters = parameter_map({payload.items.info_id(row) for row in rows}) \
+            if payload.items.with_parameters else {}
+        for row in rows:
+            ordered_items.setdefault(row[0], []).append(payload.items.build(row, parameters))
+
+    return [payload.build(order, ordered_items) for order in orders]
+
+
+def read_payload(payload_class, query_params, **kwargs):
+    """
+    Payload по параметрам fields и expand запроса
+    """
+    fields = Fields.from_query(query_params)
+    payload = payload_class(fields, **kwargs)
+    fields.errors.extend(sorted((fields.expand or set()) - set(EXPANDABLE)))
+    if fields.errors:
+        raise ParseError(f'Неизвестные поля: {", ".join(fields.errors)}')
+    return payload
+
+
+class UJSONRenderer(JSONRenderer):
+    """
+    JSONRenderer на ujson с тем же результатом для строк, целых чисел, списков и словарей
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        # отступы по заголовку Accept оставляем стандартному кодировщику
+        if self.get_indent(accepted_media_type, renderer_context or {}):
+            return super().render(data, accepted_media_type, renderer_context)
+
+        ret = dump_json(data, ensure_ascii=False, escape_forward_slashes=False)
+        # как и JSONRenderer, экранируем разделители строк, недопустимые в JavaScript
+        return ret.replace('\u2028', '\\u2028').replace('\u2029', '\\u2029').encode()
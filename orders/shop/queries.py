@@ -0,0 +1,224 @@
+"""
+Учёт запросов к базе данных на запрос к API и на задачу Celery:
+количество, суммарное время и повторяющиеся запросы.
+
+Запросы перехватываются через connection.execute_wrapper(), поэтому учёт
+работает и с выключенным DEBUG. Одинаковые с точностью до параметров
+запросы имеют общий отпечаток; отпечаток, встретившийся несколько раз,
+обычно означает N+1.
+
+Представление может объявить наибольшее число запросов атрибутом
+query_budget - числом или словарём по HTTP-методам ({'get': 3, 'post': 8}),
+у ViewSet - и по действиям ({'get': 3, 'changes': 4}).
+В режиме DEBUG итоги запроса отдаются в заголовках X-DB-*, а превышение
+бюджета и повторы пишутся в журнал. Без DEBUG итоги копятся по
+представлениям и задачам в общем кэше и отдаются администраторам по адресу
+metrics/queries. Бюджеты проверяет QueryBudgetTest в тестах shop.
+
+Управление транзакциями (BEGIN, SAVEPOINT, RELEASE и т. п.) запросом к данным
+не считается: иначе каждая транзакция и точка сохранения выглядела бы
+повтором.
+"""
+import logging
+import re
+import threading
+import time
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+from hashlib import md5
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+# повтор запроса столько раз и больше считается признаком N+1
+DUPLICATE_THRESHOLD = getattr(settings, 'QUERY_DUPLICATE_THRESHOLD', 3)
+# как часто процесс прибавляет накопленные итоги к общим в кэше, в секундах
+FLUSH_INTERVAL = getattr(settings, 'QUERY_METRICS_FLUSH_INTERVAL', 10)
+METRICS_TIMEOUT = getattr(settings, 'QUERY_METRICS_TIMEOUT', 7 * 24 * 60 * 60)
+
+METRICS_KEY = 'metrics:queries'
+METRICS_FIELDS = ('calls', 'queries', 'duplicates', 'db_time_us', 'over_budget')
+
+# списки параметров разной длины не должны давать разные отпечатки
+_in_list = re.compile(r'IN \((?:%s, )*%s\)')
+_transaction_control = re.compile(
+    r'\s*(?:BEGIN|COMMIT|ROLLBACK|SAVEPOINT|RELEASE|START\s+TRANSACTION|SET\s+TRANSACTION|END)\b', re.IGNORECASE)
+
+
+def fingerprint(sql):
+    return md5(_in_list.sub('IN (...)', sql).encode()).hexdigest()[:12]
+
+
+class QueryStats:
+    """
+    Итоги запросов к базе, обёртка для connection.execute_wrapper()
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.fingerprints = Counter()
+        # первый текст запроса с каждым отпечатком, для сообщений
+        self.samples = {}
+
+    def __call__(self, execute, sql, params, many, context):
+        if _transaction_control.match(sql):
+            return execute(sql, params, many, context)
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - started
+            self.count += 1
+            key = fingerprint(sql)
+            self.fingerprints[key] += 1
+            self.samples.setdefault(key, sql)
+
+    @property
+    def duplicates(self):
+        """
+        Сколько запросов повторили уже выполненные
+        """
+        return sum(count - 1 for count in self.fingerprints.values())
+
+    def repeated(self, threshold=2):
+        """
+        Пары (отпечаток, количество) запросов, выполненных не меньше threshold раз, от частых к редким
+        """
+        return [(key, count) for key, count in self.fingerprints.most_common() if count >= threshold]
+
+    def describe(self, threshold=2):
+        lines = [f'{self.count} запросов, {self.duration * 1000:.1f} мс']
+        lines += [f'{count} x {self.samples[key]}' for key, count in self.repeated(threshold)]
+        return '\n'.join(lines)
+
+
+@contextmanager
+def track_queries():
+    """
+    Считает запросы ко всем базам внутри блока текущего потока
+    """
+    stats = QueryStats()
+    with ExitStack() as stack:
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(stats))
+        yield stats
+
+
+def metrics_key(name, field):
+    # пробелы в ключах кэша не переносимы между бэкендами
+    return f'{METRICS_KEY}:{name.replace(" ", "_")}:{field}'
+
+
+def query_budget(view, method):
+    """
+    Бюджет представления view (функции из URLconf) для HTTP-метода method.
+    Бюджет действия ViewSet важнее бюджета метода
+    """
+    budget = getattr(getattr(view, 'cls', None), 'query_budget', None)
+    if isinstance(budget, dict):
+        action = getattr(view, 'actions', {}).get(method.lower())
+        return budget.get(action, budget.get(method.lower()))
+    return budget
+
+
+class QueryMetrics:
+    """
+    Итоги по представлениям и задачам. Копятся в памяти процесса и раз в
+    QUERY_METRICS_FLUSH_INTERVAL секунд прибавляются к общим в кэше
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.flushed_at = time.monotonic()
+
+    def record(self, name, stats, over_budget=False):
+        with self.lock:
+            totals = self.pending.setdefault(name, dict.fromkeys(METRICS_FIELDS, 0))
+            totals['calls'] += 1
+            totals['queries'] += stats.count
+            totals['duplicates'] += stats.duplicates
+            totals['db_time_us'] += int(stats.duration * 1000000)
+            totals['over_budget'] += int(over_budget)
+            due = time.monotonic() - self.flushed_at >= FLUSH_INTERVAL
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.flushed_at = time.monotonic()
+        if not pending:
+            return
+
+        names = cache.get(METRICS_KEY) or set()
+        if not names.issuperset(pending):
+            cache.set(METRICS_KEY, names | set(pending), METRICS_TIMEOUT)
+        for name, totals in pending.items():
+            for field, value in totals.items():
+                key = metrics_key(name, field)
+                if value and not cache.add(key, value, METRICS_TIMEOUT):
+                    try:
+                        cache.incr(key, value)
+                    except ValueError:
+                        cache.set(key, value, METRICS_TIMEOUT)
+
+    def read(self):
+        self.flush()
+        names = sorted(cache.get(METRICS_KEY) or ())
+        values = cache.get_many([metrics_key(name, field) for name in names for field in METRICS_FIELDS])
+
+        metrics = {}
+        for name in names:
+            totals = {field: values.get(metrics_key(name, field), 0) for field in METRICS_FIELDS}
+            calls = totals['calls'] or 1
+            metrics[name] = {
+                'calls': totals['calls'],
+                'queries': totals['queries'],
+                'queries_per_call': round(totals['queries'] / calls, 2),
+                'duplicates_per_call': round(totals['duplicates'] / calls, 2),
+                'db_time_ms': round(totals['db_time_us'] / 1000, 1),
+                'db_time_ms_per_call': round(totals['db_time_us'] / 1000 / calls, 2),
+                'over_budget': totals['over_budget'],
+            }
+        return metrics
+
+
+query_metrics = QueryMetrics()
+
+# task_id -> (ExitStack с обёртками соединений, итоги)
+_task_stats = {}
+
+
+def task_started(task_id=None, **kwargs):
+    """
+    Обработчик сигнала Celery task_prerun
+    """
+    stack = ExitStack()
+    _task_stats[task_id] = (stack, stack.enter_context(track_queries()))
+
+
+def task_finished(task_id=None, task=None, **kwargs):
+    """
+    Обработчик сигнала Celery task_postrun
+    """
+    tracked = _task_stats.pop(task_id, None)
+    if tracked is None:
+        return
+    stack, stats = tracked
+    stack.close()
+
+    query_metrics.record(f'task {task.name}', stats)
+    if stats.repeated(DUPLICATE_THRESHOLD):
+        logger.warning('Повторяющиеся запросы в задаче %s: %s', task.name, stats.describe(DUPLICATE_THRESHOLD))
+
+
+def worker_stopped(**kwargs):
+    """
+    Обработчик сигнала Celery worker_process_shutdown: итоги процесса не должны пропасть
+    """
+    query_metrics.flush()
@@ -0,0 +1,416 @@
+"""
+Чтение прайс-листов поставщиков в разных форматах.
+
+Все форматы описывают одно и то же: название магазина (shop), категории
+(categories: id, name) и товары (goods: id, category, model, name, price,
+price_rrc, quantity, parameters). Читатель отдаёт их парами (раздел, значение)
+по одному элементу, не загружая файл в память целиком:
+
+- yaml - документ прайса, разбирается по событиям через libyaml (CSafeLoader),
+  если PyYAML собран с ней;
+- json - тот же документ в JSON;
+- jsonl - по строке на запись, каждая запись - словарь из одного раздела:
+  {"shop": "Связной"}, {"categories": {"id": 224, "name": "Смартфоны"}},
+  {"goods": {...}};
+- csv - по строке на товар со столбцами shop, category, id, model, name,
+  price, price_rrc, quantity. Категория указывается названием, остальные
+  столбцы - параметры товара, пустые значения пропускаются.
+
+Сжатые gzip файлы распаковываются на лету. Формат определяется по
+расширению имени файла, а без него - по началу содержимого.
+"""
+import codecs
+import csv
+import gzip
+import io
+import os
+import re
+from functools import partial
+from json import JSONDecodeError, JSONDecoder
+
+import yaml
+from django.conf import settings
+from ujson import loads as load_json
+
+READ_CHUNK_SIZE = getattr(settings, 'PRICE_READ_CHUNK_SIZE', 64 * 1024)
+
+# без libyaml PyYAML разбирает прайс в несколько раз медленнее
+YAMLLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+SECTIONS = {
+    'categories': 'category',
+    'goods': 'goods',
+}
+
+EXTENSIONS = {
+    'yaml': 'yaml',
+    'yml': 'yaml',
+    'json': 'json',
+    'jsonl': 'jsonl',
+    'ndjson': 'jsonl',
+    'csv': 'csv',
+}
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+CSV_FIELDS = ('shop', 'category', 'id', 'model', 'name', 'price', 'price_rrc', 'quantity')
+CSV_INTEGER_FIELDS = ('id', 'price', 'price_rrc', 'quantity')
+CSV_DELIMITERS = (',', ';', '\t')
+
+# обязательные поля элементов разделов
+REQUIRED_FIELDS = {
+    'category': ('id', 'name'),
+    'goods': ('id', 'category', 'model', 'name', 'price', 'price_rrc', 'quantity'),
+}
+
+# сколько символов в конце буфера может занимать оборванное значение JSON: литерал -Infinity,
+# суррогатная пара \uXXXX\uXXXX
+JSON_TAIL = 16
+
+
+class PriceListError(ValueError):
+    """
+    Прайс-лист не соответствует формату shop/categories/goods
+    """
+
+
+def _register_anchor(anchors, event, node):
+    """
+    Запоминает узел с якорем для ссылок на него дальше в документе, как yaml.composer.Composer
+    """
+    if event.anchor is None:
+        return
+    if event.anchor in anchors:
+        raise yaml.composer.ComposerError(f'found duplicate anchor {event.anchor!r}; first occurrence',
+                                          anchors[event.anchor].start_mark, 'second occurrence', event.start_mark)
+    anchors[event.anchor] = node
+
+
+def _compose_node(loader, anchors):
+    """
+    Собирает один узел yaml из потока событий загрузчика.
+    anchors - узлы с якорями документа, на которые ссылаются псевдонимы (*anchor)
+    """
+    event = loader.get_event()
+
+    if isinstance(event, yaml.AliasEvent):
+        if event.anchor not in anchors:
+            raise yaml.composer.ComposerError(None, None, f'found undefined alias {event.anchor!r}',
+                                              event.start_mark)
+        return anchors[event.anchor]
+
+    if isinstance(event, yaml.ScalarEvent):
+        tag = event.tag
+        if tag is None or tag == '!':
+            tag = loader.resolve(yaml.ScalarNode, event.value, event.implicit)
+        node = yaml.ScalarNode(tag, event.value, event.start_mark, event.end_mark, style=event.style)
+        _register_anchor(anchors, event, node)
+        return node
+
+    if isinstance(event, yaml.SequenceStartEvent):
+        tag = event.tag
+        if tag is None or tag == '!':
+            tag = loader.resolve(yaml.SequenceNode, None, event.implicit)
+        node = yaml.SequenceNode(tag, [], event.start_mark, None, flow_style=event.flow_style)
+        # якорь регистрируется до дочерних узлов: они могут ссылаться на родителя
+        _register_anchor(anchors, event, node)
+        while not loader.check_event(yaml.SequenceEndEvent):
+            node.value.append(_compose_node(loader, anchors))
+        node.end_mark = loader.get_event().end_mark
+        return node
+
+    if isinstance(event, yaml.MappingStartEvent):
+        tag = event.tag
+        if tag is None or tag == '!':
+            tag = loader.resolve(yaml.MappingNode, None, event.implicit)
+        node = yaml.MappingNode(tag, [], event.start_mark, None, flow_style=event.flow_style)
+        _register_anchor(anchors, event, node)
+        while not loader.check_event(yaml.MappingEndEvent):
+            key = _compose_node(loader, anchors)
+            node.value.append((key, _compose_node(loader, anchors)))
+        node.end_mark = loader.get_event().end_mark
+        return node
+
+    raise PriceListError(f'Неподдерживаемый элемент прайс-листа: {event}')
+
+
+def _load_node(loader, anchors):
+    return loader.construct_document(_compose_node(loader, anchors))
+
+
+def iter_yaml(stream, loader_class=YAMLLoader):
+    loader = loader_class(stream)
+    try:
+        loader.get_event()
+        if not loader.check_event(yaml.DocumentStartEvent):
+            raise PriceListError('Пустой прайс-лист')
+        loader.get_event()
+        if not loader.check_event(yaml.MappingStartEvent):
+            raise PriceListError('Прайс-лист должен быть словарём')
+        loader.get_event()
+
+        anchors = {}
+        while not loader.check_event(yaml.MappingEndEvent):
+            key = _load_node(loader, anchors)
+            section = SECTIONS.get(key)
+            if section and loader.check_event(yaml.SequenceStartEvent):
+                start = loader.get_event()
+                # на раздел с якорем ссылаются дальше, его узлы приходится сохранить
+                node = None
+                if start.anchor is not None:
+                    tag = start.tag
+                    if tag is None or tag == '!':
+                        tag = loader.resolve(yaml.SequenceNode, None, start.implicit)
+                    node = yaml.SequenceNode(tag, [], start.start_mark, None, flow_style=start.flow_style)
+                    _register_anchor(anchors, start, node)
+                while not loader.check_event(yaml.SequenceEndEvent):
+                    element = _compose_node(loader, anchors)
+                    if node is not None:
+                        node.value.append(element)
+                    yield section, loader.construct_document(element)
+                loader.get_event()
+                continue
+
+            value = _load_node(loader, anchors)
+            # раздел задан ссылкой на список из другого места документа
+            if section and isinstance(value, list):
+                for element in value:
+                    yield section, element
+            else:
+                yield key, value
+    except yaml.YAMLError as error:
+        raise PriceListError(f'Ошибка YAML: {error}')
+    finally:
+        loader.dispose()
+
+
+_json_decoder = JSONDecoder()
+_whitespace = re.compile(r'\s*')
+
+
+class JSONScanner:
+    """
+    Разбирает JSON по частям: значения декодируются по одному из буфера,
+    который дочитывается из потока по мере надобности
+    """
+
+    def __init__(self, stream):
+        self.chunks = iter(partial(stream.read, READ_CHUNK_SIZE), b'')
+        self.decoder = codecs.getincrementaldecoder('utf-8-sig')()
+        self.buffer = ''
+        self.position = 0
+        self.eof = False
+
+    def fill(self):
+        """
+        Дочитывает следующую часть потока, в конце файла возвращает False
+        """
+        if self.eof:
+            return False
+        chunk = next(self.chunks, None)
+        self.eof = chunk is None
+        text = self.decoder.decode(chunk or b'', final=self.eof)
+        # разобранное начало буфера больше не нужно
+        self.buffer = self.buffer[self.position:] + text
+        self.position = 0
+        return True
+
+    def peek(self):
+        """
+        Следующий значащий символ или пустая строка в конце файла
+        """
+        while True:
+            self.position = _whitespace.match(self.buffer, self.position).end()
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self.fill():
+                return ''
+
+    def expect(self, chars):
+        char = self.peek()
+        if not char or char not in chars:
+            raise PriceListError(f'Ошибка JSON: ожидался один из символов {chars!r}, получено {char!r}')
+        self.position += 1
+        return char
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = _json_decoder.raw_decode(self.buffer, self.position)
+            except JSONDecodeError as error:
+                # значение не поместилось в прочитанную часть: оборвалось на строке или в конце буфера.
+                # Ошибку в середине буфера дочитывание не исправит, файл дальше не читаем
+                truncated = error.msg.startswith('Unterminated string') or error.pos >= len(self.buffer) - JSON_TAIL
+                if truncated and self.fill():
+                    continue
+                # позиция ошибки считается от начала буфера и для файла не имеет смысла
+                raise PriceListError(f'Ошибка JSON: {error.msg}')
+            # число на границе части могло оборваться
+            if end == len(self.buffer) and self.fill():
+                continue
+            self.position = end
+            return value
+
+
+def iter_json(stream):
+    scanner = JSONScanner(stream)
+    scanner.expect('{')
+    if scanner.peek() == '}':
+        return
+
+    while True:
+        key = scanner.value()
+        scanner.expect(':')
+        section = SECTIONS.get(key)
+        if section and scanner.peek() == '[':
+            scanner.expect('[')
+            if scanner.peek() == ']':
+                scanner.expect(']')
+            else:
+                while True:
+                    yield section, scanner.value()
+                    if scanner.expect(',]') == ']':
+                        break
+        else:
+            yield key, scanner.value()
+        if scanner.expect(',}') == '}':
+            break
+
+    if scanner.peek():
+        raise PriceListError('Ошибка JSON: лишние данные после прайс-листа')
+
+
+def iter_jsonl(stream):
+    for number, line in enumerate(io.TextIOWrapper(stream, encoding='utf-8-sig'), 1):
+        if not line.strip():
+            continue
+        try:
+            record = load_json(line)
+        except ValueError as error:
+            raise PriceListError(f'Строка {number}: {error}')
+        if not isinstance(record, dict) or len(record) != 1:
+            raise PriceListError(f'Строка {number}: запись должна быть словарём из одного раздела')
+        (key, value), = record.items()
+        yield SECTIONS.get(key, key), value
+
+
+def iter_csv(stream):
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    header = text.readline()
+    delimiter = max(CSV_DELIMITERS, key=header.count)
+    reader = csv.DictReader(text, fieldnames=next(csv.reader([header], delimiter=delimiter)), delimiter=delimiter)
+
+    missing = [field for field in CSV_FIELDS if field not in reader.fieldnames]
+    if missing:
+        raise PriceListError(f'В прайс-листе нет столбцов: {", ".join(missing)}')
+    parameters = [name for name in reader.fieldnames if name not in CSV_FIELDS]
+
+    shop = None
+    categories = set()
+    for row in reader:
+        if shop is None:
+            shop = row['shop']
+            yield 'shop', shop
+        category = row['category']
+        if category not in categories:
+            categories.add(category)
+            yield 'category', {'id': category, 'name': category}
+
+        item = {'category': category, 'model': row['model'], 'name': row['name']}
+        try:
+            item.update({field: int(row[field]) for field in CSV_INTEGER_FIELDS})
+        except (TypeError, ValueError) as error:
+            raise PriceListError(f'Строка {reader.line_num}: {error}')
+        item['parameters'] = {name: row[name] for name in parameters if row[name]}
+        yield 'goods', item
+
+
+def check_fields(records):
+    """
+    Проверяет, что у категорий и товаров есть обязательные поля, а параметры товара - словарь
+    """
+    for section, value in records:
+        fields = REQUIRED_FIELDS.get(section)
+        if fields:
+            if not isinstance(value, dict):
+                raise PriceListError(f'Элемент раздела {section} должен быть словарём: {value!r}')
+            missing = [field for field in fields if field not in value]
+            if missing:
+                raise PriceListError(f'Нет полей {", ".join(missing)} у элемента раздела {section}: '
+                                     f'{value.get("id", value.get("name", ""))}')
+            if not isinstance(value.get('parameters', {}), dict):
+                raise PriceListError(f'Параметры товара {value["id"]} должны быть словарём')
+        yield section, value
+
+
+READERS = {
+    'yaml': iter_yaml,
+    'json': iter_json,
+    'jsonl': iter_jsonl,
+    'csv': iter_csv,
+}
+
+
+class _RawStream(io.RawIOBase):
+    """
+    Поток с методом read() (файл хранилища, ответ сервера) как сырой поток io
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.stream.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def detect_format(head, name=''):
+    """
+    Формат прайса по расширению имени файла, а без него - по началу содержимого
+    """
+    extension = os.path.splitext(name.lower())[1].lstrip('.')
+    if extension in EXTENSIONS:
+        return EXTENSIONS[extension]
+
+    head = head.lstrip(codecs.BOM_UTF8).lstrip()
+    first_line = head.split(b'\n', 1)[0]
+    if head.startswith(b'{'):
+        # в JSON Lines первая строка - законченная запись из одного раздела
+        try:
+            record = load_json(first_line)
+        except ValueError:
+            return 'json'
+        return 'jsonl' if isinstance(record, dict) and len(record) == 1 else 'json'
+    if not first_line.startswith((b'#', b'%', b'---')) and b':' not in first_line and \
+            any(delimiter.encode() in first_line for delimiter in CSV_DELIMITERS):
+        return 'csv'
+    return 'yaml'
+
+
+def iter_price_list(stream, name=None, price_format=None):
+    """
+    Разбирает прайс-лист, не загружая его целиком в память.
+
+    Отдаёт пары (раздел, значение): ('shop', название магазина),
+    а затем по одному элементу ('category', {...}) и ('goods', {...}).
+    Формат, если не указан в price_format, определяется по имени файла и содержимому.
+    """
+    if name is None:
+        name = getattr(stream, 'name', None) or ''
+    name = os.path.basename(name)
+
+    stream = io.BufferedReader(_RawStream(stream), READ_CHUNK_SIZE)
+    if stream.peek(len(GZIP_MAGIC)).startswith(GZIP_MAGIC):
+        stream = io.BufferedReader(gzip.GzipFile(fileobj=stream), READ_CHUNK_SIZE)
+        if name.lower().endswith('.gz'):
+            name = name[:-3]
+
+    price_format = price_format or detect_format(stream.peek(READ_CHUNK_SIZE), name)
+    if price_format not in READERS:
+        raise PriceListError(f'Неизвестный формат прайс-листа: {price_format}')
+    return check_fields(READERS[price_format](stream))
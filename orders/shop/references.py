@@ -0,0 +1,76 @@
+"""
+Небольшие справочники (категории, магазины, параметры) в памяти процесса.
+
+Версией справочника служит отметка ресурса в общем кэше (shop.cache.stamp),
+её меняет любое изменение справочника. При каждом обращении процесс читает
+только отметку и перечитывает таблицу, когда она изменилась.
+"""
+from django.db import DEFAULT_DB_ALIAS
+
+from .cache import stamp
+from .models import Category, Parameter, ProductInfo, Shop
+
+
+class ReferenceCache:
+    """
+    Строки справочника (словари values()) в порядке модели по умолчанию.
+    Возвращаемый список общий для всех запросов процесса и не должен изменяться
+    """
+
+    def __init__(self, model, resource, fields):
+        self.model = model
+        self.resource = resource
+        self.fields = fields
+        # (версия, строки, производные значения) заменяются целиком одним присваиванием
+        self._state = (None, [], {})
+
+    def _current(self):
+        version = stamp(self.resource)
+        state = self._state
+        if version != state[0]:
+            # отметка прочитана до таблицы: если справочник изменится между ними,
+            # при следующем обращении версия снова не совпадёт и таблица перечитается
+            # реплика может отставать, а прочитанное хранится до следующего изменения
+            rows = list(self.model.objects.db_manager(DEFAULT_DB_ALIAS).values(*self.fields))
+            state = self._state = (version, rows, {})
+        return state
+
+    def rows(self):
+        return self._current()[1]
+
+    def derived(self, name, build):
+        """
+        Значение, вычисляемое по строкам справочника один раз на версию
+        """
+        _, rows, derived = self._current()
+        if name not in derived:
+            derived[name] = build(rows)
+        return derived[name]
+
+
+category_cache = ReferenceCache(Category, 'categories', ('id', 'name'))
+shop_cache = ReferenceCache(Shop, 'shops', ('id', 'name', 'state'))
+parameter_cache = ReferenceCache(Parameter, 'parameters', ('id', 'name'))
+
+
+def published_infos():
+    """
+    Позиции из опубликованных каталогов магазинов, принимающих заказы.
+
+    Версия каталога и статус магазина берутся соединением с Shop в том же запросе,
+    то есть из той же базы, что и позиции: иначе с отстающей реплики были бы видны
+    строки новой версии вместе со старыми, ещё не удалёнными
+    """
+    return ProductInfo.objects.published().filter(shop__state=True)
+
+
+def parameter_names():
+    return parameter_cache.derived('names', lambda rows: {row['id']: row['name'] for row in rows})
+
+
+def shop_rows():
+    """
+    Магазины в виде ShopSerializer
+    """
+    return shop_cache.derived('rows', lambda rows: [{'id': row['id'], 'name': row['name'], 'state': row['state']}
+                                                    for row in rows])
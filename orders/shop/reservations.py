@@ -0,0 +1,95 @@
+"""
+Резервирование товара при оформлении заказа.
+
+Остаток списывается условным UPDATE ... WHERE quantity >= n по позициям
+в порядке ИД, все позиции корзины - в одной транзакции. Если хотя бы одной
+позиции не хватает, транзакция откатывается целиком и перепродажи нет.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .changes import record_changes
+from .models import Order, OrderItem, ProductInfo, StockReservation
+
+RESERVATION_TTL = getattr(settings, 'STOCK_RESERVATION_TTL', 24 * 60 * 60)
+
+
+class OutOfStock(Exception):
+    """
+    Товара не хватает для оформления заказа
+    """
+
+    def __init__(self, product_infos):
+        super().__init__(f'Недостаточно товара: {product_infos}')
+        self.product_infos = product_infos
+
+
+def reserve_order(order_id, user_id, contact_id):
+    """
+    Оформляет корзину в заказ и резервирует товар по всем её позициям.
+
+    Возвращает False, если корзина не найдена или уже оформлена,
+    и поднимает OutOfStock, если какого-то товара не хватает.
+    """
+    expires_at = timezone.now() + timedelta(seconds=RESERVATION_TTL)
+    with transaction.atomic():
+        # смена статуса блокирует заказ: параллельное оформление той же корзины не пройдёт
+        if not Order.objects.filter(id=order_id, user_id=user_id, status='basket').update(
+                status='new', contact_id=contact_id):
+            return False
+
+        items = OrderItem.objects.filter(order_id=order_id).order_by('product_info_id').values_list(
+            'product_info_id', 'quantity')
+        missing = []
+        reservations = []
+        for product_info_id, quantity in items:
+            # строки блокируются в одном порядке у всех покупателей, взаимных блокировок нет
+            if ProductInfo.objects.filter(id=product_info_id, quantity__gte=quantity).update(
+                    quantity=F('quantity') - quantity):
+                reservations.append(StockReservation(order_id=order_id, product_info_id=product_info_id,
+                                                     quantity=quantity, expires_at=expires_at))
+            else:
+                missing.append(product_info_id)
+
+        if missing:
+            raise OutOfStock(missing)
+        StockReservation.objects.bulk_create(reservations)
+        record_changes(upserted=[reservation.product_info_id for reservation in reservations])
+    return True
+
+
+def release_reservations(order_id):
+    """
+    Возвращает на остаток товар активных резервов заказа
+    """
+    with transaction.atomic():
+        reservations = list(StockReservation.objects.select_for_update().filter(
+            order_id=order_id, status='active').order_by('product_info_id').values_list(
+            'id', 'product_info_id', 'quantity'))
+        for _, product_info_id, quantity in reservations:
+            ProductInfo.objects.filter(id=product_info_id).update(quantity=F('quantity') + quantity)
+        StockReservation.objects.filter(id__in=[row[0] for row in reservations]).update(status='released')
+        record_changes(upserted=[row[1] for row in reservations])
+    return len(reservations)
+
+
+def commit_reservations(order_id):
+    """
+    Заказ подтверждён: резерв больше не истекает, товар списан окончательно
+    """
+    return StockReservation.objects.filter(order_id=order_id, status='active').update(status='committed')
+
+
+def reserved_quantities(product_info_ids):
+    """
+    Количество товара в активных резервах по позициям
+    """
+    reserved = {}
+    for product_info_id, quantity in StockReservation.objects.filter(
+            product_info_id__in=product_info_ids, status='active').values_list('product_info_id', 'quantity'):
+        reserved[product_info_id] = reserved.get(product_info_id, 0) + quantity
+    return reserved
@@ -0,0 +1,73 @@
+"""
+Сопоставление названий из прайс-листов с записями справочников
+"""
+from collections import OrderedDict
+from threading import Lock
+
+from django.conf import settings
+from django.db.models.signals import post_delete
+
+from .models import Category, Parameter
+
+CACHE_SIZE = getattr(settings, 'NAME_RESOLVER_CACHE_SIZE', 10000)
+
+
+class NameResolver:
+    """
+    Возвращает ИД записей справочника по их названиям.
+
+    Недостающие названия ищутся одним запросом, ненайденные создаются одним
+    bulk_create. Название уникально, поэтому записи, которые параллельный импорт
+    успел создать раньше, пропускаются, а ИД всех созданных перечитываются.
+    Найденные ИД хранятся в LRU-кэше процесса и переиспользуются между импортами.
+    """
+
+    def __init__(self, model, maxsize=CACHE_SIZE):
+        self.model = model
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+        self._lock = Lock()
+        post_delete.connect(self._on_delete, sender=model, weak=False)
+
+    def resolve(self, names):
+        names = set(names)
+        result = {}
+        with self._lock:
+            for name in names:
+                if name in self._cache:
+                    self._cache.move_to_end(name)
+                    result[name] = self._cache[name]
+
+        missing = names - result.keys()
+        if missing:
+            found = self._fetch(missing)
+            absent = missing - found.keys()
+            if absent:
+                self.model.objects.bulk_create([self.model(name=name) for name in absent], ignore_conflicts=True)
+                found.update(self._fetch(absent))
+            result.update(found)
+            self._remember(found)
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def _fetch(self, names):
+        return dict(self.model.objects.filter(name__in=names).values_list('name', 'id'))
+
+    def _remember(self, found):
+        with self._lock:
+            self._cache.update(found)
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+
+    def _on_delete(self, sender, instance, **kwargs):
+        # удалённая запись не должна оставаться в кэше этого процесса
+        with self._lock:
+            if self._cache.get(instance.name) == instance.pk:
+                del self._cache[instance.name]
+
+
+parameter_resolver = NameResolver(Parameter)
+category_resolver = NameResolver(Category)
@@ -0,0 +1,132 @@
+"""
+Чтение с реплик базы данных.
+
+Запись и всё, что не помечено явно, идёт в основную базу. Чтение уходит на
+реплику только внутри replica_reads(): в представлениях каталога и отчётов
+(ReplicaReadMixin), при выгрузке заказов и в отчётной задаче send_sales_reports.
+Реплика с отставанием больше REPLICA_MAX_LAG секунд или недоступная исключается
+до следующей проверки, без живых реплик читаем из основной базы.
+
+После записи пользователь на REPLICA_PIN_TIMEOUT секунд закрепляется за
+основной базой, чтобы сразу видеть свои изменения.
+"""
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+from rest_framework.permissions import SAFE_METHODS
+
+REPLICAS = getattr(settings, 'DATABASE_REPLICAS', [])
+MAX_LAG = getattr(settings, 'REPLICA_MAX_LAG', 5)
+HEALTH_INTERVAL = getattr(settings, 'REPLICA_HEALTH_INTERVAL', 10)
+PIN_TIMEOUT = getattr(settings, 'REPLICA_PIN_TIMEOUT', 10)
+
+# отставание реплики PostgreSQL; если всё полученное уже применено, отставания нет
+POSTGRESQL_LAG = """
+    SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END
+"""
+
+_replica_reads = ContextVar('replica_reads', default=False)
+
+# alias -> (время следующей проверки, реплика исправна)
+_health = {}
+
+
+@contextmanager
+def replica_reads():
+    """
+    Разрешает читать с реплик внутри блока
+    """
+    token = _replica_reads.set(True)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+def replica_lag(alias):
+    with connections[alias].cursor() as cursor:
+        if connections[alias].vendor == 'postgresql':
+            cursor.execute(POSTGRESQL_LAG)
+            return float(cursor.fetchone()[0])
+        cursor.execute('SELECT 1')
+        return 0
+
+
+def is_healthy(alias):
+    now = time.monotonic()
+    checked = _health.get(alias)
+    if checked is not None and checked[0] > now:
+        return checked[1]
+
+    try:
+        healthy = replica_lag(alias) <= MAX_LAG
+    except DatabaseError:
+        healthy = False
+    _health[alias] = (now + HEALTH_INTERVAL, healthy)
+    return healthy
+
+
+def choose_replica():
+    healthy = [alias for alias in REPLICAS if is_healthy(alias)]
+    return random.choice(healthy) if healthy else DEFAULT_DB_ALIAS
+
+
+def pin_key(user_id):
+    return f'db:pin:{user_id}'
+
+
+def pin_to_primary(user_id):
+    cache.set(pin_key(user_id), 1, PIN_TIMEOUT)
+
+
+def is_pinned(user):
+    return user.is_authenticated and cache.get(pin_key(user.id)) is not None
+
+
+class ReplicaRouter:
+    """
+    Роутер DATABASE_ROUTERS
+    """
+
+    def db_for_read(self, model, **hints):
+        if not REPLICAS or not _replica_reads.get():
+            return None
+        # внутри транзакции основной базы читаем её же, иначе не увидим своих незафиксированных изменений
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return choose_replica()
+
+    def db_for_write(self, model, **hints):
+        # объект, прочитанный с реплики, сохраняется всё равно в основную базу
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *REPLICAS}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+
+class ReplicaReadMixin:
+    """
+    Представление читает с реплик, если запрос только на чтение и пользователь
+    недавно ничего не менял
+    """
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if request.method in SAFE_METHODS and not is_pinned(request.user):
+            self._replica_token = _replica_reads.set(True)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        token = getattr(self, '_replica_token', None)
+        if token is not None:
+            _replica_reads.reset(token)
+            self._replica_token = None
+        return super().finalize_response(request, response, *args, **kwargs)
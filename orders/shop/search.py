@@ -0,0 +1,109 @@
+"""
+Поиск по каталогу: текстовый запрос, фасеты по параметрам и диапазон цен.
+
+Запросы идут только по индексу SearchTerm, таблица ProductParameter при
+поиске не читается. Индекс обновляется импортом прайсов вместе с позициями,
+а после правки позиции в админке пересобирается функцией reindex.
+"""
+import re
+from collections import OrderedDict
+
+from django.db import transaction
+from django.db.models import Count, Max, Min
+
+from .models import ProductInfo, ProductParameter, SearchTerm
+from .references import parameter_names
+
+WORD = re.compile(r'\w+')
+TERM_LENGTH = SearchTerm._meta.get_field('term').max_length
+
+
+def word_terms(*texts):
+    return {f'w:{word}'[:TERM_LENGTH] for text in texts for word in WORD.findall(str(text).lower())}
+
+
+def parameter_term(parameter_id, value):
+    return f'p:{parameter_id}:{value}'[:TERM_LENGTH]
+
+
+def item_terms(name, model, parameters):
+    """
+    Термины позиции каталога, parameters - словарь ИД параметра -> значение
+    """
+    return word_terms(name, model) | {parameter_term(parameter_id, value)
+                                      for parameter_id, value in parameters.items()}
+
+
+def reindex(product_info_ids):
+    """
+    Пересобирает термины позиций по данным из базы
+    """
+    product_info_ids = set(product_info_ids)
+    parameters = {}
+    for info_id, parameter_id, value in ProductParameter.objects.filter(
+            product_info_id__in=product_info_ids).values_list('product_info_id', 'parameter_id', 'value'):
+        parameters.setdefault(info_id, {})[parameter_id] = value
+
+    terms = [SearchTerm(product_info_id=info_id, term=term)
+             for info_id, name, model in ProductInfo.objects.filter(id__in=product_info_ids).values_list(
+                 'id', 'product__name', 'model')
+             for term in item_terms(name, model, parameters.get(info_id, {}))]
+    with transaction.atomic():
+        SearchTerm.objects.filter(product_info_id__in=product_info_ids).delete()
+        SearchTerm.objects.bulk_create(terms)
+
+
+def query_terms(query_params):
+    """
+    Термины запроса: слова из q и фасеты parameter=<ИД параметра>:<значение>
+    """
+    terms = word_terms(query_params.get('q', ''))
+    for facet in query_params.getlist('parameter'):
+        parameter_id, _, value = facet.partition(':')
+        if parameter_id.isdigit() and value:
+            terms.add(parameter_term(parameter_id, value))
+    return terms
+
+
+def matching(terms):
+    """
+    Подзапрос ИД позиций, у которых есть все термины
+    """
+    return SearchTerm.objects.filter(term__in=terms).values('product_info_id').annotate(
+        matched=Count('id')).filter(matched=len(terms)).values('product_info_id')
+
+
+def filter_products(queryset, query_params):
+    terms = query_terms(query_params)
+    if terms:
+        queryset = queryset.filter(id__in=matching(terms))
+
+    price_min = query_params.get('price_min')
+    price_max = query_params.get('price_max')
+    if price_min and price_min.isdigit():
+        queryset = queryset.filter(price__gte=price_min)
+    if price_max and price_max.isdigit():
+        queryset = queryset.filter(price__lte=price_max)
+    return queryset
+
+
+def facet_counts(queryset):
+    """
+    Количество позиций выборки по каждому значению каждого параметра и диапазон цен
+    """
+    ids = queryset.order_by().values('id')
+    counts = SearchTerm.objects.filter(product_info_id__in=ids, term__startswith='p:').values_list(
+        'term').annotate(count=Count('id')).order_by('term')
+
+    facets = OrderedDict()
+    for term, count in counts:
+        _, parameter_id, value = term.split(':', 2)
+        facets.setdefault(int(parameter_id), OrderedDict())[value] = count
+
+    names = parameter_names()
+    prices = ProductInfo.objects.filter(id__in=ids).aggregate(min=Min('price'), max=Max('price'))
+    return {
+        'parameters': [{'id': parameter_id, 'name': names.get(parameter_id), 'values': values}
+                       for parameter_id, values in facets.items()],
+        'price': prices,
+    }
@@ -1,6 +1,9 @@
+from django.conf import settings
 from rest_framework import serializers
 
-from .models import User, Category, Shop, ProductInfo, Product, ProductParameter, OrderItem, Order, Contact
+from .fetcher import PriceFetchError, check_url
+from .models import User, Category, Shop, ProductInfo, Product, ProductParameter, OrderItem, Order, Contact, \
+    ImportJob
 from auth_api.models import User, Contact
 
 
@@ -37,6 +40,28 @@ class ShopSerializer(serializers.ModelSerializer):
         read_only_fields = ('id',)
 
 
+class PriceRefreshSerializer(serializers.ModelSerializer):
+    """
+    Расписание обновления прайса магазина
+    """
+
+    class Meta:
+        model = Shop
+        fields = ('price_url', 'refresh_interval', 'next_refresh_at')
+        read_only_fields = ('next_refresh_at',)
+        extra_kwargs = {
+            'refresh_interval': {'min_value': getattr(settings, 'PRICE_REFRESH_MIN_INTERVAL', 15)},
+        }
+
+    def validate_price_url(self, value):
+        if value:
+            try:
+                check_url(value)
+            except PriceFetchError as error:
+                raise serializers.ValidationError(str(error))
+        return value
+
+
 class ProductSerializer(serializers.ModelSerializer):
     category = serializers.StringRelatedField()
 
@@ -80,10 +105,24 @@ class OrderItemCreateSerializer(OrderItemSerializer):
 class OrderSerializer(serializers.ModelSerializer):
     ordered_items = OrderItemCreateSerializer(read_only=True, many=True)
 
-    total_sum = serializers.IntegerField()
     contact = ContactSerializer(read_only=True)
 
     class Meta:
         model = Order
-        fields = ('id', 'ordered_items', 'status', 'dt', 'total_sum', 'contact',)
-        read_only_fields = ('id',)
+        fields = ('id', 'ordered_items', 'status', 'dt', 'total_quantity', 'total_sum', 'contact',)
+        read_only_fields = ('id', 'total_quantity', 'total_sum',)
+
+
+class PartnerOrderSerializer(OrderSerializer):
+    total_quantity = serializers.IntegerField(source='shop_total_quantity', read_only=True)
+    total_sum = serializers.IntegerField(source='shop_total_sum', read_only=True)
+
+
+class ImportJobSerializer(serializers.ModelSerializer):
+    elapsed = serializers.FloatField(read_only=True)
+
+    class Meta:
+        model = ImportJob
+        fields = ('id', 'status', 'url', 'chunked', 'rows_parsed', 'rows_written', 'errors', 'created_at', 'started_at',
+                  'finished_at', 'elapsed',)
+        read_only_fields = fields
@@ -1,10 +1,17 @@
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver, Signal
 from django_rest_passwordreset.signals import reset_password_token_created
+from rest_framework.authtoken.models import Token
 
+from auth_api.authentication import invalidate_user_tokens, token_cache
 from auth_api.models import ConfirmEmailToken, User
 
 
-from .tasks import send_email
+from .cache import invalidate_catalog, touch
+from .models import Category, Order, OrderItem, Parameter, Product, Shop
+from .reservations import commit_reservations, release_reservations
+from .tasks import queue_email
+from .totals import order_items_changed
 
 new_user_registered = Signal(
     providing_args=['user_id'],
@@ -27,9 +34,10 @@ def password_reset_token_created(sender, instance, reset_password_token, **kwarg
     :return:
     """
     # send an e-mail to the user
+    title = 'Сброс пароля'
     message = f'Token {reset_password_token.key}'
-    email = reset_password_token.user
-    send_email(message, email)
+    email = reset_password_token.user.email
+    queue_email(title, message, email)
 
 
 @receiver(new_user_registered)
@@ -39,9 +47,10 @@ def new_user_registered_signal(user_id, **kwargs):
     """
     # send an e-mail to the user
     token, _ = ConfirmEmailToken.objects.get_or_create(user_id=user_id)
+    title = 'Подтверждение email'
     message = token.key
     email = token.user.email
-    send_email(message, email)
+    queue_email(title, message, email)
 
 
 @receiver(new_order)
@@ -54,4 +63,71 @@ def new_order_signal(user_id, **kwargs):
     title = "Обновление статуса заказа"
     message = 'Заказ сформирован'
     email = user.email
-    send_email.apply_async((title, message, email), countdown=5 * 60)
+    queue_email(title, message, email)
+
+
+@receiver(post_save, sender=OrderItem)
+@receiver(post_delete, sender=OrderItem)
+def order_item_changed(sender, instance, **kwargs):
+    """
+    пересчитываем итоги заказа при изменении его позиций
+    """
+    order_items_changed([instance.order_id])
+
+
+@receiver(post_save, sender=Order)
+def order_status_changed(sender, instance, **kwargs):
+    """
+    снимаем резерв с отменённого заказа и закрепляем за подтверждённым
+    """
+    if instance.status == 'canceled':
+        release_reservations(instance.id)
+    elif instance.status in ('confirmed', 'assembled', 'sent', 'delivered'):
+        commit_reservations(instance.id)
+
+
+@receiver(post_save, sender=User)
+def user_changed(sender, instance, **kwargs):
+    """
+    сбрасываем кэш токенов при смене пароля, отключении и других изменениях пользователя
+    """
+    invalidate_user_tokens(instance.id)
+
+
+@receiver(post_delete, sender=Token)
+def token_deleted(sender, instance, **kwargs):
+    """
+    удалённый токен (выход, удаление пользователя) сразу перестаёт действовать
+    """
+    token_cache.delete(instance.key)
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def category_changed(sender, **kwargs):
+    """
+    название категории есть и в списке категорий, и в позициях каталога
+    """
+    touch('categories', 'products')
+
+
+@receiver(post_save, sender=Shop)
+@receiver(post_delete, sender=Shop)
+def shop_changed(sender, instance, **kwargs):
+    """
+    магазин, включённый или выключенный в админке, сразу появляется в поиске или пропадает из него
+    """
+    invalidate_catalog(instance.id)
+    touch('shops')
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def product_changed(sender, **kwargs):
+    touch('products')
+
+
+@receiver(post_save, sender=Parameter)
+@receiver(post_delete, sender=Parameter)
+def parameter_changed(sender, **kwargs):
+    touch('parameters')
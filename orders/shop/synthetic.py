@@ -0,0 +1,212 @@
+"""
+Синтетические данные для замеров: прайс-листы поставщиков во всех форматах
+shop.readers, покупатели, корзины и заказы.
+
+Данные зависят только от размеров и seed, поэтому замеры разных версий
+проводятся на одинаковых данных.
+"""
+import csv
+import gzip
+import io
+import os
+import random
+from collections import defaultdict
+
+import yaml
+from ujson import dumps as dump_json
+
+from auth_api.models import Contact, User
+
+from .models import Category, Order, OrderItem, OrderShopTotal, Parameter, Product, ProductInfo, ProductParameter, \
+    Shop
+from .readers import CSV_FIELDS, EXTENSIONS
+
+CATEGORIES = 10
+
+# строки, на которых кодировщики JSON чаще всего расходятся
+SAMPLES = ('обычный текст', 'кавычки " и \\ слэши / ', 'перевод\nстроки\tи\x01управляющие', 'смайлик 😀',
+           'разделитель\u2028строк', '<b>&amp;</b>')
+
+YAMLDumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+
+def categories():
+    return [{'id': number, 'name': f'Категория {number}'} for number in range(1, CATEGORIES + 1)]
+
+
+def iter_goods(count, parameters, shop=0, revision=0):
+    """
+    Товары прайса магазина shop. Со следующей revision меняется цена каждого десятого товара
+    """
+    for number in range(count):
+        yield {
+            'id': number,
+            'category': number % CATEGORIES + 1,
+            'model': f'bench/{shop}/model-{number}',
+            'name': f'Товар "{number}" магазина {shop}',
+            'price': 1000 + (number * 7 + shop) % 5000 + (revision if number % 10 == 0 else 0),
+            'price_rrc': 1200 + (number * 7 + shop) % 5000,
+            'quantity': 10 + number % 50,
+            'parameters': {f'Параметр {index}': f'значение {(number + index) % 100}' for index in range(parameters)},
+        }
+
+
+def write_yaml(stream, shop_name, goods):
+    stream.write(yaml.dump({'shop': shop_name, 'categories': categories()}, Dumper=YAMLDumper, allow_unicode=True,
+                           sort_keys=False))
+    stream.write('goods:\n')
+    batch = []
+    for item in goods:
+        batch.append(item)
+        if len(batch) == 1000:
+            stream.write(yaml.dump(batch, Dumper=YAMLDumper, allow_unicode=True, sort_keys=False))
+            batch = []
+    if batch:
+        stream.write(yaml.dump(batch, Dumper=YAMLDumper, allow_unicode=True, sort_keys=False))
+
+
+def write_json(stream, shop_name, goods):
+    stream.write(f'{{"shop": {dump_json(shop_name, ensure_ascii=False)}, '
+                 f'"categories": {dump_json(categories(), ensure_ascii=False)}, "goods": [')
+    for number, item in enumerate(goods):
+        if number:
+            stream.write(',\n')
+        stream.write(dump_json(item, ensure_ascii=False))
+    stream.write(']}\n')
+
+
+def write_jsonl(stream, shop_name, goods):
+    stream.write(dump_json({'shop': shop_name}, ensure_ascii=False) + '\n')
+    for category in categories():
+        stream.write(dump_json({'categories': category}, ensure_ascii=False) + '\n')
+    for item in goods:
+        stream.write(dump_json({'goods': item}, ensure_ascii=False) + '\n')
+
+
+def write_csv(stream, shop_name, goods):
+    names = {category['id']: category['name'] for category in categories()}
+    writer = None
+    for item in goods:
+        if writer is None:
+            writer = csv.writer(stream)
+            writer.writerow(CSV_FIELDS + tuple(item['parameters']))
+        writer.writerow([shop_name, names[item['category']], item['id'], item['model'], item['name'], item['price'],
+                         item['price_rrc'], item['quantity'], *item['parameters'].values()])
+
+
+WRITERS = {
+    'yaml': write_yaml,
+    'json': write_json,
+    'jsonl': write_jsonl,
+    'csv': write_csv,
+}
+
+
+def write_price_list(path, goods, shop_name='Bench'):
+    """
+    Записывает прайс в формате по расширению path, с расширением .gz - сжатым
+    """
+    compressed = path.endswith('.gz')
+    price_format = EXTENSIONS[os.path.splitext(path[:-3] if compressed else path)[1].lstrip('.')]
+    with (gzip.open(path, 'wb') if compressed else open(path, 'wb')) as binary:
+        with io.TextIOWrapper(binary, encoding='utf-8', newline='') as stream:
+            WRITERS[price_format](stream, shop_name, goods)
+    return path
+
+
+def create_suppliers(count):
+    return [User.objects.get_or_create(email=f'shop{number}@bench.example', defaults={
+        'username': f'bench-shop{number}', 'type': 'shop', 'is_active': True})[0] for number in range(count)]
+
+
+def write_price_lists(directory, suppliers, goods, parameters, price_format='yaml', revision=0):
+    """
+    Прайсы поставщиков в directory, возвращает пары (поставщик, путь к файлу)
+    """
+    return [(supplier, write_price_list(
+        os.path.join(directory, f'shop{number}-{revision}.{price_format}'),
+        iter_goods(goods, parameters, shop=number, revision=revision), shop_name=f'Bench {number}'))
+        for number, supplier in enumerate(suppliers)]
+
+
+def create_buyers(count):
+    buyers = []
+    for number in range(count):
+        buyer, created = User.objects.get_or_create(email=f'buyer{number}@bench.example', defaults={
+            'username': f'bench-buyer{number}', 'is_active': True})
+        if created:
+            Contact.objects.create(user=buyer, city='Москва', street=f'Улица {number}', house='1',
+                                   phone='+7 000 000 00 00')
+        buyers.append(buyer)
+    return buyers
+
+
+def create_orders(buyers, orders, items, seed=0):
+    """
+    По orders заказов из items позиций у каждого покупателя и корзина из items позиций
+    """
+    rng = random.Random(seed)
+    infos = list(ProductInfo.objects.values_list('id', 'shop_id', 'price'))
+    if not infos:
+        return 0
+
+    created = 0
+    for buyer in buyers:
+        contact = Contact.objects.filter(user=buyer).first()
+        # корзина у покупателя одна, при повторном запуске новую не создаём
+        has_basket = Order.objects.filter(user=buyer, status='basket').exists()
+        for status in ['new'] * orders + ([] if has_basket else ['basket']):
+            lines = rng.sample(infos, min(items, len(infos)))
+            quantities = [rng.randint(1, 3) for _ in lines]
+            order = Order.objects.create(
+                user=buyer, contact=contact if status != 'basket' else None, status=status,
+                total_quantity=sum(quantities),
+                total_sum=sum(price * quantity for (_, _, price), quantity in zip(lines, quantities)))
+            # bulk_create не вызывает OrderItem.save(), стоимость считаем сами
+            OrderItem.objects.bulk_create([
+                OrderItem(order=order, product_info_id=info_id, quantity=quantity, price=price,
+                          total_amount=price * quantity)
+                for (info_id, _, price), quantity in zip(lines, quantities)])
+
+            if status != 'basket':
+                totals = defaultdict(lambda: [0, 0])
+                for (_, shop_id, price), quantity in zip(lines, quantities):
+                    totals[shop_id][0] += quantity
+                    totals[shop_id][1] += price * quantity
+                OrderShopTotal.objects.bulk_create([
+                    OrderShopTotal(order=order, shop_id=shop_id, total_quantity=quantity, total_sum=total)
+                    for shop_id, (quantity, total) in totals.items()])
+                created += 1
+    return created
+
+
+def create_sample_order(count, parameter_count):
+    """
+    Магазин с count позициями по parameter_count параметров и заказ на все позиции.
+    В названиях и значениях - строки SAMPLES
+    """
+    supplier = User.objects.create_user('samples-shop@example.com', username='samples-shop', type='shop')
+    shop = Shop.objects.create(name='Samples', user=supplier)
+    category = Category.objects.create(name=SAMPLES[1])
+    parameters = [Parameter.objects.create(name=f'{SAMPLES[number % len(SAMPLES)]} {number}')
+                  for number in range(parameter_count)]
+
+    infos = []
+    for number in range(count):
+        product, _ = Product.objects.get_or_create(name=SAMPLES[number % len(SAMPLES)], category=category)
+        infos.append(ProductInfo.objects.create(
+            model=f'samples/{number} {SAMPLES[-number % len(SAMPLES)]}', external_id=number, product=product,
+            shop=shop, quantity=number, price=100 + number, price_rrc=120 + number))
+    ProductParameter.objects.bulk_create([
+        ProductParameter(product_info=info, parameter=parameter, value=SAMPLES[(info.id + index) % len(SAMPLES)])
+        for info in infos for index, parameter in enumerate(parameters)
+    ])
+
+    buyer = User.objects.create_user('samples-buyer@example.com', username='samples-buyer')
+    contact = Contact.objects.create(user=buyer, city='Москва', street=SAMPLES[1], phone='+7 000')
+    order = Order.objects.create(user=buyer, contact=contact, status='new', total_quantity=count,
+                                 total_sum=count * 100)
+    OrderItem.objects.bulk_create([OrderItem(order=order, product_info=info, quantity=1, price=info.price)
+                                   for info in infos])
+    OrderShopTotal.objects.create(order=order, shop=shop, total_quantity=count, total_sum=count * 100)
+    return shop, order
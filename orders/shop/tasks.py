@@ -1,65 +1,363 @@
-import yaml
+import random
+from datetime import date, timedelta
 
-from django.conf.global_settings import EMAIL_HOST_USER
+from celery import chord
+from celery.signals import task_postrun, task_prerun, worker_process_shutdown
+from django.conf import settings
+from django.core.mail import get_connection
 from django.core.mail.message import EmailMultiAlternatives
+from django.db import transaction
+from django.db.models import Count, F, Q, Sum
+from django.utils import timezone
 
+from auth_api.models import User
 from orders.celery import app
 
-from .models import Category, Parameter, ProductParameter, Product, Shop
+from .changes import compact
+from .fetcher import fetch_price_list, forget_price_list, get_source
+from .importer import PriceListImporter
+from .models import ImportJob, Order, OrderShopTotal, OutgoingEmail, Shop, StockReservation, storage
+from .queries import task_finished, task_started, worker_stopped
+from .reservations import release_reservations
+from .resolvers import parameter_resolver
+from .routers import replica_reads
+
+CHUNK_SIZE = getattr(settings, 'IMPORT_CHUNK_SIZE', 10000)
+STALE_AFTER = getattr(settings, 'IMPORT_STALE_AFTER', 2 * 60 * 60)
+
+OUTBOX_BATCH_SIZE = getattr(settings, 'EMAIL_OUTBOX_BATCH_SIZE', 50)
+OUTBOX_RATE_LIMIT = getattr(settings, 'EMAIL_OUTBOX_RATE_LIMIT', '30/m')
+OUTBOX_MAX_ATTEMPTS = getattr(settings, 'EMAIL_OUTBOX_MAX_ATTEMPTS', 5)
+OUTBOX_RETRY_DELAY = getattr(settings, 'EMAIL_OUTBOX_RETRY_DELAY', 30)
+OUTBOX_CLAIM_TIMEOUT = getattr(settings, 'EMAIL_OUTBOX_CLAIM_TIMEOUT', 10 * 60)
+
+REFRESH_MAX_CONCURRENT = getattr(settings, 'PRICE_REFRESH_MAX_CONCURRENT', 4)
+REFRESH_JITTER = getattr(settings, 'PRICE_REFRESH_JITTER', 0.1)
+
+# учёт запросов к базе по задачам
+task_prerun.connect(task_started)
+task_postrun.connect(task_finished)
+worker_process_shutdown.connect(worker_stopped)
+
+
+def queue_email(subject, message, email):
+    """
+    Кладёт письмо в очередь исходящих в текущей транзакции, отправка - после её фиксации
+    """
+    OutgoingEmail.objects.create(subject=subject, body=message, to=email)
+    transaction.on_commit(lambda: send_outbox.delay())
+
+
+@app.task(bind=True, rate_limit=OUTBOX_RATE_LIMIT, max_retries=OUTBOX_MAX_ATTEMPTS)
+def send_outbox(self):
+    """
+    Отправляет пачку писем из очереди через одно SMTP-соединение
+    """
+    now = timezone.now()
+    # воркер упал, не отметив результат отправки: письма возвращаются в очередь.
+    # Если письмо успело уйти до сбоя, получатель увидит его дважды
+    OutgoingEmail.objects.filter(status='sending', claimed_at__lt=now - timedelta(seconds=OUTBOX_CLAIM_TIMEOUT)).update(
+        status='pending')
+
+    with transaction.atomic():
+        emails = list(OutgoingEmail.objects.select_for_update(skip_locked=True).filter(
+            status='pending').order_by('id')[:OUTBOX_BATCH_SIZE])
+        OutgoingEmail.objects.filter(id__in=[email.id for email in emails]).update(status='sending', claimed_at=now)
+    if not emails:
+        return 0
+
+    ids = [email.id for email in emails]
+    connection = get_connection()
+    messages = [EmailMultiAlternatives(subject=email.subject, body=email.body, from_email=settings.EMAIL_HOST_USER,
+                                       to=[email.to], connection=connection) for email in emails]
+    try:
+        connection.send_messages(messages)
+    except Exception as error:
+        OutgoingEmail.objects.filter(id__in=ids).update(attempts=F('attempts') + 1, last_error=str(error),
+                                                        status='pending')
+        OutgoingEmail.objects.filter(id__in=ids, attempts__gte=OUTBOX_MAX_ATTEMPTS).update(status='failed')
+        raise self.retry(exc=error, countdown=OUTBOX_RETRY_DELAY * 2 ** self.request.retries)
+    finally:
+        connection.close()
+
+    OutgoingEmail.objects.filter(id__in=ids).update(status='sent', sent_at=timezone.now(),
+                                                    attempts=F('attempts') + 1)
+    # в очереди ещё есть письма - берём следующую пачку
+    if len(emails) == OUTBOX_BATCH_SIZE:
+        send_outbox.delay()
+    return len(emails)
+
+
+def active_jobs():
+    """
+    Загрузки в очереди и выполняемые. Зависшие после сбоя воркера
+    дольше IMPORT_STALE_AFTER секунд не считаются
+    """
+    return ImportJob.objects.filter(status__in=('queued', 'running'),
+                                    created_at__gte=timezone.now() - timedelta(seconds=STALE_AFTER))
+
+
+def queue_import(user_id, file=None, **fields):
+    """
+    Создаёт загрузку прайса поставщика и ставит её в очередь после фиксации транзакции.
+    Если у поставщика уже есть незавершённая загрузка, возвращает None.
+
+    Вызывается в транзакции: строка пользователя заблокирована до её конца,
+    поэтому параллельные запросы не создадут две загрузки одного поставщика
+    """
+    list(User.objects.select_for_update().filter(id=user_id).values_list('id'))
+    if active_jobs().filter(user_id=user_id).exists():
+        return None
+
+    job = ImportJob(user_id=user_id, **fields)
+    if file:
+        job.file_name.save(file.name, file, save=False)
+    job.save()
+    transaction.on_commit(lambda: import_shop_data.delay(job.id))
+    return job
+
+
+def update_job(job_id, **fields):
+    ImportJob.objects.filter(id=job_id).update(**fields)
+
+
+def report_progress(job_id):
+    def progress(stats):
+        update_job(job_id, rows_parsed=stats['parsed'],
+                   rows_written=stats['created'] + stats['updated'] + stats['deleted'])
+
+    return progress
+
+
+@app.task()
+def import_shop_data(job_id):
+    job = ImportJob.objects.get(id=job_id)
+    update_job(job_id, status='running', started_at=timezone.now())
+
+    try:
+        if not job.file_name:
+            if job.source is None:
+                job.source = get_source(job.user_id, job.url)
+                update_job(job_id, source=job.source)
+            file_name = fetch_price_list(job.source)
+            if file_name is None:
+                update_job(job_id, status='unchanged', finished_at=timezone.now())
+                return None
+            job.file_name = file_name
+            update_job(job_id, file_name=file_name)
+
+        with job.file_name.open('rb') as stream:
+            if job.chunked:
+                return start_chunked_import(job, stream)
+            stats = PriceListImporter(job.user_id, progress=report_progress(job_id)).run(stream)
+    except Exception as error:
+        fail_job(job, error)
+        raise
+    finally:
+        discard_file(job)
+
+    update_job(job_id, status='done', finished_at=timezone.now())
+    return stats
+
+
+def discard_file(job):
+    """
+    Удаляет файл прайса из хранилища: после разбора он не нужен, части
+    параллельной загрузки получают товары в аргументах задач
+    """
+    if job.file_name:
+        job.file_name.delete(save=False)
+        update_job(job.id, file_name='')
+
+
+def start_chunked_import(job, stream):
+    """
+    Делит товары прайса на части по IMPORT_CHUNK_SIZE и загружает их параллельно
+    """
+    importer = PriceListImporter(job.user_id)
+    shards = []
+    shard = []
+    for item in importer.iter_goods(stream):
+        shard.append(item)
+        if len(shard) >= CHUNK_SIZE:
+            shards.append(shard)
+            shard = []
+    if shard:
+        shards.append(shard)
+
+    # общие справочники заполняем заранее, чтобы части не создавали одни и те же записи наперегонки
+    goods = [item for shard in shards for item in shard]
+    importer.resolve_products(goods)
+    parameter_resolver.resolve(name for item in goods for name in item.get('parameters', {}))
+
+    shop_id = importer.shop.id
+    version = importer.version
+    category_ids = list(importer.category_ids.items())
+    if not shards:
+        finish_chunked_import.delay([], job.id, shop_id, version)
+        return 0
+
+    header = [import_goods_chunk.s(job.id, shop_id, version, category_ids, shard) for shard in shards]
+    callback = finish_chunked_import.s(job.id, shop_id, version).on_error(fail_chunked_import.s(job.id))
+    chord(header)(callback)
+    return len(header)
 
 
 @app.task()
-def send_email(message: str, email: str, *args, **kwargs) -> str:
-    title = 'Title'
-    email_list = list()
-    email_list.append(email)
+def import_goods_chunk(job_id, shop_id, version, category_ids, items):
+    shop = Shop.objects.get(id=shop_id)
+    importer = PriceListImporter(shop.user_id, shop=shop, category_ids=category_ids, version=version)
+    importer.apply_items(items)
+
+    stats = importer.stats
+    update_job(job_id, rows_parsed=F('rows_parsed') + stats['parsed'],
+               rows_written=F('rows_written') + stats['created'] + stats['updated'])
+    # отложенные изменения части уже сохранены в ImportStage
+    return {'stats': stats, 'seen': list(importer.seen)}
+
+
+@app.task()
+def finish_chunked_import(results, job_id, shop_id, version):
+    """
+    Применяет отложенные изменения всех частей, удаляет позиции, которых не оказалось
+    ни в одной части прайса, и переключает магазин на новую версию каталога
+    """
+    shop = Shop.objects.get(id=shop_id)
+    importer = PriceListImporter(shop.user_id, shop=shop, version=version)
+    for result in results:
+        importer.seen.update(result['seen'])
+
+    importer.publish()
+
+    update_job(job_id, rows_written=F('rows_written') + importer.stats['deleted'], status='done',
+               finished_at=timezone.now())
+    return importer.stats['deleted']
+
+
+def fail_job(job, error):
+    update_job(job.id, status='failed', errors=str(error), finished_at=timezone.now())
+    if job.source_id:
+        forget_price_list(job.source_id)
+
+
+@app.task()
+def fail_chunked_import(request, exc, traceback, job_id):
+    fail_job(ImportJob.objects.get(id=job_id), exc)
+
+
+@app.task()
+def purge_price_files():
+    """
+    Удаляет файлы прайсов, оставшиеся после сбоя воркера: файлы завершённых и зависших
+    загрузок и файлы в хранилище, на которые ничего не ссылается, старше IMPORT_STALE_AFTER
+    """
+    stale = timezone.now() - timedelta(seconds=STALE_AFTER)
+    jobs = ImportJob.objects.exclude(file_name='').exclude(file_name__isnull=True).filter(
+        Q(status__in=('done', 'unchanged', 'failed')) | Q(created_at__lt=stale))
+    purged = 0
+    for job in jobs:
+        discard_file(job)
+        purged += 1
+
+    # скачанный файл мог не успеть попасть в загрузку, загруженный - дождаться фиксации транзакции
+    referenced = {*ImportJob.objects.values_list('file_name', flat=True),
+                  *Shop.objects.values_list('file_name', flat=True)}
     try:
-        msg = EmailMultiAlternatives(subject=title, body=message, from_email=EMAIL_HOST_USER, to=email_list)
-        msg.send()
-        return f'Title: {msg.subject}, Message:{msg.body}'
-    except Exception as e:
-        raise e
+        _, names = storage.listdir('')
+    except FileNotFoundError:
+        return purged
+    for name in names:
+        if name not in referenced and storage.get_modified_time(name) < stale:
+            storage.delete(name)
+            purged += 1
+    return purged
+
+
+@app.task()
+def expire_reservations():
+    """
+    Отменяет заказы, не подтверждённые до истечения резерва, и возвращает товар на остаток
+    """
+    order_ids = set(StockReservation.objects.filter(
+        status='active', expires_at__lt=timezone.now(), order__status='new').values_list('order_id', flat=True))
+
+    expired = 0
+    for order_id in order_ids:
+        with transaction.atomic():
+            if Order.objects.filter(id=order_id, status='new').update(status='canceled'):
+                release_reservations(order_id)
+                expired += 1
+    return expired
+
+
+@app.task()
+def compact_catalog_changes():
+    """
+    Удаляет из ленты изменений перекрытые и устаревшие записи
+    """
+    return compact()
+
+
+@app.task()
+def send_sales_reports(day=None):
+    """
+    Рассылает магазинам итоги заказов за день (по умолчанию - за вчера).
+    Отчёт читается с реплик, в основную базу пишутся только письма
+    """
+    day = date.fromisoformat(day) if day else timezone.localdate() - timedelta(days=1)
+    with replica_reads():
+        rows = list(OrderShopTotal.objects.filter(order__dt__date=day, shop__user__isnull=False).exclude(
+            order__status__in=('basket', 'canceled')).values('shop__user__email', 'shop__name').annotate(
+            orders=Count('order_id'), quantity=Sum('total_quantity'), total=Sum('total_sum')).order_by('shop__name'))
 
+    with transaction.atomic():
+        for row in rows:
+            message = f'{row["shop__name"]}, {day:%d.%m.%Y}: заказов {row["orders"]}, ' \
+                      f'товаров {row["quantity"]}, на сумму {row["total"]}'
+            queue_email('Итоги заказов за день', message, row['shop__user__email'])
+    return len(rows)
 
-def open_file(shop):
-    with open(shop.get_file(), 'r') as f:
-        data = yaml.safe_load(f)
-    return data
+
+def refresh_delay(interval):
+    """
+    Время до следующего обновления прайса: интервал в минутах со случайным отклонением
+    на долю PRICE_REFRESH_JITTER, чтобы магазины с одинаковым интервалом не сходились к одному моменту
+    """
+    return timedelta(minutes=interval * random.uniform(1 - REFRESH_JITTER, 1 + REFRESH_JITTER))
 
 
 @app.task()
-def import_shop_data(data, user_id):
-    file = open_file(data)
-
-    shop, _ = Shop.objects.get_or_create(user_id=user_id,
-                                         defaults={'name': file['shop']})
-
-    load_cat = [
-        Category(id=category['id'], name=category['name']) for category in file['categories']
-    ]
-    Category.objects.bulk_create(load_cat)
-
-    Product.objects.filter(shop_id=shop.id).delete()
-
-    load_prod = []
-    product_id = {}
-    load_pp = []
-    for item in file['goods']:
-        load_prod.append(Product(name=item['name'],
-                                 category_id=item['category'],
-                                 model=item['model'],
-                                 external_id=item['id'],
-                                 shop_id=shop.id,
-                                 quantity=item['quantity'],
-                                 price=item['price'],
-                                 price_rrc=item['price_rrc']))
-        product_id[item['id']] = {}
-
-        for name, value in item['parameters'].items():
-            parameter, _ = Parameter.objects.get_or_create(name=name)
-            product_id[item['id']].update({parameter.id: value})
-            load_pp.append(ProductParameter(product_id=product_id[item['id']][parameter.id],
-                                            parameter_id=parameter.id,
-                                            value=value))
-    Product.objects.bulk_create(load_prod)
-    ProductParameter.objects.bulk_create(load_pp)
+def schedule_price_refreshes():
+    """
+    Ставит в очередь загрузку прайсов магазинов, у которых подошло время обновления.
+    Одновременно выполняется не больше PRICE_REFRESH_MAX_CONCURRENT загрузок,
+    остальные магазины дождутся следующего запуска
+    """
+    now = timezone.now()
+    scheduled = Shop.objects.filter(user__isnull=False, price_url__isnull=False, refresh_interval__isnull=False)
+
+    # первое обновление назначаем в случайный момент интервала:
+    # магазины, получившие расписание одновременно, не загружаются вместе
+    new = list(scheduled.filter(next_refresh_at__isnull=True))
+    for shop in new:
+        shop.next_refresh_at = now + timedelta(minutes=shop.refresh_interval * random.random())
+    Shop.objects.bulk_update(new, ['next_refresh_at'])
+
+    # зависшие после сбоя воркера загрузки не занимают место бесконечно
+    active = active_jobs()
+    free = REFRESH_MAX_CONCURRENT - active.count()
+    if free <= 0:
+        return 0
+
+    with transaction.atomic():
+        shops = list(scheduled.select_for_update(skip_locked=True).filter(
+            state=True, next_refresh_at__lte=now).exclude(
+            user_id__in=active.values('user_id')).order_by('next_refresh_at')[:free])
+        queued = []
+        for shop in shops:
+            # поставщик мог успеть загрузить прайс сам, тогда обновим в следующий запуск
+            if queue_import(shop.user_id, url=shop.price_url):
+                shop.next_refresh_at = now + refresh_delay(shop.refresh_interval)
+                queued.append(shop)
+        Shop.objects.bulk_update(queued, ['next_refresh_at'])
+    return len(queued)
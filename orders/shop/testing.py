@@ -0,0 +1,115 @@
+"""
+Помощники для тестов и замеров.
+
+Бюджет запросов к базе объявляет само представление атрибутом query_budget
+(см. shop.queries). assert_query_budget выполняет запрос тестовым клиентом и
+падает, если запросов к базе больше бюджета; в сообщение попадают
+повторяющиеся запросы, по которым обычно и виден N+1. В тестах удобнее
+QueryBudgetMixin для TestCase.
+
+rendering_cases отдаёт ответы сериализаторов DRF и быстрого пути
+shop.payloads, которые должны совпадать побайтно.
+
+Команды замеров работают в отдельной тестовой базе bench_database, чтобы не
+трогать рабочие данные.
+"""
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+from django.db import connection
+from django.db.models import F, Prefetch
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.urls import resolve
+from rest_framework.renderers import JSONRenderer
+
+from .models import Order, OrderItem, ProductInfo, ProductParameter
+from .payloads import OrderPayload, UJSONRenderer, order_payloads, product_info_payloads, product_info_values
+from .queries import query_budget, track_queries
+from .resolvers import category_resolver, parameter_resolver
+from .serializers import OrderSerializer, PartnerOrderSerializer, ProductInfoSerializer
+
+
+@contextmanager
+def bench_database(keepdb=False):
+    """
+    Тестовая база на время замера. Окружение как при запуске тестов: DEBUG выключен
+    и запросы не копятся в connection.queries, письма не отправляются, адрес testserver разрешён
+    """
+    setup_test_environment(debug=False)
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, keepdb=keepdb, serialize=False)
+    # ИД категорий и параметров в кэше процесса относятся к рабочей базе
+    category_resolver.clear()
+    parameter_resolver.clear()
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=keepdb)
+        teardown_test_environment()
+
+
+class QueryBudgetExceeded(AssertionError):
+    """
+    Представление выполнило больше запросов, чем объявило в query_budget
+    """
+
+
+def assert_query_budget(client, method, path, **kwargs):
+    """
+    Выполняет запрос client.<method>(path, **kwargs), проверяет число запросов к базе
+    по query_budget представления и возвращает ответ и итоги запросов
+    """
+    view = resolve(urlsplit(path).path).func
+    budget = query_budget(view, method)
+    if budget is None:
+        raise AssertionError(f'{method.upper()} {path}: у представления {getattr(view, "cls", view)} '
+                             f'не задан query_budget')
+
+    with track_queries() as stats:
+        response = getattr(client, method.lower())(path, **kwargs)
+    if stats.count > budget:
+        raise QueryBudgetExceeded(f'{method.upper()} {path}: бюджет {budget}, {stats.describe()}')
+    return response, stats
+
+
+class QueryBudgetMixin:
+    """
+    Примесь к TestCase: self.assertQueryBudget('get', '/api/v1/basket')
+    """
+
+    def assertQueryBudget(self, method, path, **kwargs):
+        response, _ = assert_query_budget(self.client, method, path, **kwargs)
+        return response
+
+
+def rendering_cases(shop, order, count):
+    """
+    Тройки (название, ответ сериализаторов DRF, ответ shop.payloads) для страницы каталога
+    из count позиций, заказа покупателя и заказа поставщика shop. Ответы должны совпадать побайтно
+    """
+    parameters = Prefetch('product_parameters', queryset=ProductParameter.objects.order_by('id').select_related(
+        'parameter'))
+    items = Prefetch('ordered_items', queryset=OrderItem.objects.order_by('id').select_related(
+        'product_info__product__category').prefetch_related(
+        Prefetch('product_info__product_parameters', queryset=parameters.queryset)))
+    page = ProductInfo.objects.order_by('id')[:count]
+    orders = Order.objects.filter(id=order.id)
+    partner_orders = orders.filter(shop_totals__shop=shop).annotate(
+        shop_total_sum=F('shop_totals__total_sum'), shop_total_quantity=F('shop_totals__total_quantity'))
+    partner_items = OrderItem.objects.filter(product_info__shop=shop)
+
+    return (
+        ('Страница каталога',
+         lambda: JSONRenderer().render(ProductInfoSerializer(
+             page.select_related('product__category').prefetch_related(parameters), many=True).data),
+         lambda: UJSONRenderer().render(product_info_payloads(list(product_info_values(page))))),
+        ('Заказ',
+         lambda: JSONRenderer().render(OrderSerializer(
+             orders.select_related('contact').prefetch_related(items), many=True).data),
+         lambda: UJSONRenderer().render(order_payloads(orders))),
+        ('Заказ поставщика',
+         lambda: JSONRenderer().render(PartnerOrderSerializer(
+             partner_orders.select_related('contact').prefetch_related(items), many=True).data),
+         lambda: UJSONRenderer().render(order_payloads(
+             partner_orders, partner_items, OrderPayload(totals=('shop_total_quantity', 'shop_total_sum'))))),
+    )
@@ -1,3 +1,1052 @@
-from django.test import TestCase
+import csv
+import io
+import os
+import socket
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
 
-# Create your tests here.
+import ujson
+import yaml
+from celery import signature
+from django.core import mail
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.db import connection, transaction
+from django.forms.models import model_to_dict
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.http import http_date
+from rest_framework.test import APIClient
+
+from auth_api.models import Contact, User
+from shop.cache import stamp
+from shop.changes import HORIZON_KEY, RETENTION, compact, horizon, record_changes
+from shop.exports import HEADER
+from shop.fetcher import PriceFetchError, check_url, fetch_price_list, get_source
+from shop.importer import PriceListImporter
+from shop.models import CatalogChange, Category, ImportJob, ImportStage, Order, OrderItem, OrderShopTotal, \
+    OutgoingEmail, Product, ProductInfo, ProductParameter, SearchTerm, Shop, StockReservation, storage
+from shop.queries import track_queries
+from shop.reservations import OutOfStock, release_reservations, reserve_order
+from shop.readers import READ_CHUNK_SIZE, PriceListError, iter_price_list
+from shop.references import published_infos
+from shop.resolvers import category_resolver, parameter_resolver
+from shop.routers import is_pinned, pin_key, replica_reads
+from shop.synthetic import create_buyers, create_orders, create_sample_order, create_suppliers, iter_goods, \
+    write_price_list
+from shop.tasks import OUTBOX_CLAIM_TIMEOUT, STALE_AFTER, expire_reservations, import_shop_data, purge_price_files, \
+    schedule_price_refreshes, send_outbox, send_sales_reports
+from shop.testing import QueryBudgetMixin, rendering_cases
+
+
+def price_list(goods, shop='Связной', categories=None, **kwargs):
+    """
+    Прайс-лист в YAML, как его пишет yaml.safe_dump: ключи по алфавиту, shop после goods
+    """
+    data = {'shop': shop, 'categories': categories or [{'id': 1, 'name': 'Смартфоны'}], 'goods': goods}
+    if shop is None:
+        del data['shop']
+    return io.BytesIO(yaml.safe_dump(data, allow_unicode=True, **kwargs).encode())
+
+
+def good(number, price=1000, category=1, **parameters):
+    return {'id': number, 'category': category, 'model': f'model-{number}', 'name': f'Товар {number}',
+            'price': price, 'price_rrc': price + 100, 'quantity': 5, 'parameters': parameters}
+
+
+def resolve_to(address):
+    return mock.patch('shop.fetcher.socket.getaddrinfo',
+                      return_value=[(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP, '', (address, 0))])
+
+
+class ImportTestCase(TestCase):
+
+    def setUp(self):
+        # ИД справочников в кэше процесса остаются от других тестов
+        category_resolver.clear()
+        parameter_resolver.clear()
+        self.supplier = User.objects.create_user('shop@example.com', username='shop', type='shop')
+
+    def run_import(self, stream, **kwargs):
+        return PriceListImporter(self.supplier.id, **kwargs).run(stream)
+
+
+class PriceListImporterTest(ImportTestCase):
+
+    def test_shop_after_goods(self):
+        stats = self.run_import(price_list([good(1), good(2)]))
+
+        self.assertEqual(stats['created'], 2)
+        shop = Shop.objects.get(user=self.supplier)
+        self.assertEqual(shop.name, 'Связной')
+        self.assertEqual(shop.catalog_version, 1)
+
+    def test_categories_after_goods(self):
+        stream = io.BytesIO(yaml.safe_dump({'shop': 'Связной', 'goods': [good(1, category=7)],
+                                            'categories': [{'id': 7, 'name': 'Аксессуары'}]},
+                                           allow_unicode=True, sort_keys=False).encode())
+        self.run_import(stream)
+
+        info = ProductInfo.objects.select_related('product__category').get()
+        self.assertEqual(info.product.category.name, 'Аксессуары')
+
+    def test_unknown_category(self):
+        with self.assertRaisesMessage(PriceListError, 'Неизвестная категория 2'):
+            self.run_import(price_list([good(1, category=2)]))
+
+    def test_missing_shop(self):
+        with self.assertRaisesMessage(PriceListError, 'не указан магазин'):
+            self.run_import(price_list([good(1)], shop=None))
+        self.assertFalse(Shop.objects.exists())
+
+    def test_only_changes_are_written(self):
+        self.run_import(price_list([good(1, color='белый'), good(2), good(3)]))
+        stats = self.run_import(price_list([good(1, price=900, color='чёрный'), good(2)]))
+
+        self.assertEqual((stats['created'], stats['updated'], stats['deleted']), (0, 1, 1))
+        self.assertEqual(ProductInfo.objects.get(external_id=1).price, 900)
+        self.assertEqual(ProductParameter.objects.get().value, 'чёрный')
+
+    def test_pending_changes_are_staged(self):
+        self.run_import(price_list([good(number) for number in range(6)]))
+
+        importer = PriceListImporter(self.supplier.id, batch_size=2)
+        importer.apply_items(importer.iter_goods(price_list([good(number, price=900) for number in range(6)])))
+        # изменения видимых позиций лежат в базе по пачке и ещё не видны покупателям
+        self.assertEqual(ImportStage.objects.count(), 3)
+        self.assertEqual(importer.pending['infos'], [])
+        self.assertFalse(ProductInfo.objects.filter(price=900).exists())
+
+        importer.publish()
+        self.assertFalse(ImportStage.objects.exists())
+        self.assertEqual(ProductInfo.objects.filter(price=900).count(), 6)
+
+    def test_interrupted_import_is_discarded(self):
+        self.run_import(price_list([good(1)]))
+        importer = PriceListImporter(self.supplier.id)
+        importer.apply_items(importer.iter_goods(price_list([good(1, price=1)])))
+
+        self.run_import(price_list([good(1, price=2)]))
+        self.assertEqual(ProductInfo.objects.get().price, 2)
+
+
+class ChunkedImportTest(ImportTestCase):
+    """
+    Загрузка частями: chord заменён, части и завершающая задача выполняются здесь же
+    """
+
+    def setUp(self):
+        super().setUp()
+        location = tempfile.TemporaryDirectory()
+        self.addCleanup(location.cleanup)
+        for patcher in (mock.patch.object(storage, 'location', location.name),
+                        mock.patch('shop.tasks.CHUNK_SIZE', 2)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.run_import(price_list([good(number) for number in range(3)]))
+
+    def start(self, goods):
+        job = ImportJob(user=self.supplier, chunked=True)
+        job.file_name.save('price.yaml', ContentFile(price_list(goods).getvalue()))
+        with mock.patch('shop.tasks.chord') as chord:
+            import_shop_data.apply((job.id,), throw=True)
+        (header,), _ = chord.call_args
+        (callback,), _ = chord.return_value.call_args
+        return job, header, callback
+
+    def published(self):
+        return sorted(ProductInfo.objects.published().values_list('external_id', 'price'))
+
+    def test_finish_publishes_all_shards(self):
+        job, header, callback = self.start([good(number, price=900) for number in range(1, 6)])
+        self.assertEqual(len(header), 3)
+        results = [shard.apply(throw=True).get() for shard in header]
+        # пока части не сведены, покупатели видят прежний каталог
+        self.assertEqual(self.published(), [(number, 1000) for number in range(3)])
+
+        self.assertEqual(callback.apply((results,), throw=True).get(), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.rows_parsed, job.rows_written), ('done', 5, 6))
+        self.assertEqual(self.published(), [(number, 900) for number in range(1, 6)])
+        self.assertFalse(ImportStage.objects.exists())
+
+    def test_failed_shard_keeps_catalog(self):
+        job, header, callback = self.start([good(number, price=900) for number in range(1, 6)])
+        header[0].apply(throw=True)
+        with mock.patch.object(PriceListImporter, 'apply_items', side_effect=PriceListError('сбой части')):
+            result = header[1].apply()
+        self.assertTrue(result.failed())
+
+        # chord вызывает обработчик ошибки вместо завершающей задачи
+        errback = signature(callback.options['link_error'][0])
+        errback.apply((None, result.result, None), throw=True)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.errors), ('failed', 'сбой части'))
+        self.assertEqual(self.published(), [(number, 1000) for number in range(3)])
+
+        # следующая загрузка отбрасывает изменения незавершённой
+        self.run_import(price_list([good(number, price=800) for number in range(2)]))
+        self.assertEqual(self.published(), [(0, 800), (1, 800)])
+
+
+class PriceListReaderTest(TestCase):
+
+    def test_yaml_aliases(self):
+        # yaml.safe_dump ставит якорь на словарь, повторённый в документе
+        parameters = {'color': 'белый'}
+        goods = [good(1, **parameters), good(2)]
+        goods[1]['parameters'] = goods[0]['parameters']
+        stream = price_list(goods)
+        self.assertIn(b'*id001', stream.getvalue())
+
+        records = list(iter_price_list(stream, name='price.yaml'))
+        self.assertEqual([value['parameters'] for section, value in records if section == 'goods'],
+                         [parameters, parameters])
+
+    def test_section_alias(self):
+        stream = io.BytesIO('shop: Связной\nall: &all [{id: 1, name: Смартфоны}]\ncategories: *all\n'
+                            'goods: []\n'.encode())
+        records = list(iter_price_list(stream, name='price.yaml'))
+
+        self.assertIn(('category', {'id': 1, 'name': 'Смартфоны'}), records)
+        with self.assertRaisesMessage(PriceListError, 'undefined alias'):
+            list(iter_price_list(io.BytesIO(b'shop: *name'), name='price.yaml'))
+
+    def test_missing_fields(self):
+        with open('shop/fixtures/shop1.json', 'rb') as stream, \
+                self.assertRaisesMessage(PriceListError, 'Нет полей id у элемента раздела category'):
+            list(iter_price_list(stream))
+
+        item = good(1)
+        del item['quantity']
+        with self.assertRaisesMessage(PriceListError, 'Нет полей quantity у элемента раздела goods: 1'):
+            list(iter_price_list(price_list([item])))
+
+    def test_malformed_json_is_not_buffered(self):
+        stream = io.BytesIO(b'{"shop": "S", "goods": [{"id": x}' + b' ' * READ_CHUNK_SIZE * 20 + b']}')
+        with self.assertRaisesMessage(PriceListError, 'Ошибка JSON'):
+            list(iter_price_list(stream, name='price.json'))
+        self.assertLess(stream.tell(), READ_CHUNK_SIZE * 4)
+
+    def test_json_value_across_chunks(self):
+        name = 'Смартфон ' * (READ_CHUNK_SIZE // 8)
+        stream = io.BytesIO(ujson.dumps({'shop': 'S', 'categories': [{'id': 1, 'name': name}], 'goods': [],
+                                         'rate': -1.5e-7}, ensure_ascii=False).encode())
+        records = list(iter_price_list(stream, name='price.json'))
+
+        self.assertEqual(records, [('shop', 'S'), ('category', {'id': 1, 'name': name}), ('rate', -1.5e-7)])
+
+
+class ReservationTest(ImportTestCase):
+
+    def setUp(self):
+        super().setUp()
+        item = good(1)
+        item['quantity'] = 10
+        self.item = item
+        self.run_import(price_list([item]))
+        self.info = ProductInfo.objects.get()
+        self.buyer = User.objects.create_user('buyer@example.com', username='buyer')
+        self.contact = Contact.objects.create(user=self.buyer, city='Москва', phone='+7 000')
+
+    def basket(self, quantity):
+        order = Order.objects.create(user=self.buyer, status='basket')
+        OrderItem.objects.create(order=order, product_info=self.info, quantity=quantity, price=self.info.price)
+        return order
+
+    def checkout(self, quantity):
+        order = self.basket(quantity)
+        self.assertTrue(reserve_order(order.id, self.buyer.id, self.contact.id))
+        return order
+
+    def quantity(self):
+        return ProductInfo.objects.get(id=self.info.id).quantity
+
+    def test_reserve_and_release(self):
+        order = self.checkout(4)
+        self.assertEqual(self.quantity(), 6)
+        self.assertEqual(StockReservation.objects.get().quantity, 4)
+        # корзина уже оформлена
+        self.assertFalse(reserve_order(order.id, self.buyer.id, self.contact.id))
+
+        self.assertEqual(release_reservations(order.id), 1)
+        self.assertEqual(self.quantity(), 10)
+        self.assertEqual(StockReservation.objects.get().status, 'released')
+
+    def test_out_of_stock_rolls_back(self):
+        order = self.basket(11)
+        with self.assertRaises(OutOfStock):
+            reserve_order(order.id, self.buyer.id, self.contact.id)
+
+        self.assertEqual(self.quantity(), 10)
+        self.assertEqual(Order.objects.get(id=order.id).status, 'basket')
+        self.assertFalse(StockReservation.objects.exists())
+
+    def test_expire_reservations(self):
+        expired = self.checkout(4)
+        current = self.checkout(2)
+        StockReservation.objects.filter(order=expired).update(expires_at=timezone.now() - timedelta(seconds=1))
+
+        self.assertEqual(expire_reservations.apply().get(), 1)
+        self.assertEqual(Order.objects.get(id=expired.id).status, 'canceled')
+        self.assertEqual(Order.objects.get(id=current.id).status, 'new')
+        self.assertEqual(self.quantity(), 8)
+
+    def test_import_keeps_reserved_stock(self):
+        self.checkout(4)
+        self.item['price'] += 1
+        self.run_import(price_list([self.item]))
+
+        self.assertEqual(self.quantity(), 6)
+
+    def test_checkout_between_staging_and_publish(self):
+        self.item['price'] += 1
+        importer = PriceListImporter(self.supplier.id)
+        importer.apply_items(importer.iter_goods(price_list([self.item])))
+        self.checkout(4)
+        importer.publish()
+
+        info = ProductInfo.objects.get(id=self.info.id)
+        self.assertEqual((info.quantity, info.price), (6, self.item['price']))
+
+
+class BasketBulkTest(ImportTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.run_import(price_list([good(1, price=100), good(2, price=200), good(3, price=300)]))
+        self.infos = dict(ProductInfo.objects.values_list('external_id', 'id'))
+        self.buyer = User.objects.create_user('buyer@example.com', username='buyer')
+        self.client = APIClient()
+        self.client.force_authenticate(self.buyer)
+
+    def post(self, *lines):
+        return self.client.post('/api/v1/basket/bulk', {'items': list(lines)}, format='json').json()
+
+    def line(self, number, quantity):
+        return {'product_info': self.infos[number], 'quantity': quantity}
+
+    def test_created_updated_deleted(self):
+        response = self.post(self.line(1, 2), self.line(2, 1))
+        self.assertTrue(response['Status'])
+        self.assertEqual([result['Action'] for result in response['Results']], ['created', 'created'])
+
+        response = self.post(self.line(1, 3), self.line(2, 0), self.line(3, 0))
+        self.assertTrue(response['Status'])
+        self.assertEqual([result['Action'] for result in response['Results']], ['updated', 'deleted', 'skipped'])
+
+        basket = Order.objects.get(user=self.buyer, status='basket')
+        self.assertEqual(list(basket.ordered_items.values_list('product_info_id', 'quantity')), [(self.infos[1], 3)])
+        self.assertEqual((basket.total_quantity, basket.total_sum), (3, 300))
+
+    def test_invalid_lines(self):
+        response = self.post(self.line(1, 2), self.line(2, -1), self.line(2, 10 ** 12), {'product_info': 'x'},
+                             self.line(1, 5), {'product_info': 0, 'quantity': 1}, self.line(3, 1))
+        self.assertFalse(response['Status'])
+        self.assertEqual([result['Status'] for result in response['Results']],
+                         [True, False, False, False, False, False, True])
+        self.assertIn('1000', response['Results'][2]['Errors'])
+        self.assertEqual(response['Results'][5]['Errors'], 'Товар не найден')
+
+        # верные строки сохраняются, ошибочные не влияют на итоги корзины
+        basket = Order.objects.get(user=self.buyer, status='basket')
+        self.assertEqual((basket.total_quantity, basket.total_sum), (3, 500))
+
+    def test_bad_request(self):
+        self.assertEqual(self.client.post('/api/v1/basket/bulk', {'items': []}, format='json').status_code, 400)
+        self.assertEqual(APIClient().post('/api/v1/basket/bulk', {'items': [self.line(1, 1)]},
+                                          format='json').status_code, 403)
+
+
+class NameResolverTest(ImportTestCase):
+
+    def test_resolve_creates_missing(self):
+        existing = Category.objects.create(name='Смартфоны')
+        ids = category_resolver.resolve(['Смартфоны', 'Аксессуары'])
+
+        self.assertEqual(ids['Смартфоны'], existing.id)
+        self.assertEqual(ids['Аксессуары'], Category.objects.get(name='Аксессуары').id)
+
+    def test_name_created_concurrently(self):
+        # параллельный импорт создал запись между поиском и вставкой
+        other = Category.objects.create(name='Смартфоны')
+        with mock.patch.object(category_resolver, '_fetch', side_effect=[{}, {'Смартфоны': other.id}]):
+            ids = category_resolver.resolve(['Смартфоны'])
+
+        self.assertEqual(ids, {'Смартфоны': other.id})
+        self.assertEqual(Category.objects.filter(name='Смартфоны').count(), 1)
+
+    def test_product_created_concurrently(self):
+        category = Category.objects.create(name='Смартфоны')
+        Product.objects.create(name='Товар 1', category=category)
+        importer = PriceListImporter(self.supplier.id, category_ids={1: category.id})
+        found = Product.objects.filter(name__in=['Товар 1'])
+        # параллельный импорт создал продукт между поиском и вставкой
+        with mock.patch.object(Product.objects, 'filter', side_effect=[Product.objects.none(), found]):
+            products = importer.resolve_products([good(1)])
+
+        self.assertEqual(products, {('Товар 1', category.id): Product.objects.get().id})
+
+
+class PartnerUpdateTest(TestCase):
+
+    def setUp(self):
+        self.supplier = User.objects.create_user('shop@example.com', username='shop', type='shop')
+        self.client = APIClient()
+        self.client.force_authenticate(self.supplier)
+        resolver = resolve_to('93.184.216.34')
+        resolver.start()
+        self.addCleanup(resolver.stop)
+
+    def upload(self):
+        return self.client.post('/api/v1/partner/update', {'url': 'https://example.com/price.yaml'})
+
+    def test_second_upload_conflicts(self):
+        self.assertEqual(self.upload().status_code, 202)
+        self.assertEqual(self.upload().status_code, 409)
+        self.assertEqual(ImportJob.objects.count(), 1)
+
+    def test_finished_or_stale_job_does_not_block(self):
+        self.upload()
+        ImportJob.objects.update(status='done')
+        self.assertEqual(self.upload().status_code, 202)
+
+        ImportJob.objects.update(created_at=timezone.now() - timedelta(days=1))
+        self.assertEqual(self.upload().status_code, 202)
+
+    def test_private_url_is_rejected(self):
+        with resolve_to('10.0.0.5'):
+            response = self.upload()
+
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(ImportJob.objects.exists())
+
+    def test_scheduler_skips_supplier_with_active_upload(self):
+        Shop.objects.create(name='Связной', user=self.supplier, price_url='https://example.com/price.yaml',
+                            refresh_interval=60, next_refresh_at=timezone.now())
+        self.upload()
+
+        self.assertEqual(schedule_price_refreshes(), 0)
+        self.assertEqual(ImportJob.objects.count(), 1)
+
+    def test_schedule_without_shop(self):
+        self.assertEqual(self.client.get('/api/v1/partner/schedule').status_code, 404)
+        self.assertEqual(self.client.post('/api/v1/partner/schedule', {'refresh_interval': 60}).status_code, 404)
+        self.assertEqual(self.client.get('/api/v1/partner/state').status_code, 404)
+
+    def test_schedule(self):
+        shop = Shop.objects.create(name='Связной', user=self.supplier, next_refresh_at=timezone.now())
+        response = self.client.post('/api/v1/partner/schedule', {'price_url': 'https://example.com/price.yaml',
+                                                                 'refresh_interval': 60})
+        self.assertEqual(response.status_code, 200)
+
+        shop.refresh_from_db()
+        self.assertEqual((shop.refresh_interval, shop.next_refresh_at), (60, None))
+        self.assertEqual(self.client.get('/api/v1/partner/schedule').json()['price_url'], shop.price_url)
+
+
+class OutboxTest(TestCase):
+
+    def test_abandoned_claim_is_requeued(self):
+        now = timezone.now()
+        abandoned = OutgoingEmail.objects.create(subject='Заказ', body='Заказ сформирован', to='buyer@example.com',
+                                                 status='sending',
+                                                 claimed_at=now - timedelta(seconds=OUTBOX_CLAIM_TIMEOUT + 1))
+        # письмо только что взял другой воркер
+        claimed = OutgoingEmail.objects.create(subject='Заказ', body='Заказ сформирован', to='other@example.com',
+                                               status='sending', claimed_at=now)
+
+        self.assertEqual(send_outbox.apply().get(), 1)
+        self.assertEqual([message.to for message in mail.outbox], [['buyer@example.com']])
+        abandoned.refresh_from_db()
+        claimed.refresh_from_db()
+        self.assertEqual((abandoned.status, abandoned.attempts), ('sent', 1))
+        self.assertEqual(claimed.status, 'sending')
+
+
+class SalesReportTest(TestCase):
+
+    def test_report_for_previous_day(self):
+        shop, order = create_sample_order(3, 0)
+        canceled = Order.objects.create(user=order.user, contact=order.contact, status='canceled')
+        OrderShopTotal.objects.create(order=canceled, shop=shop, total_quantity=1, total_sum=100)
+        Order.objects.update(dt=timezone.now() - timedelta(days=1))
+
+        with mock.patch('shop.tasks.replica_reads', wraps=replica_reads) as reads:
+            self.assertEqual(send_sales_reports.apply().get(), 1)
+        self.assertTrue(reads.called)
+        email = OutgoingEmail.objects.get()
+        self.assertEqual(email.to, shop.user.email)
+        self.assertIn('заказов 1, товаров 3, на сумму 300', email.body)
+
+        self.assertEqual(send_sales_reports.apply(kwargs={'day': timezone.localdate().isoformat()}).get(), 0)
+
+
+class ReplicaPinTest(TransactionTestCase):
+    """
+    Вне транзакции теста роутер действительно выбирает реплику
+    """
+
+    def setUp(self):
+        self.supplier = User.objects.create_user('shop@example.com', username='shop', type='shop')
+        cache.delete(pin_key(self.supplier.id))
+        self.client = APIClient()
+        self.client.force_authenticate(self.supplier)
+
+    def test_reads_stay_on_primary_after_write(self):
+        with mock.patch('shop.routers.REPLICAS', ['replica']), \
+                mock.patch('shop.routers.choose_replica', return_value='default') as choose:
+            self.assertEqual(self.client.get('/api/v1/partner/orders').status_code, 200)
+            self.assertTrue(choose.called)
+            self.assertFalse(is_pinned(self.supplier))
+
+            self.client.post('/api/v1/partner/state', {'state': 'off'})
+            self.assertTrue(is_pinned(self.supplier))
+            choose.reset_mock()
+            self.assertEqual(self.client.get('/api/v1/partner/orders').status_code, 200)
+            self.assertFalse(choose.called)
+
+        cache.delete(pin_key(self.supplier.id))
+        self.assertFalse(is_pinned(self.supplier))
+
+
+class CatalogChangesTest(TestCase):
+
+    def test_horizon_survives_cache_loss(self):
+        self.addCleanup(cache.delete, HORIZON_KEY)
+        record_changes(upserted=[1], deleted=[2, 3])
+        CatalogChange.objects.filter(action='delete').update(
+            created_at=timezone.now() - timedelta(seconds=RETENTION + 1))
+        last = CatalogChange.objects.latest('id').id
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(compact(), 2)
+
+        cache.delete(HORIZON_KEY)
+        self.assertEqual(horizon(), last)
+        response = APIClient().get('/api/v1/products/changes/', {'since': last - 1})
+        self.assertTrue(response.json()['resync'])
+
+
+class AdminReindexTest(ImportTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.run_import(price_list([good(1, color='красный')]))
+        self.info = ProductInfo.objects.get()
+        admin = User.objects.create_superuser('admin@example.com', 'password', username='admin')
+        self.client.force_login(admin)
+
+    def terms(self):
+        return set(SearchTerm.objects.filter(product_info=self.info).values_list('term', flat=True))
+
+    def change(self, instance, **values):
+        data = {name: value for name, value in model_to_dict(instance).items() if value is not None}
+        data.update(values)
+        opts = instance._meta
+        response = self.client.post(f'/admin/shop/{opts.model_name}/{instance.pk}/change/', data)
+        self.assertEqual(response.status_code, 302)
+
+    def test_edits_update_search_terms(self):
+        parameter = ProductParameter.objects.get()
+        self.assertIn(f'p:{parameter.parameter_id}:красный', self.terms())
+
+        self.change(self.info, model='nokia-3310')
+        self.change(self.info.product, name='Телефон')
+        self.change(parameter, value='синий')
+
+        terms = self.terms()
+        self.assertTrue({'w:nokia', 'w:3310', 'w:телефон', f'p:{parameter.parameter_id}:синий'} <= terms)
+        self.assertFalse({'w:model', 'w:товар', f'p:{parameter.parameter_id}:красный'} & terms)
+
+        self.client.post(f'/admin/shop/productparameter/{parameter.id}/delete/', {'post': 'yes'})
+        self.assertFalse([term for term in self.terms() if term.startswith('p:')])
+
+
+class FastPayloadTest(TestCase):
+
+    def test_payloads_match_serializers(self):
+        shop, order = create_sample_order(12, 4)
+
+        for name, reference, fast in rendering_cases(shop, order, 12):
+            with self.subTest(name):
+                self.assertEqual(fast(), reference())
+
+
+class SparseFieldsTest(ImportTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.run_import(price_list([good(1, color='белый'), good(2, color='чёрный')]))
+        self.client = APIClient()
+
+    def get(self, path):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(path)
+        return response, ' '.join(query['sql'] for query in queries)
+
+    def test_products_fields_and_expand(self):
+        response, sql = self.get('/api/v1/products/')
+        row = response.json()['results'][0]
+        self.assertEqual(row['product'], {'name': 'Товар 1', 'category': 'Смартфоны'})
+        self.assertEqual(row['product_parameters'], [{'parameter': 'color', 'value': 'белый'}])
+        self.assertIn('shop_productparameter', sql)
+
+        # ненужные связи не читаются из базы
+        response, sql = self.get('/api/v1/products/?fields=id,price,product&expand=')
+        product_id = ProductInfo.objects.get(id=row['id']).product_id
+        self.assertEqual(response.json()['results'][0], {'id': row['id'], 'price': 1000, 'product': product_id})
+        self.assertNotIn('shop_productparameter', sql)
+        self.assertNotIn('shop_category', sql)
+
+        response, sql = self.get('/api/v1/products/?fields=id,product.name&expand=product')
+        self.assertEqual(response.json()['results'][0], {'id': row['id'], 'product': {'name': 'Товар 1'}})
+        self.assertNotIn('shop_category', sql)
+
+    def test_unknown_field(self):
+        response = self.client.get('/api/v1/products/?fields=id,colour&expand=shop')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('colour, shop', response.json()['detail'])
+
+    def test_basket_fields(self):
+        buyer = User.objects.create_user('buyer@example.com', username='buyer')
+        basket = Order.objects.create(user=buyer, status='basket')
+        info = ProductInfo.objects.get(external_id=1)
+        OrderItem.objects.create(order=basket, product_info=info, quantity=2, price=info.price)
+        self.client.force_authenticate(buyer)
+
+        response, _ = self.get('/api/v1/basket?fields=id,total_sum,ordered_items.quantity')
+        self.assertEqual(response.json(), [{'id': basket.id, 'total_sum': 2000, 'ordered_items': [{'quantity': 2}]}])
+
+        response, sql = self.get('/api/v1/basket?fields=ordered_items.product_info&expand=')
+        self.assertEqual(response.json(), [{'ordered_items': [{'product_info': info.id}]}])
+        self.assertNotIn('shop_productparameter', sql)
+
+
+class ConditionalGetTest(ImportTestCase):
+
+    def set_stamp(self, value, resource='categories'):
+        cache.set(f'stamp:{resource}', value, timeout=None)
+        self.assertEqual(stamp(resource), value)
+
+    def test_last_modified_only_after_its_second(self):
+        client = APIClient()
+        now = time.time()
+        self.set_stamp(now)
+        response = client.get('/api/v1/categories/')
+        self.assertNotIn('Last-Modified', response)
+        # изменение в ту же секунду не должно дать 304 по If-Modified-Since
+        response = client.get('/api/v1/categories/', HTTP_IF_MODIFIED_SINCE=http_date(now))
+        self.assertEqual(response.status_code, 200)
+
+        self.set_stamp(now - 5)
+        response = client.get('/api/v1/categories/')
+        self.assertEqual(response['Last-Modified'], http_date(now - 5))
+        response = client.get('/api/v1/categories/', HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_etag_is_authoritative(self):
+        client = APIClient()
+        self.set_stamp(time.time() - 5)
+        etag = client.get('/api/v1/categories/')['ETag']
+        self.assertEqual(client.get('/api/v1/categories/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        self.set_stamp(time.time() - 4)
+        response = client.get('/api/v1/categories/', HTTP_IF_NONE_MATCH=etag,
+                              HTTP_IF_MODIFIED_SINCE=http_date(time.time()))
+        self.assertEqual(response.status_code, 200)
+
+    def test_writes_bump_stamps(self):
+        partner = APIClient()
+        partner.force_authenticate(self.supplier)
+        writes = (
+            ('categories', lambda: Category.objects.create(name='Аксессуары')),
+            ('shops', lambda: partner.post('/api/v1/partner/state', {'state': 'off'})),
+            ('products', lambda: self.run_import(price_list([good(1)]))),
+        )
+        client = APIClient()
+        for resource, write in writes:
+            with self.subTest(resource):
+                path = f'/api/v1/{resource}/'
+                self.set_stamp(time.time() - 5, resource)
+                response = client.get(path)
+                validators = {'HTTP_IF_NONE_MATCH': response['ETag'],
+                              'HTTP_IF_MODIFIED_SINCE': response['Last-Modified']}
+                self.assertEqual(client.get(path, **validators).status_code, 304)
+
+                # лента изменений отмечает позиции после фиксации транзакции
+                with self.captureOnCommitCallbacks(execute=True):
+                    write()
+                response = client.get(path, **validators)
+                self.assertEqual(response.status_code, 200)
+                self.assertNotEqual(response['ETag'], validators['HTTP_IF_NONE_MATCH'])
+
+
+class SearchCacheTest(ImportTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.run_import(price_list([good(1), good(2)]))
+        self.client = APIClient()
+
+    def search(self):
+        response = self.client.get('/api/v1/products/search/?q=товар&fields=id,price&expand=')
+        return sorted(row['price'] for row in response.json()['results'])
+
+    def test_shop_state_resets_cached_pages(self):
+        self.assertEqual(self.search(), [1000, 1000])
+        partner = APIClient()
+        partner.force_authenticate(self.supplier)
+        partner.post('/api/v1/partner/state', {'state': 'off'})
+        self.assertEqual(self.search(), [])
+
+        shop = Shop.objects.get()
+        shop.state = True
+        shop.save()
+        self.assertEqual(self.search(), [1000, 1000])
+
+    def test_catalog_update_resets_cached_pages(self):
+        self.assertEqual(self.search(), [1000, 1000])
+        self.run_import(price_list([good(1, price=900)]))
+        self.assertEqual(self.search(), [900])
+
+
+class PublishedInfosTest(TestCase):
+
+    def test_versions_joined_in_same_query(self):
+        user = User.objects.create_user('shop@example.com', username='shop', type='shop')
+        shop = Shop.objects.create(name='Связной', user=user, catalog_version=1)
+        category = Category.objects.create(name='Смартфоны')
+        product = Product.objects.create(name='Товар', category=category)
+        for version in (1, 2):
+            ProductInfo.objects.create(shop=shop, product=product, external_id=version, version=version, model='m',
+                                       quantity=1, price=1, price_rrc=1)
+
+        # версия и статус магазина читаются соединением с Shop, из той же базы, что и позиции
+        query = str(published_infos().query)
+        self.assertIn('"shop_shop"."catalog_version"', query)
+        self.assertIn('"shop_shop"."state"', query)
+        self.assertEqual(list(published_infos().values_list('external_id', flat=True)), [1])
+        Shop.objects.filter(id=shop.id).update(state=False)
+        self.assertFalse(published_infos().exists())
+
+    def test_many_shops(self):
+        Shop.objects.bulk_create([Shop(name=f'Магазин {number}') for number in range(1200)])
+        self.assertEqual(published_infos().count(), 0)
+
+
+class PriceHandler(BaseHTTPRequestHandler):
+    """
+    Сервер прайсов поставщика: /price.yaml с ETag и перенаправление на него с /latest
+    """
+    body = b''
+    requests = 0
+
+    def do_GET(self):
+        type(self).requests += 1
+        if self.path == '/latest':
+            self.send_response(302)
+            self.send_header('Location', '/price.yaml')
+            self.end_headers()
+        elif self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+        else:
+            self.send_response(200)
+            self.send_header('ETag', '"v1"')
+            self.send_header('Content-Length', str(len(self.body)))
+            self.end_headers()
+            self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FetchPriceListTest(ImportTestCase):
+
+    def setUp(self):
+        super().setUp()
+        PriceHandler.body = price_list([good(1), good(2)]).getvalue()
+        PriceHandler.requests = 0
+        server = ThreadingHTTPServer(('127.0.0.1', 0), PriceHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.url = f'http://127.0.0.1:{server.server_port}'
+
+        self.location = tempfile.TemporaryDirectory()
+        self.addCleanup(self.location.cleanup)
+        for patcher in (mock.patch.object(storage, 'location', self.location.name),
+                        mock.patch('shop.fetcher.ALLOW_PRIVATE', True)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def stored_files(self):
+        return os.listdir(self.location.name)
+
+    def test_conditional_download(self):
+        source = get_source(self.supplier.id, f'{self.url}/price.yaml')
+        file_name = fetch_price_list(source)
+
+        with storage.open(file_name, 'rb') as stream:
+            self.assertEqual(stream.read(), PriceHandler.body)
+        self.assertEqual(source.etag, '"v1"')
+        storage.delete(file_name)
+        # сервер ответил 304, файл не скачивается
+        self.assertIsNone(fetch_price_list(source))
+        self.assertEqual(self.stored_files(), [])
+
+    def test_redirect_target_is_checked(self):
+        source = get_source(self.supplier.id, f'{self.url}/latest')
+        with mock.patch('shop.fetcher.check_url', wraps=check_url) as checked:
+            self.assertTrue(fetch_price_list(source))
+
+        self.assertEqual([call.args[0] for call in checked.call_args_list],
+                         [f'{self.url}/latest', f'{self.url}/price.yaml'])
+
+    def test_oversized_download_is_discarded(self):
+        source = get_source(self.supplier.id, f'{self.url}/price.yaml')
+        with mock.patch('shop.fetcher.MAX_SIZE', 10), self.assertRaisesMessage(PriceFetchError, 'больше 10 байт'):
+            fetch_price_list(source)
+        self.assertEqual(self.stored_files(), [])
+
+        # сервер не прислал Content-Length или сжал ответ: размер считается по прочитанному
+        with mock.patch('shop.fetcher.MAX_SIZE', 10), mock.patch.object(PriceHandler, 'send_header'), \
+                self.assertRaises(PriceFetchError):
+            fetch_price_list(source)
+        self.assertEqual(self.stored_files(), [])
+
+    def test_private_address_is_rejected(self):
+        source = get_source(self.supplier.id, f'{self.url}/price.yaml')
+        with mock.patch('shop.fetcher.ALLOW_PRIVATE', False):
+            with self.assertRaisesMessage(PriceFetchError, 'недоступен для загрузки прайса'):
+                fetch_price_list(source)
+            self.assertEqual(PriceHandler.requests, 0)
+
+            with resolve_to('93.184.216.34'):
+                check_url('https://example.com/price.yaml')
+            for address in ('169.254.169.254', '::1', '::ffff:10.0.0.1'):
+                with self.subTest(address), resolve_to(address), self.assertRaises(PriceFetchError):
+                    check_url('https://example.com/price.yaml')
+
+    def test_import_removes_file(self):
+        job = ImportJob.objects.create(user=self.supplier, url=f'{self.url}/price.yaml')
+        import_shop_data(job.id)
+
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.file_name.name), ('done', ''))
+        self.assertEqual(ProductInfo.objects.count(), 2)
+        self.assertEqual(self.stored_files(), [])
+
+    def test_failed_import_removes_file(self):
+        PriceHandler.body = price_list([good(1, category=2)]).getvalue()
+        job = ImportJob.objects.create(user=self.supplier, url=f'{self.url}/price.yaml')
+        with self.assertRaises(PriceListError):
+            import_shop_data(job.id)
+
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.file_name.name), ('failed', ''))
+        self.assertEqual(self.stored_files(), [])
+
+    def test_scheduled_refresh_removes_file(self):
+        Shop.objects.create(name='Связной', user=self.supplier, price_url=f'{self.url}/price.yaml',
+                            refresh_interval=60, next_refresh_at=timezone.now())
+        # задача загрузки выполняется здесь же, без брокера
+        with mock.patch.object(import_shop_data, 'delay', side_effect=lambda *args: import_shop_data.apply(args)), \
+                self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(schedule_price_refreshes(), 1)
+
+        self.assertEqual(ImportJob.objects.get().status, 'done')
+        self.assertEqual(self.stored_files(), [])
+
+    def test_purge_leftover_files(self):
+        old = time.time() - STALE_AFTER - 1
+        for name in ('crashed.yaml', 'running.yaml', 'orphan.yaml', 'uploading.yaml'):
+            storage.save(name, io.BytesIO(b'shop: x'))
+        for name in ('crashed.yaml', 'orphan.yaml'):
+            os.utime(storage.path(name), (old, old))
+        # воркер упал посреди загрузки
+        ImportJob.objects.create(user=self.supplier, file_name='crashed.yaml', status='running')
+        ImportJob.objects.update(created_at=timezone.now() - timedelta(seconds=STALE_AFTER + 1))
+        ImportJob.objects.create(user=self.supplier, file_name='running.yaml', status='running')
+
+        self.assertEqual(purge_price_files(), 2)
+        self.assertEqual(sorted(self.stored_files()), ['running.yaml', 'uploading.yaml'])
+        self.assertEqual(ImportJob.objects.get(status='running', file_name='').id,
+                         ImportJob.objects.order_by('id').first().id)
+
+
+class SyntheticDataTest(ImportTestCase):
+
+    def test_goods_are_deterministic(self):
+        goods = list(iter_goods(30, 2, shop=1))
+        self.assertEqual(goods, list(iter_goods(30, 2, shop=1)))
+
+        # следующая ревизия меняет только цену каждого десятого товара
+        revised = iter_goods(30, 2, shop=1, revision=1)
+        changed = [(old['id'], new['price'] - old['price']) for old, new in zip(goods, revised) if old != new]
+        self.assertEqual(changed, [(0, 1), (10, 1), (20, 1)])
+
+    def test_price_list_formats_read_back(self):
+        goods = list(iter_goods(15, 3))
+        with tempfile.TemporaryDirectory() as directory:
+            for name in ('price.yaml', 'price.json', 'price.jsonl', 'price.csv', 'price.yaml.gz', 'price.jsonl.gz'):
+                with self.subTest(name), open(write_price_list(os.path.join(directory, name), goods), 'rb') as stream:
+                    records = list(iter_price_list(stream))
+
+                    self.assertEqual(records[0], ('shop', 'Bench'))
+                    read = [value for section, value in records if section == 'goods']
+                    # в CSV категория указывается названием
+                    expected = [dict(item, category=f'Категория {item["category"]}') for item in goods] \
+                        if name == 'price.csv' else goods
+                    self.assertEqual(read, expected)
+
+    def test_repeated_runs_reuse_data(self):
+        suppliers = create_suppliers(2)
+        self.assertEqual(create_suppliers(2), suppliers)
+        with tempfile.TemporaryDirectory() as directory:
+            path = write_price_list(os.path.join(directory, 'price.yaml'), iter_goods(20, 2))
+            with open(path, 'rb') as stream:
+                PriceListImporter(suppliers[0].id).run(stream)
+
+        buyers = create_buyers(2)
+        self.assertEqual(create_orders(buyers, 2, 3), 4)
+        self.assertEqual(create_buyers(2), buyers)
+        self.assertEqual(create_orders(buyers, 2, 3), 4)
+
+        # корзина у покупателя одна, суммы заказов сходятся с позициями
+        self.assertEqual(Order.objects.filter(status='basket').count(), 2)
+        self.assertEqual(Order.objects.filter(status='new').count(), 8)
+        for order in Order.objects.prefetch_related('ordered_items'):
+            self.assertEqual(order.total_sum, sum(item.total_amount for item in order.ordered_items.all()))
+
+
+class QueryBudgetTest(QueryBudgetMixin, ImportTestCase):
+    """
+    Представления укладываются в объявленный query_budget. Данных больше, чем позиций
+    на странице, поэтому N+1 выводит запрос за бюджет
+    """
+    client_class = APIClient
+
+    def setUp(self):
+        super().setUp()
+        self.suppliers = create_suppliers(2)
+        with tempfile.TemporaryDirectory() as directory:
+            for number, supplier in enumerate(self.suppliers):
+                path = write_price_list(os.path.join(directory, f'shop{number}.yaml'),
+                                        iter_goods(100, 5, shop=number), shop_name=f'Bench {number}')
+                with open(path, 'rb') as stream:
+                    PriceListImporter(supplier.id).run(stream)
+        self.buyers = create_buyers(2)
+        create_orders(self.buyers, orders=5, items=10)
+
+    def test_transaction_control_is_not_counted(self):
+        with track_queries() as stats:
+            for _ in range(3):
+                with transaction.atomic():
+                    Category.objects.count()
+
+        self.assertEqual(stats.count, 3)
+        self.assertEqual([sql.split()[0] for sql in stats.samples.values()], ['SELECT'])
+
+    def test_views_within_budget(self):
+        buyer, supplier = self.buyers[0], self.suppliers[0]
+        info = ProductInfo.objects.first()
+        contact = Contact.objects.filter(user=buyer).first()
+        requests = (
+            (None, 'get', '/api/v1/categories/', {}),
+            (None, 'get', '/api/v1/shops/', {}),
+            (None, 'get', '/api/v1/products/', {}),
+            (None, 'get', '/api/v1/products/?fields=id,price&expand=', {}),
+            (None, 'get', f'/api/v1/products/{info.id}/', {}),
+            (None, 'get', '/api/v1/products/search/?q=товар', {}),
+            (None, 'get', '/api/v1/products/facets/?q=товар', {}),
+            (None, 'get', '/api/v1/products/changes/?since=0', {}),
+            (buyer, 'get', '/api/v1/basket', {}),
+            (buyer, 'get', '/api/v1/order', {}),
+            (buyer, 'get', '/api/v1/user/details', {}),
+            (buyer, 'get', '/api/v1/user/contact', {}),
+            (buyer, 'put', '/api/v1/user/contact', {'data': {'id': str(contact.id), 'city': 'Казань'}}),
+            (supplier, 'get', '/api/v1/partner/orders', {}),
+            (supplier, 'get', '/api/v1/partner/state', {}),
+            (supplier, 'get', '/api/v1/partner/schedule', {}),
+        )
+        for user, method, path, kwargs in requests:
+            with self.subTest(f'{method.upper()} {path}'):
+                self.client.force_authenticate(user)
+                response = self.assertQueryBudget(method, path, **kwargs)
+                self.assertLess(response.status_code, 400)
+
+    def test_admin_pages_without_n_plus_one(self):
+        admin = User.objects.create_superuser('admin@example.com', 'password', username='admin')
+        self.client.force_login(admin)
+        item = OrderItem.objects.first()
+        for path in ('/admin/shop/shop/', '/admin/shop/productinfo/', '/admin/shop/productparameter/',
+                     '/admin/shop/order/', '/admin/shop/orderitem/', '/admin/shop/productinfo/add/',
+                     f'/admin/shop/orderitem/{item.id}/change/'):
+            with self.subTest(path), CaptureQueriesContext(connection) as queries:
+                response = self.client.get(path)
+                self.assertEqual(response.status_code, 200)
+                # строк и вариантов выбора больше сотни, запрос на строку вышел бы за предел
+                self.assertLess(len(queries), 20)
+
+
+class PartnerOrdersExportTest(TestCase):
+
+    def setUp(self):
+        shop, self.order = create_sample_order(6, 2)
+        self.client = APIClient()
+        self.client.force_authenticate(shop.user)
+        # старый доставленный заказ для проверки фильтров
+        self.delivered = Order.objects.create(user=self.order.user, contact=self.order.contact, status='delivered')
+        OrderItem.objects.create(order=self.delivered, product_info=ProductInfo.objects.first(), quantity=2, price=100)
+        Order.objects.filter(id=self.delivered.id).update(dt=timezone.now().replace(year=2020, month=1, day=15))
+
+    def export(self, **params):
+        response = self.client.get('/api/v1/partner/orders/export', params)
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content)
+
+    def exported_orders(self, **params):
+        rows = list(csv.DictReader(io.StringIO(self.export(**params).decode())))
+        return sorted({int(row['order']) for row in rows})
+
+    def test_csv(self):
+        rows = list(csv.reader(io.StringIO(self.export(file_format='csv').decode())))
+
+        self.assertEqual(rows[0], HEADER)
+        self.assertEqual(len(rows), 1 + 6 + 1)
+        self.assertIn('перевод\nстроки\tи\x01управляющие', {row[HEADER.index('product')] for row in rows})
+
+    def test_jsonl(self):
+        # записи разделяет только \n, а U+2028 в строках допустим
+        rows = [ujson.loads(line) for line in self.export(file_format='jsonl').decode().split('\n') if line]
+
+        self.assertEqual(len(rows), 7)
+        self.assertEqual(set(rows[0]), set(HEADER))
+        self.assertEqual({row['order'] for row in rows}, {self.order.id, self.delivered.id})
+
+    def test_xlsx_strips_control_characters(self):
+        import openpyxl
+
+        sheet = openpyxl.load_workbook(io.BytesIO(self.export(file_format='xlsx'))).active
+        rows = list(sheet.values)
+
+        self.assertEqual(list(rows[0]), HEADER)
+        self.assertEqual(len(rows), 8)
+        self.assertIn('перевод\nстроки\tиуправляющие', {row[HEADER.index('product')] for row in rows})
+
+    def test_filters(self):
+        self.assertEqual(self.exported_orders(), sorted([self.order.id, self.delivered.id]))
+        self.assertEqual(self.exported_orders(status='delivered'), [self.delivered.id])
+        self.assertEqual(self.exported_orders(date_to='2020-01-31'), [self.delivered.id])
+        self.assertEqual(self.exported_orders(date_from='2021-01-01'), [self.order.id])
+
+        for params in ({'date_from': '2021-13-01'}, {'date_to': 'вчера'}, {'file_format': 'xml'}):
+            with self.subTest(params):
+                response = self.client.get('/api/v1/partner/orders/export', params)
+                self.assertEqual(response.status_code, 400)
@@ -0,0 +1,76 @@
+"""
+Ограничение частоты запросов с общими для всех процессов счётчиками в Redis.
+
+Используется алгоритм GCRA (вариант token bucket): на каждый ключ хранится
+одно число - теоретическое время следующего запроса. Проверка и обновление
+выполняются одним Lua-скриптом атомарно, за один запрос к Redis; время берётся
+у Redis, поэтому расхождение часов между серверами не влияет на лимиты.
+"""
+from django_redis import get_redis_connection
+from rest_framework.throttling import AnonRateThrottle, ScopedRateThrottle, UserRateThrottle
+
+# KEYS[1] - ключ, ARGV[1] - интервал между запросами, ARGV[2] - допустимый всплеск, в микросекундах.
+# Возвращает 0 или время ожидания в микросекундах
+GCRA_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000000 + tonumber(time[2])
+local interval = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local tat = tonumber(redis.call('GET', KEYS[1]) or now)
+if tat < now then
+    tat = now
+end
+local new_tat = tat + interval
+local wait = new_tat - burst - now
+if wait > 0 then
+    return wait
+end
+redis.call('SET', KEYS[1], string.format('%d', new_tat), 'PX', math.ceil((new_tat - now) / 1000))
+return 0
+"""
+
+
+class RedisThrottleMixin:
+    """
+    Заменяет хранение списка отметок времени в кэше на счётчик GCRA в Redis.
+
+    За период duration пропускается num_requests запросов, в том числе
+    подряд; дальше - равномерно, по одному за duration / num_requests.
+    """
+    connection_alias = 'default'
+    cache_format = 'throttle:%(scope)s:%(ident)s'
+    _script = None
+
+    @classmethod
+    def get_script(cls):
+        # register_script сам переходит с EVALSHA на EVAL, если скрипта ещё нет в Redis
+        if RedisThrottleMixin._script is None:
+            RedisThrottleMixin._script = get_redis_connection(cls.connection_alias).register_script(GCRA_SCRIPT)
+        return RedisThrottleMixin._script
+
+    def allow_request(self, request, view):
+        if self.rate is None:
+            return True
+
+        self.key = self.get_cache_key(request, view)
+        if self.key is None:
+            return True
+
+        interval = self.duration * 1000000 // self.num_requests
+        self.wait_time = self.get_script()(keys=[self.key], args=[interval, self.duration * 1000000]) / 1000000
+        return self.wait_time == 0
+
+    def wait(self):
+        return self.wait_time
+
+
+class RedisAnonRateThrottle(RedisThrottleMixin, AnonRateThrottle):
+    pass
+
+
+class RedisUserRateThrottle(RedisThrottleMixin, UserRateThrottle):
+    pass
+
+
+class RedisScopedRateThrottle(RedisThrottleMixin, ScopedRateThrottle):
+    pass
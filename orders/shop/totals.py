@@ -0,0 +1,65 @@
+"""
+Итоги заказов: общее количество и стоимость заказа и подытоги по магазинам.
+
+Итоги хранятся в Order и OrderShopTotal и пересчитываются при любом
+изменении позиций заказа, поэтому чтение заказа не требует агрегации.
+"""
+from contextlib import contextmanager
+from threading import local
+
+from django.db.models import OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+from .models import Order, OrderItem, OrderShopTotal
+
+_state = local()
+
+
+def update_order_totals(order_ids):
+    """
+    Пересчитывает итоги указанных заказов по их позициям
+    """
+    order_ids = set(order_ids)
+    if not order_ids:
+        return
+
+    items = OrderItem.objects.filter(order_id=OuterRef('pk')).order_by().values('order_id')
+    Order.objects.filter(id__in=order_ids).update(
+        total_quantity=Coalesce(Subquery(items.annotate(total=Sum('quantity')).values('total')), 0),
+        total_sum=Coalesce(Subquery(items.annotate(total=Sum('total_amount')).values('total')), 0))
+
+    OrderShopTotal.objects.filter(order_id__in=order_ids).delete()
+    OrderShopTotal.objects.bulk_create([
+        OrderShopTotal(order_id=row['order_id'], shop_id=row['product_info__shop_id'],
+                       total_quantity=row['total_quantity'], total_sum=row['total_sum'])
+        for row in OrderItem.objects.filter(order_id__in=order_ids).order_by().values(
+            'order_id', 'product_info__shop_id').annotate(
+            total_quantity=Sum('quantity'), total_sum=Sum('total_amount'))
+    ])
+
+
+def order_items_changed(order_ids):
+    pending = getattr(_state, 'pending', None)
+    if pending is not None:
+        pending.update(order_ids)
+    else:
+        update_order_totals(order_ids)
+
+
+@contextmanager
+def batch_totals():
+    """
+    Откладывает пересчёт итогов до конца блока, чтобы массовые изменения
+    позиций пересчитывали каждый заказ один раз
+    """
+    if getattr(_state, 'pending', None) is not None:
+        yield
+        return
+
+    _state.pending = set()
+    try:
+        yield
+        order_ids = _state.pending
+    finally:
+        _state.pending = None
+    update_order_totals(order_ids)
@@ -4,7 +4,8 @@ from rest_framework import routers
 from rest_framework.urlpatterns import format_suffix_patterns
 
 from .views import CategoryView, ShopView, ProductInfoView, BasketView, OrderView, LoginAccount, ContactView, \
-    AccountDetails, ConfirmAccount, RegisterAccount, PartnerOrders, PartnerState, PartnerUpdate
+    AccountDetails, ConfirmAccount, RegisterAccount, PartnerOrders, PartnerState, PartnerUpdate, \
+    PartnerUpdateStatus, BasketBulkView, PartnerOrdersExport, LogoutAccount, PartnerSchedule, QueryMetricsView
 
 app_name = 'shop'
 
@@ -15,16 +16,22 @@ router.register(r'products', ProductInfoView, basename='products')
 
 urlpatterns = [
     path('partner/update', PartnerUpdate.as_view(), name='partner-update'),
+    path('partner/update/<int:job_id>', PartnerUpdateStatus.as_view(), name='partner-update-status'),
+    path('partner/schedule', PartnerSchedule.as_view(), name='partner-schedule'),
     path('partner/state', PartnerState.as_view(), name='partner-state'),
     path('partner/orders', PartnerOrders.as_view(), name='partner-orders'),
+    path('partner/orders/export', PartnerOrdersExport.as_view(), name='partner-orders-export'),
     path('user/register', RegisterAccount.as_view(), name='user-register'),
     path('user/register/confirm', ConfirmAccount.as_view(), name='user-register-confirm'),
     path('user/details', AccountDetails.as_view(), name='user-details'),
     path('user/contact', ContactView.as_view(), name='user-contact'),
     path('user/login', LoginAccount.as_view(), name='user-login'),
+    path('user/logout', LogoutAccount.as_view(), name='user-logout'),
     path('user/password_reset', reset_password_request_token, name='password-reset'),
     path('user/password_reset/confirm', reset_password_confirm, name='password-reset-confirm'),
+    path('metrics/queries', QueryMetricsView.as_view(), name='metrics-queries'),
     path('basket', BasketView.as_view(), name='basket'),
+    path('basket/bulk', BasketBulkView.as_view(), name='basket-bulk'),
     path('order', OrderView.as_view(), name='order'),
     path('', include(router.urls)),
 ]
@@ -1,28 +1,47 @@
+from operator import itemgetter
+
 from django.conf import settings
 from django.contrib.auth import authenticate
 from django.contrib.auth.password_validation import validate_password
-from django.db import IntegrityError
-from django.db.models import Q, Sum, F
-from django.db.models.query import Prefetch
-from django.http import JsonResponse
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.validators import URLValidator
+from django.db import IntegrityError, transaction
+from django.db.models import Q, F
+from django.http import FileResponse, JsonResponse, StreamingHttpResponse
+from django.utils.dateparse import parse_date
 
 from rest_framework import status, viewsets
+from rest_framework.decorators import action
+from rest_framework.renderers import BrowsableAPIRenderer
 from rest_framework.generics import ListAPIView
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.authtoken.models import Token
 
-from yaml import load as load_yaml, Loader
 from ujson import loads as load_json
 from distutils.util import strtobool
-from requests import get
 
-from shop.tasks import import_shop_data
-from .signals import new_user_registered
-from .models import Category, Shop, ProductInfo, Order, OrderItem, Product, ProductParameter, Parameter
-from auth_api.models import Contact, ConfirmEmailToken
-from .serializers import CategorySerializer, ShopSerializer, ProductInfoSerializer, OrderSerializer, \
-    OrderItemSerializer, UserSerializer, ContactSerializer
+from shop.tasks import queue_email, queue_import
+from .cache import CATALOG_CACHE_TIMEOUT, ConditionalGetMixin, catalog_page_key, invalidate_catalog, touch
+from .changes import CHANGES_MAX_LIMIT, horizon, record_changes
+from .exports import iter_csv, iter_jsonl, write_xlsx
+from .fetcher import PriceFetchError, check_url
+from .pagination import KeysetPagination
+from .payloads import OrderPayload, ProductInfoPayload, UJSONRenderer, order_payloads, product_info_payloads, \
+    product_info_values, read_payload
+from .reservations import OutOfStock, reserve_order
+from .queries import query_metrics
+from .references import category_cache, published_infos, shop_rows
+from .routers import ReplicaReadMixin
+from .search import facet_counts, filter_products
+from .totals import batch_totals, order_items_changed, update_order_totals
+from .models import Category, Shop, ProductInfo, Order, OrderItem, ImportJob, CatalogChange
+from auth_api.models import Contact, ConfirmEmailToken, User
+from .serializers import CategorySerializer, ShopSerializer, ProductInfoSerializer, OrderItemSerializer, \
+    UserSerializer, ContactSerializer, ImportJobSerializer, PriceRefreshSerializer
+
+BASKET_MAX_QUANTITY = getattr(settings, 'BASKET_MAX_QUANTITY', 1000)
 
 
 class RegisterAccount(APIView):
@@ -109,18 +128,36 @@ class LoginAccount(APIView):
                         status=status.HTTP_400_BAD_REQUEST)
 
 
+class LogoutAccount(APIView):
+    """
+    Класс для выхода пользователя: токен удаляется и перестаёт действовать
+    """
+    throttle_scope = 'user'
+
+    def post(self, request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return Response({'Status': False, 'Error': 'Log in required'}, status=status.HTTP_403_FORBIDDEN)
+
+        # удаление токена сбрасывает его из кэша аутентификации
+        for token in Token.objects.filter(user_id=request.user.id):
+            token.delete()
+        return Response({'Status': True})
+
+
 class AccountDetails(APIView):
     """
     Класс для работы данными пользователя
     """
     throttle_scope = 'user'
+    query_budget = {'get': 2}
 
     # Возвращает все данные пользователя включая все контакты.
     def get(self, request, *args, **kwargs):
         if not request.user.is_authenticated:
             return Response({'Status': False, 'Error': 'Login required'}, status=status.HTTP_403_FORBIDDEN)
 
-        serializer = UserSerializer(request.user)
+        # после аутентификации по токену у пользователя загружены только поля для проверки прав
+        serializer = UserSerializer(User.objects.get(id=request.user.id))
         return Response(serializer.data)
 
     # Изменяем данные пользователя.
@@ -128,6 +165,8 @@ class AccountDetails(APIView):
         if not request.user.is_authenticated:
             return Response({'Status': False, 'Error': 'Login required'}, status=status.HTTP_403_FORBIDDEN)
 
+        user = User.objects.get(id=request.user.id)
+
         # Если есть пароль, проверяем его и сохраняем.
         if 'password' in request.data:
             try:
@@ -135,10 +174,10 @@ class AccountDetails(APIView):
             except Exception as password_error:
                 return Response({'Status': False, 'Errors': {'password': password_error}})
             else:
-                request.user.set_password(request.data['password'])
+                user.set_password(request.data['password'])
 
         # Проверяем остальные данные
-        user_serializer = UserSerializer(request.user, data=request.data, partial=True)
+        user_serializer = UserSerializer(user, data=request.data, partial=True)
         if user_serializer.is_valid():
             user_serializer.save()
             return Response({'Status': True}, status=status.HTTP_201_CREATED)
@@ -146,36 +185,52 @@ class AccountDetails(APIView):
             return Response({'Status': False, 'Errors': user_serializer.errors}, status=status.HTTP_400_BAD_REQUEST)
 
 
-class CategoryView(viewsets.ModelViewSet):
+class CategoryView(ConditionalGetMixin, ReplicaReadMixin, viewsets.ModelViewSet):
     """
     Класс для просмотра категорий
     """
+    stamp_resource = 'categories'
+    query_budget = {'get': 1}
     queryset = Category.objects.all()
     serializer_class = CategorySerializer
     ordering = ('name',)
 
+    # список отдаём из справочника в памяти процесса
+    def list(self, request, *args, **kwargs):
+        return self.get_paginated_response(self.paginate_queryset(category_cache.rows()))
 
-class ShopView(viewsets.ModelViewSet):
+
+class ShopView(ConditionalGetMixin, ReplicaReadMixin, viewsets.ModelViewSet):
     """
     Класс для просмотра списка магазинов
     """
+    stamp_resource = 'shops'
+    query_budget = {'get': 1}
 
     queryset = Shop.objects.all()
     serializer_class = ShopSerializer
     ordering = ('name',)
 
+    # список отдаём из справочника в памяти процесса
+    def list(self, request, *args, **kwargs):
+        return self.get_paginated_response(self.paginate_queryset(shop_rows()))
+
 
-class ProductInfoView(viewsets.ReadOnlyModelViewSet):
+class ProductInfoView(ConditionalGetMixin, ReplicaReadMixin, viewsets.ReadOnlyModelViewSet):
     """
     Класс для поиска товаров
     """
+    stamp_resource = 'products'
     throttle_scope = 'anon'
+    # лента изменений после сброса кэша читает горизонт сжатия из базы
+    query_budget = {'get': 3, 'changes': 4}
     serializer_class = ProductInfoSerializer
+    renderer_classes = (UJSONRenderer, BrowsableAPIRenderer)
     ordering = ('product',)
 
     def get_queryset(self):
 
-        query = Q(shop__state=True)
+        query = Q()
         shop_id = self.request.query_params.get('shop_id')
         category_id = self.request.query_params.get('category_id')
 
@@ -185,13 +240,85 @@ class ProductInfoView(viewsets.ReadOnlyModelViewSet):
         if category_id:
             query = query & Q(product__category_id=category_id)
 
-        # фильтруем и отбрасываем дуликаты
-        queryset = ProductInfo.objects.filter(
+        # фильтруем только по прямым связям, поэтому дубликатов нет и distinct() не нужен,
+        # незавершённые загрузки прайсов и магазины без приёма заказов не показываем;
+        # версии каталогов читаем из той же базы, что и позиции
+        queryset = published_infos().filter(
             query).select_related(
-            'shop', 'product__category').prefetch_related(
-            'product_parameters__parameter').distinct()
-
-        return queryset
+            'product__category').prefetch_related(
+            'product_parameters__parameter')
+
+        # текстовый запрос, фасеты и цены ищем по индексу поиска
+        return filter_products(queryset, self.request.query_params)
+
+    # списки отдаём без сериализаторов: позиции и их параметры читаются двумя запросами,
+    # состав полей задают параметры fields и expand
+    def list(self, request, *args, **kwargs):
+        payload = read_payload(ProductInfoPayload, request.query_params)
+        rows = self.paginate_queryset(product_info_values(self.get_queryset(), payload))
+        return self.get_paginated_response(product_info_payloads(rows, payload))
+
+    # поиск по каталогу с постраничным выводом по курсору и кэшем страниц
+    @action(detail=False)
+    def search(self, request, *args, **kwargs):
+        paginator = KeysetPagination()
+        key = catalog_page_key(request.query_params)
+
+        page = cache.get(key)
+        if page is None:
+            payload = read_payload(ProductInfoPayload, request.query_params)
+            rows = paginator.paginate_queryset(product_info_values(self.get_queryset(), payload), request, view=self,
+                                               key=itemgetter(1, 0))
+            page = {'next_cursor': paginator.next_cursor, 'results': product_info_payloads(rows, payload)}
+            cache.set(key, page, CATALOG_CACHE_TIMEOUT)
+        else:
+            paginator.request = request
+            paginator.next_cursor = page['next_cursor']
+
+        return paginator.get_paginated_response(page['results'])
+
+    # количество товаров по значениям параметров и диапазон цен для текущего запроса
+    @action(detail=False)
+    def facets(self, request, *args, **kwargs):
+        key = catalog_page_key(request.query_params) + ':facets'
+        facets = cache.get(key)
+        if facets is None:
+            facets = facet_counts(self.get_queryset())
+            cache.set(key, facets, CATALOG_CACHE_TIMEOUT)
+        return Response(facets)
+
+    # изменения каталога после номера since для синхронизации без полной выгрузки
+    @action(detail=False)
+    def changes(self, request, *args, **kwargs):
+        try:
+            since = int(request.query_params.get('since', 0))
+            limit = min(int(request.query_params.get('limit', settings.REST_FRAMEWORK['PAGE_SIZE'])),
+                        CHANGES_MAX_LIMIT)
+        except ValueError:
+            return Response({'Status': False, 'Errors': 'Неверный формат запроса'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        # часть ленты уже сжата: клиенту нужно загрузить каталог заново
+        if since < horizon():
+            return Response({'next_since': since, 'resync': True, 'results': []})
+
+        changes = list(CatalogChange.objects.filter(id__gt=since).values_list(
+            'id', 'product_info_id', 'action')[:max(limit, 1)])
+
+        # в ответ отдаём текущее состояние позиций, по несколько изменений одной позиции - одна загрузка
+        upserted = {product_info_id for _, product_info_id, action in changes if action == 'upsert'}
+        infos = product_info_values(published_infos().filter(id__in=upserted))
+        data = {item['id']: item for item in product_info_payloads(list(infos))}
+
+        results = []
+        for seq, product_info_id, action in changes:
+            # позиция уже удалена или скрыта - для клиента это удаление
+            item = data.get(product_info_id)
+            results.append({'seq': seq, 'action': 'upsert' if item else 'delete', 'id': product_info_id,
+                            'data': item})
+
+        return Response({'next_since': changes[-1][0] if changes else since, 'resync': False,
+                         'results': results})
 
 
 class BasketView(APIView):
@@ -199,19 +326,15 @@ class BasketView(APIView):
     Класс для работы с корзиной пользователя
     """
     throttle_scope = 'user'
+    query_budget = {'get': 3}
+    renderer_classes = (UJSONRenderer, BrowsableAPIRenderer)
 
     # получить корзину
     def get(self, request, *args, **kwargs):
         if not request.user.is_authenticated:
             return JsonResponse({'Status': False, 'Error': 'Log in required'}, status=status.HTTP_403_FORBIDDEN)
-        basket = Order.objects.filter(
-            user_id=request.user.id, status='basket').prefetch_related(
-            'ordered_items__product_info__product__category',
-            'ordered_items__product_info__product_parameters__parameter').annotate(
-            total_sum=Sum(F('ordered_items__quantity') * F('ordered_items__product_info__price'))).distinct()
-
-        serializer = OrderSerializer(basket, many=True)
-        return Response(serializer.data)
+        basket = Order.objects.filter(user_id=request.user.id, status='basket')
+        return Response(order_payloads(basket, payload=read_payload(OrderPayload, request.query_params)))
 
     # редактировать корзину
     def post(self, request, *args, **kwargs):
@@ -225,20 +348,22 @@ class BasketView(APIView):
             except ValueError:
                 JsonResponse({'Status': False, 'Errors': 'Неверный формат запроса'})
             else:
-                basket, _ = Order.objects.get_or_create(user_id=request.user.id, state='basket')
+                basket, _ = Order.objects.get_or_create(user_id=request.user.id, status='basket')
                 objects_created = 0
-                for order_item in items_dict:
-                    order_item.update({'order': basket.id})
-                    serializer = OrderItemSerializer(data=order_item)
-                    if serializer.is_valid():
-                        try:
-                            serializer.save()
-                        except IntegrityError as error:
-                            return JsonResponse({'Status': False, 'Errors': str(error)})
+                # итоги корзины пересчитываем один раз после всех позиций
+                with batch_totals():
+                    for order_item in items_dict:
+                        order_item.update({'order': basket.id})
+                        serializer = OrderItemSerializer(data=order_item)
+                        if serializer.is_valid():
+                            try:
+                                serializer.save()
+                            except IntegrityError as error:
+                                return JsonResponse({'Status': False, 'Errors': str(error)})
+                            else:
+                                objects_created += 1
                         else:
-                            objects_created += 1
-                    else:
-                        JsonResponse({'Status': False, 'Errors': serializer.errors})
+                            JsonResponse({'Status': False, 'Errors': serializer.errors})
 
                 return JsonResponse({'Status': True, 'Создано объектов': objects_created})
         return JsonResponse({'Status': False, 'Errors': 'Не указаны все необходимые аргументы'})
@@ -251,7 +376,7 @@ class BasketView(APIView):
         items_sting = request.data.get('items')
         if items_sting:
             items_list = items_sting.split(',')
-            basket, _ = Order.objects.get_or_create(user_id=request.user.id, state='basket')
+            basket, _ = Order.objects.get_or_create(user_id=request.user.id, status='basket')
             query = Q()
             objects_deleted = False
             for order_item_id in items_list:
@@ -260,7 +385,8 @@ class BasketView(APIView):
                     objects_deleted = True
 
             if objects_deleted:
-                deleted_count = OrderItem.objects.filter(query).delete()[0]
+                with batch_totals():
+                    deleted_count = OrderItem.objects.filter(query).delete()[0]
                 return JsonResponse({'Status': True, 'Удалено объектов': deleted_count})
         return JsonResponse({'Status': False, 'Errors': 'Не указаны все необходимые аргументы'})
 
@@ -276,35 +402,114 @@ class BasketView(APIView):
             except ValueError:
                 JsonResponse({'Status': False, 'Errors': 'Неверный формат запроса'})
             else:
-                basket, _ = Order.objects.get_or_create(user_id=request.user.id, state='basket')
+                basket, _ = Order.objects.get_or_create(user_id=request.user.id, status='basket')
                 objects_updated = 0
                 for order_item in items_dict:
                     if type(order_item['id']) == int and type(order_item['quantity']) == int:
                         objects_updated += OrderItem.objects.filter(order_id=basket.id, id=order_item['id']).update(
-                            quantity=order_item['quantity'])
+                            quantity=order_item['quantity'], total_amount=F('price') * order_item['quantity'])
+                # update() не вызывает сигналы, итоги пересчитываем сами
+                update_order_totals([basket.id])
 
                 return JsonResponse({'Status': True, 'Обновлено объектов': objects_updated})
         return JsonResponse({'Status': False, 'Errors': 'Не указаны все необходимые аргументы'})
 
 
+class BasketBulkView(APIView):
+    """
+    Класс для массового изменения корзины одним запросом
+    """
+    throttle_scope = 'user'
+
+    # задать количество по списку позиций: создать, обновить или удалить (quantity = 0)
+    def post(self, request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return Response({'Status': False, 'Error': 'Log in required'}, status=status.HTTP_403_FORBIDDEN)
+
+        items = request.data.get('items')
+        if isinstance(items, str):
+            try:
+                items = load_json(items)
+            except ValueError:
+                items = None
+        if not isinstance(items, list) or not items:
+            return Response({'Status': False, 'Errors': 'Неверный формат запроса'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        # проверяем все строки за один проход и одним запросом загружаем товары
+        results = []
+        lines = {}
+        for line, item in enumerate(items):
+            product_info_id = item.get('product_info') if isinstance(item, dict) else None
+            quantity = item.get('quantity') if isinstance(item, dict) else None
+            result = {'line': line, 'product_info': product_info_id}
+            results.append(result)
+            if type(product_info_id) != int or type(quantity) != int or quantity < 0:
+                result.update({'Status': False, 'Errors': 'Нужны целые product_info и quantity'})
+            elif quantity > BASKET_MAX_QUANTITY:
+                result.update({'Status': False, 'Errors': f'Количество не может быть больше {BASKET_MAX_QUANTITY}'})
+            elif product_info_id in lines:
+                result.update({'Status': False, 'Errors': f'Позиция повторяет строку {lines[product_info_id][0]}'})
+            else:
+                lines[product_info_id] = (line, quantity)
+
+        prices = dict(ProductInfo.objects.published().filter(
+            id__in=lines, shop__state=True).values_list('id', 'price'))
+
+        # итоги корзины пересчитываются один раз, внутри той же транзакции
+        with transaction.atomic(), batch_totals():
+            basket, _ = Order.objects.get_or_create(user_id=request.user.id, status='basket')
+            existing = {item.product_info_id: item for item in OrderItem.objects.filter(
+                order_id=basket.id, product_info_id__in=lines)}
+
+            created = []
+            updated = []
+            deleted = []
+            for product_info_id, (line, quantity) in lines.items():
+                result = results[line]
+                if product_info_id not in prices:
+                    result.update({'Status': False, 'Errors': 'Товар не найден'})
+                    continue
+
+                item = existing.get(product_info_id)
+                if quantity == 0:
+                    if item:
+                        deleted.append(item.id)
+                    result.update({'Status': True, 'Action': 'deleted' if item else 'skipped'})
+                elif item:
+                    item.quantity = quantity
+                    item.total_amount = item.price * quantity
+                    updated.append(item)
+                    result.update({'Status': True, 'Action': 'updated'})
+                else:
+                    price = prices[product_info_id]
+                    created.append(OrderItem(order_id=basket.id, product_info_id=product_info_id, quantity=quantity,
+                                             price=price, total_amount=price * quantity))
+                    result.update({'Status': True, 'Action': 'created'})
+
+            OrderItem.objects.bulk_create(created)
+            OrderItem.objects.bulk_update(updated, ('quantity', 'total_amount'))
+            OrderItem.objects.filter(id__in=deleted).delete()
+            # bulk_create и bulk_update не вызывают сигналы
+            order_items_changed([basket.id])
+
+        return Response({'Status': all(result['Status'] for result in results), 'Results': results})
+
+
 class OrderView(APIView):
     """
     Класс для получения и размешения заказов пользователями
     """
     throttle_scope = 'user'
+    query_budget = {'get': 3}
+    renderer_classes = (UJSONRenderer, BrowsableAPIRenderer)
 
     def get(self, request, *args, **kwargs):
         if not request.user.is_authenticated:
             return Response({'Status': False, 'Error': 'Log in required'}, status=status.HTTP_403_FORBIDDEN)
 
-        order = Order.objects.filter(
-            user_id=request.user.id).exclude(status='basket').select_related('contact').prefetch_related(
-            'ordered_items').annotate(
-            total_quantity=Sum('ordered_items__quantity'),
-            total_sum=Sum('ordered_items__total_amount')).distinct()
-
-        serializer = OrderSerializer(order, many=True)
-        return Response(serializer.data)
+        order = Order.objects.filter(user_id=request.user.id).exclude(status='basket')
+        return Response(order_payloads(order, payload=read_payload(OrderPayload, request.query_params)))
 
     # Размещаем заказ из корзины и посылаем письмо об изменении статуса заказа.
     def post(self, request, *args, **kwargs):
@@ -313,18 +518,16 @@ class OrderView(APIView):
 
         if request.data['id'].isdigit():
             try:
-                is_updated = Order.objects.filter(
-                    id=request.data['id'], user_id=request.user.id).update(
-                    contact_id=request.data['contact'],
-                    status='new')
+                is_updated = reserve_order(request.data['id'], request.user.id, request.data['contact'])
+            except OutOfStock as error:
+                return Response({'Status': False, 'Errors': 'Недостаточно товара', 'Items': error.product_infos},
+                                status=status.HTTP_409_CONFLICT)
             except IntegrityError as error:
                 return Response({'Status': False, 'Errors': 'Неправильно указаны аргументы'},
                                 status=status.HTTP_400_BAD_REQUEST)
             else:
                 if is_updated:
-                    request.user.email_user(f'Обновление статуса заказа',
-                                            'Заказ сформирован',
-                                            from_email=settings.EMAIL_HOST_USER)
+                    queue_email('Обновление статуса заказа', 'Заказ сформирован', request.user.email)
                     return Response({'Status': True})
 
         return Response({'Status': False, 'Errors': 'Не указаны все необходимые аргументы'},
@@ -336,6 +539,7 @@ class ContactView(APIView):
     Класс для работы с контактами покупателей
     """
     throttle_scope = 'user'
+    query_budget = {'get': 1, 'put': 2}
 
     # получить мои контакты
     def get(self, request, *args, **kwargs):
@@ -392,23 +596,26 @@ class ContactView(APIView):
         if 'id' in request.data:
             if request.data['id'].isdigit():
                 contact = Contact.objects.filter(id=request.data['id'], user_id=request.user.id).first()
-                print(contact)
                 if contact:
-                    serializer = ContactSerializer(contact, data=request.data, partial=True)
+                    # контакт остаётся у владельца: поле user не меняем и не ищем пользователя по нему
+                    data = {key: value for key, value in request.data.items() if key != 'user'}
+                    serializer = ContactSerializer(contact, data=data, partial=True)
                     if serializer.is_valid():
                         serializer.save()
                         return JsonResponse({'Status': True})
                     else:
-                        JsonResponse({'Status': False, 'Errors': serializer.errors})
+                        return JsonResponse({'Status': False, 'Errors': serializer.errors})
 
         return JsonResponse({'Status': False, 'Errors': 'Не указаны все необходимые аргументы'})
 
 
-class PartnerOrders(APIView):
+class PartnerOrders(ReplicaReadMixin, APIView):
     """
     Класс для получения заказов поставщиками
     """
     throttle_scope = 'user'
+    query_budget = 3
+    renderer_classes = (UJSONRenderer, BrowsableAPIRenderer)
 
     def get(self, request, *args, **kwargs):
         if not request.user.is_authenticated:
@@ -417,15 +624,65 @@ class PartnerOrders(APIView):
         if request.user.type != 'shop':
             return Response({'Status': False, 'Error': 'Только для магазинов'}, status=status.HTTP_403_FORBIDDEN)
 
-        pr = Prefetch('ordered_items', queryset=OrderItem.objects.filter(shop__user_id=request.user.id))
+        # в заказе показываем только позиции магазина и его подытог
+        items = OrderItem.objects.filter(product_info__shop__user_id=request.user.id)
         order = Order.objects.filter(
-            ordered_items__shop__user_id=request.user.id).exclude(status='basket') \
-            .prefetch_related(pr).select_related('contact').annotate(
-            total_sum=Sum('ordered_items__total_amount'),
-            total_quantity=Sum('ordered_items__quantity'))
+            shop_totals__shop__user_id=request.user.id).exclude(status='basket').annotate(
+            shop_total_sum=F('shop_totals__total_sum'),
+            shop_total_quantity=F('shop_totals__total_quantity'))
 
-        serializer = OrderSerializer(order, many=True)
-        return Response(serializer.data)
+        payload = read_payload(OrderPayload, request.query_params, totals=('shop_total_quantity', 'shop_total_sum'))
+        return Response(order_payloads(order, items, payload))
+
+
+class PartnerOrdersExport(APIView):
+    """
+    Класс для выгрузки заказов поставщика файлом
+    """
+    throttle_scope = 'user'
+
+    formats = {
+        'csv': ('text/csv', iter_csv),
+        'jsonl': ('application/x-ndjson', iter_jsonl),
+        'xlsx': ('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', None),
+    }
+
+    def get(self, request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return Response({'Status': False, 'Error': 'Login required'}, status=status.HTTP_403_FORBIDDEN)
+
+        if request.user.type != 'shop':
+            return Response({'Status': False, 'Error': 'Только для магазинов'}, status=status.HTTP_403_FORBIDDEN)
+
+        # параметр format занят DRF под выбор рендерера
+        file_format = request.query_params.get('file_format', 'csv')
+        if file_format not in self.formats:
+            return Response({'Status': False, 'Errors': f'Поддерживаются форматы: {", ".join(self.formats)}'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        items = OrderItem.objects.filter(product_info__shop__user_id=request.user.id).exclude(order__status='basket')
+        order_status = request.query_params.get('status')
+        if order_status:
+            items = items.filter(order__status=order_status)
+        for param, lookup in (('date_from', 'order__dt__date__gte'), ('date_to', 'order__dt__date__lte')):
+            value = request.query_params.get(param)
+            if value:
+                try:
+                    day = parse_date(value)
+                except ValueError:
+                    day = None
+                if day is None:
+                    return Response({'Status': False, 'Errors': f'Неверная дата {param}'},
+                                    status=status.HTTP_400_BAD_REQUEST)
+                items = items.filter(**{lookup: day})
+
+        content_type, writer = self.formats[file_format]
+        if writer:
+            response = StreamingHttpResponse(writer(items), content_type=content_type)
+        else:
+            response = FileResponse(write_xlsx(items), content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="orders.{file_format}"'
+        return response
 
 
 class PartnerState(APIView):
@@ -433,6 +690,7 @@ class PartnerState(APIView):
     Класс для работы со статусом поставщика
     """
     throttle_scope = 'user'
+    query_budget = {'get': 1}
 
     # Получить текущий статус получения заказов у магазина
     def get(self, request, *args, **kwargs):
@@ -442,7 +700,10 @@ class PartnerState(APIView):
         if request.user.type != 'shop':
             return Response({'Status': False, 'Error': 'Только для магазинов'}, status=status.HTTP_403_FORBIDDEN)
 
-        shop = request.user.shop
+        shop = Shop.objects.filter(user_id=request.user.id).first()
+        if not shop:
+            return Response({'Status': False, 'Error': 'Магазин не найден'}, status=status.HTTP_404_NOT_FOUND)
+
         serializer = ShopSerializer(shop)
         return Response(serializer.data)
 
@@ -457,7 +718,16 @@ class PartnerState(APIView):
         state = request.data.get('state')
         if state:
             try:
-                Shop.objects.filter(user_id=request.user.id).update(state=strtobool(state))
+                shops = Shop.objects.filter(user_id=request.user.id)
+                with transaction.atomic():
+                    shops.update(state=strtobool(state))
+                    # позиции магазина появляются в каталоге или пропадают из него
+                    record_changes(upserted=ProductInfo.objects.filter(
+                        shop__user_id=request.user.id).values_list('id', flat=True))
+                for shop_id in shops.values_list('id', flat=True):
+                    invalidate_catalog(shop_id)
+                # update() не вызывает сигналы, позиции отмечает record_changes
+                touch('shops')
                 return Response({'Status': True})
             except ValueError as error:
                 return Response({'Status': False, 'Errors': str(error)}, status=status.HTTP_400_BAD_REQUEST)
@@ -478,12 +748,111 @@ class PartnerUpdate(APIView):
         if request.user.type != 'shop':
             return Response({'Status': False, 'Error': 'Только для магазинов'}, status=status.HTTP_403_FORBIDDEN)
 
-        file = request.FILES
-        if file:
-            user_id = request.user.id
-            import_shop_data(file, user_id)
+        file = request.FILES.get('file')
+        url = request.data.get('url')
+        if file or url:
+            if url:
+                validate_url = URLValidator()
+                try:
+                    validate_url(url)
+                    check_url(url)
+                except (ValidationError, PriceFetchError) as error:
+                    return Response({'Status': False, 'Error': str(error)}, status=status.HTTP_400_BAD_REQUEST)
 
-            return Response({'Status': True})
+            try:
+                chunked = strtobool(request.data.get('chunked', 'false'))
+            except ValueError as error:
+                return Response({'Status': False, 'Errors': str(error)}, status=status.HTTP_400_BAD_REQUEST)
+
+            # сохраняем прайс и ставим загрузку в очередь, не дожидаясь её окончания.
+            # Две загрузки одного магазина записывали бы одну и ту же версию каталога
+            with transaction.atomic():
+                job = queue_import(request.user.id, file=file, url=url, chunked=chunked)
+            if job is None:
+                return Response({'Status': False, 'Error': 'Предыдущая загрузка прайса ещё не завершена'},
+                                status=status.HTTP_409_CONFLICT)
+
+            return Response({'Status': True, 'Job': job.id}, status=status.HTTP_202_ACCEPTED)
 
         return Response({'Status': False, 'Errors': 'Не указаны все необходимые аргументы'},
                         status=status.HTTP_400_BAD_REQUEST)
+
+
+class PartnerSchedule(APIView):
+    """
+    Класс для настройки обновления прайса по расписанию
+    """
+    throttle_scope = 'user'
+    query_budget = {'get': 1}
+
+    # Получить адрес прайса, интервал и время следующего обновления
+    def get(self, request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return Response({'Status': False, 'Error': 'Log in required'}, status=status.HTTP_403_FORBIDDEN)
+
+        if request.user.type != 'shop':
+            return Response({'Status': False, 'Error': 'Только для магазинов'}, status=status.HTTP_403_FORBIDDEN)
+
+        shop = Shop.objects.filter(user_id=request.user.id).first()
+        if not shop:
+            return Response({'Status': False, 'Error': 'Магазин не найден'}, status=status.HTTP_404_NOT_FOUND)
+
+        serializer = PriceRefreshSerializer(shop)
+        return Response(serializer.data)
+
+    # Изменить расписание, пустые price_url или refresh_interval отключают обновление
+    def post(self, request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return Response({'Status': False, 'Error': 'Log in required'}, status=status.HTTP_403_FORBIDDEN)
+
+        if request.user.type != 'shop':
+            return Response({'Status': False, 'Error': 'Только для магазинов'}, status=status.HTTP_403_FORBIDDEN)
+
+        shop = Shop.objects.filter(user_id=request.user.id).first()
+        if not shop:
+            return Response({'Status': False, 'Error': 'Магазин не найден'}, status=status.HTTP_404_NOT_FOUND)
+
+        serializer = PriceRefreshSerializer(shop, data=request.data, partial=True)
+        if serializer.is_valid():
+            # время первого обновления по новому расписанию назначит schedule_price_refreshes
+            serializer.save(next_refresh_at=None)
+            return Response({'Status': True})
+        return Response({'Status': False, 'Errors': serializer.errors}, status=status.HTTP_400_BAD_REQUEST)
+
+
+class PartnerUpdateStatus(APIView):
+    """
+    Класс для получения хода загрузки прайса
+    """
+    throttle_scope = 'user'
+
+    def get(self, request, job_id, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return Response({'Status': False, 'Error': 'Log in required'}, status=status.HTTP_403_FORBIDDEN)
+
+        if request.user.type != 'shop':
+            return Response({'Status': False, 'Error': 'Только для магазинов'}, status=status.HTTP_403_FORBIDDEN)
+
+        job = ImportJob.objects.filter(id=job_id, user_id=request.user.id).first()
+        if not job:
+            return Response({'Status': False, 'Error': 'Загрузка не найдена'}, status=status.HTTP_404_NOT_FOUND)
+
+        serializer = ImportJobSerializer(job)
+        return Response(serializer.data)
+
+
+class QueryMetricsView(APIView):
+    """
+    Класс для получения итогов запросов к базе по представлениям и задачам
+    """
+    throttle_scope = 'user'
+
+    def get(self, request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return Response({'Status': False, 'Error': 'Log in required'}, status=status.HTTP_403_FORBIDDEN)
+
+        if not request.user.is_staff:
+            return Response({'Status': False, 'Error': 'Только для администраторов'},
+                            status=status.HTTP_403_FORBIDDEN)
+
+        return Response(query_metrics.read())